@@ -0,0 +1,143 @@
+import threading
+import time
+
+import numpy as np
+
+# 回答キャッシュの設定
+ANSWER_CACHE_THRESHOLD = 0.95  # キャッシュした質問とのコサイン類似度がこの値以上なら同じ質問とみなす
+ANSWER_CACHE_MAX_ENTRIES = 1000  # 名前空間ごとに保持する回答の最大件数
+ANSWER_CACHE_TTL = 3600.0  # 回答の有効期限(秒)
+INITIAL_CAPACITY = 64  # 名前空間ごとに最初に確保する行数 (足りなくなったら倍に広げる)
+
+
+class _Namespace:
+    """同じ検索条件の回答をまとめて保持する。質問のベクトルは正規化して1つの行列に並べる"""
+
+    def __init__(self, dim: int):
+        self.vectors = np.zeros((INITIAL_CAPACITY, dim), dtype=np.float32)
+        self.expires_at = np.zeros(INITIAL_CAPACITY, dtype=np.float64)
+        self.last_used = np.zeros(INITIAL_CAPACITY, dtype=np.float64)
+        self.entries = []  # {"answer": ..., "docs": ...}
+        self.size = 0
+
+    def slot_for_new_entry(self, max_entries: int, now: float) -> int:
+        if self.size < len(self.vectors):
+            self.size += 1
+            self.entries.append(None)
+            return self.size - 1
+        if self.size < max_entries:
+            capacity = min(len(self.vectors) * 2, max_entries)
+            self.vectors = np.resize(self.vectors, (capacity, self.vectors.shape[1]))
+            self.expires_at = np.resize(self.expires_at, capacity)
+            self.last_used = np.resize(self.last_used, capacity)
+            return self.slot_for_new_entry(max_entries, now)
+        # 上限に達している場合は期限切れの回答、なければ最も長く参照されていない回答を置き換える
+        expired = np.flatnonzero(self.expires_at[:self.size] <= now)
+        if len(expired):
+            return int(expired[0])
+        return int(np.argmin(self.last_used[:self.size]))
+
+
+class SemanticAnswerCache:
+    """
+    質問のベクトルの類似度で引く回答キャッシュ
+    - 言い換えられた質問でも、キャッシュした質問とのコサイン類似度が threshold 以上なら回答を再利用する
+    - 検索条件(インデックス名、top_k など)ごとの名前空間に分けて保持し、NumPyの行列積でまとめて比較する
+    - 件数の上限を超えたらLRUで、有効期限(TTL)を過ぎたら参照時に破棄する
+    - インデックスごとの世代番号を持ち、/index で登録されるたびに世代を進めて古い回答を無効にする
+    """
+
+    def __init__(
+        self,
+        threshold: float = ANSWER_CACHE_THRESHOLD,
+        max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+        ttl: float = ANSWER_CACHE_TTL,
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._namespaces = {}  # (index_name, 検索条件...) -> _Namespace
+        self._generations = {}  # index_name -> 世代番号
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def generation(self, index_name: str) -> int:
+        with self._lock:
+            return self._generations.get(index_name, 0)
+
+    def bump_generation(self, index_name: str) -> int:
+        """インデックスの内容が変わったときに呼び出し、そのインデックスの回答をすべて無効にする"""
+        with self._lock:
+            self._generations[index_name] = self._generations.get(index_name, 0) + 1
+            stale = [key for key in self._namespaces if key[0] == index_name]
+            for key in stale:
+                del self._namespaces[key]
+            self.invalidations += 1
+            return self._generations[index_name]
+
+    def lookup(self, namespace: tuple, embedding):
+        """
+        namespace: 先頭の要素がインデックス名の検索条件のタプル
+        戻り値: 類似度が threshold 以上の回答 {"answer": ..., "docs": ..., "similarity": ...}、なければ None
+        """
+        query = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            space = self._namespaces.get(namespace)
+            if space is None or space.size == 0:
+                self.misses += 1
+                return None
+            similarities = space.vectors[:space.size] @ query
+            similarities[space.expires_at[:space.size] <= now] = -np.inf  # 期限切れの回答は対象外
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            space.last_used[best] = now
+            self.hits += 1
+            return {**space.entries[best], "similarity": float(similarities[best])}
+
+    def store(self, namespace: tuple, embedding, answer: str, docs: list, generation: int):
+        """
+        generation: 回答の生成を始める前に generation() で取得した世代番号
+        生成中にインデックスが更新されていた場合は古い回答になるため保存しない
+        """
+        if self.max_entries <= 0:
+            return
+        vector = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            if self._generations.get(namespace[0], 0) != generation:
+                return
+            space = self._namespaces.get(namespace)
+            if space is None:
+                space = self._namespaces[namespace] = _Namespace(len(vector))
+            slot = space.slot_for_new_entry(self.max_entries, now)
+            space.vectors[slot] = vector
+            space.expires_at[slot] = now + self.ttl
+            space.last_used[slot] = now
+            space.entries[slot] = {"answer": answer, "docs": docs}
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "namespaces": len(self._namespaces),
+                "entries": sum(space.size for space in self._namespaces.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "threshold": self.threshold,
+            }
+
+
+answer_cache = SemanticAnswerCache()
@@ -1,3 +1,14 @@
+import hashlib
+import itertools
+import re
+
+# 文の区切り (日本語の文末の記号と改行)。記号が続く場合 (「！？」や「。\n」) は1文にまとめる
+SENTENCE_DELIMITERS = "。！？!?\n"
+_SENTENCE_PATTERN = re.compile(f"[^{SENTENCE_DELIMITERS}]*[{SENTENCE_DELIMITERS}]+")
+MAX_SENTENCE_CHARS = 10000  # 文末の記号がないまま続くテキストを1文として溜めておく最大文字数
+TOKEN_COUNT_BATCH_SIZE = 256  # トークン数をまとめて数える文の数
+
+
 def chunking(text: str, chunk_size: int = 50, overlap: int = 10):
     """
     文字数ベースでテキストをチャンク分割し、重複部分も含める
@@ -5,24 +16,178 @@ def chunking(text: str, chunk_size: int = 50, overlap: int = 10):
     chunk_size: 1チャンクの文字数
     overlap: 前のチャンクと重複させる文字数
     """
+    return list(chunking_stream([text], chunk_size=chunk_size, overlap=overlap))
+
+
+def _with_offsets(chunk: str, start: int, with_offsets: bool):
+    # with_offsets=True の場合は (チャンク, 開始位置, 終了位置) を返す。位置はテキスト全体での文字の位置
+    return (chunk, start, start + len(chunk)) if with_offsets else chunk
+
+
+def chunking_stream(blocks, chunk_size: int = 50, overlap: int = 10, with_offsets: bool = False):
+    """
+    分割して読み込んだテキストを順に受け取り、チャンクを1件ずつ生成するジェネレータ
+    ブロックの境界をまたぐチャンクと重複部分は次のブロックに引き継ぐため、結果は全文を chunking した場合と同じになる
+    blocks: 文字列のイテラブル
+    chunk_size: 1チャンクの文字数
+    overlap: 前のチャンクと重複させる文字数
+    with_offsets: True の場合は (チャンク, 開始位置, 終了位置) を生成する (テキスト[開始位置:終了位置] がチャンクになる)
+    """
     if overlap >= chunk_size:
         raise ValueError("overlap must be smaller than chunk_size")
 
-    chunks = []
+    step = chunk_size - overlap
+    buffer = ""
+    offset = 0  # buffer の先頭のテキスト全体での位置
+    for block in blocks:
+        buffer += block
+        start = 0
+        while len(buffer) - start >= chunk_size:
+            yield _with_offsets(buffer[start:start + chunk_size], offset + start, with_offsets)
+            start += step  # オーバーラップ分を戻す
+        buffer = buffer[start:]  # 未処理の部分と重複部分を次のブロックへ引き継ぐ
+        offset += start
+
+    # 最後のブロックの残り
     start = 0
-    text_length = len(text)
+    while start < len(buffer):
+        yield _with_offsets(buffer[start:start + chunk_size], offset + start, with_offsets)
+        start += step
+
+
+def _sentence_spans(blocks):
+    """
+    テキストを文末の記号と改行で区切り、(開始位置, 文) を順に生成する (空白だけの文も含め、テキスト全体を隙間なく区切る)
+    ブロックの境界をまたぐ文は次のブロックに引き継ぐため、結果はブロックの区切り方によらない
+    """
+    buffer = ""
+    offset = 0  # buffer の先頭のテキスト全体での位置
+    for block in blocks:
+        buffer += block
+        start = 0
+        for match in _SENTENCE_PATTERN.finditer(buffer):
+            if match.end() == len(buffer):
+                break  # 次のブロックの先頭に記号が続く場合があるため、末尾の文は引き継ぐ
+            yield from _limit_length(offset + match.start(), match.group())
+            start = match.end()
+        buffer = buffer[start:]
+        offset += start
+        # 記号のない長いテキストは MAX_SENTENCE_CHARS 文字ずつ1文として扱い、メモリ使用量を抑える
+        while len(buffer) > MAX_SENTENCE_CHARS and not _SENTENCE_PATTERN.match(buffer[:MAX_SENTENCE_CHARS]):
+            yield offset, buffer[:MAX_SENTENCE_CHARS]
+            buffer = buffer[MAX_SENTENCE_CHARS:]
+            offset += MAX_SENTENCE_CHARS
+
+    if buffer:
+        yield from _limit_length(offset, buffer)
 
-    while start < text_length:
-        end = start + chunk_size
-        chunk = text[start:end]
-        chunks.append(chunk)
-        start += chunk_size - overlap  # オーバーラップ分を戻す
 
-    return chunks
+def _limit_length(start: int, sentence: str) -> list:
+    # ブロックの区切り方によらず同じ結果になるよう、長い文は先頭から MAX_SENTENCE_CHARS 文字ずつに分ける
+    return [(start + i, sentence[i:i + MAX_SENTENCE_CHARS]) for i in range(0, len(sentence), MAX_SENTENCE_CHARS)]
+
+
+def split_sentences(blocks):
+    """
+    分割して読み込んだテキストを文末の記号と改行で区切り、1文ずつ生成するジェネレータ
+    文は末尾の記号を含み、空白だけの文は返さない。ブロックの境界をまたぐ文は次のブロックに引き継ぐため、結果はブロックの区切り方によらない
+    blocks: 文字列のイテラブル
+    """
+    for _, sentence in _sentence_spans(blocks):
+        if not sentence.isspace():
+            yield sentence
+
+
+def count_chars(texts: list) -> list:
+    # トークナイザーを使わない場合は文字数をトークン数とする
+    return [len(text) for text in texts]
+
+
+def _split_long_sentence(start: int, sentence: str, tokens: int, max_tokens: int, count_tokens) -> list:
+    """max_tokens を超える1文を、各部分が max_tokens 以下になるように文字で区切る。戻り値は [(開始位置, 部分, トークン数), ...]"""
+    size = max(len(sentence) * max_tokens // tokens, 1)
+    while True:
+        offsets = range(0, len(sentence), size)
+        pieces = [sentence[i:i + size] for i in offsets]
+        counts = count_tokens(pieces)
+        if size == 1 or max(counts) <= max_tokens:
+            return [(start + i, piece, count) for i, piece, count in zip(offsets, pieces, counts)]
+        size = max(min(size - 1, size * max_tokens // max(counts)), 1)
+
+
+def _join_sentences(sentences: list, with_offsets: bool):
+    # 連続した文をつなげて前後の空白を除く。空白だけの場合は None
+    text = "".join(sentence for _, sentence, _ in sentences)
+    chunk = text.strip()
+    if not chunk:
+        return None
+    return _with_offsets(chunk, sentences[0][0] + len(text) - len(text.lstrip()), with_offsets)
+
+
+def sentence_chunking_stream(blocks, max_tokens: int = 128, overlap: int = 1, count_tokens=count_chars, with_offsets: bool = False):
+    """
+    文の区切りを保ったまま、トークン数の合計が max_tokens 以下になるまで文を詰めてチャンクを1件ずつ生成するジェネレータ
+    max_tokens を超える1文だけは文字で区切る。トークン数は TOKEN_COUNT_BATCH_SIZE 文ずつまとめて数える
+    blocks: 文字列のイテラブル
+    max_tokens: 1チャンクのトークン数の上限
+    overlap: 前のチャンクの末尾から重複させる文の数 (上限に収まる分だけ)
+    count_tokens: 文字列のリストを受け取り、それぞれのトークン数のリストを返す関数 (既定は文字数)
+    with_offsets: True の場合は (チャンク, 開始位置, 終了位置) を生成する (テキスト[開始位置:終了位置] がチャンクになる)
+    """
+    if max_tokens < 1:
+        raise ValueError("max_tokens must be positive")
+    if overlap < 0:
+        raise ValueError("overlap must not be negative")
+
+    current = []  # (開始位置, 文, トークン数) のリスト。テキスト上で連続している
+    total = 0
+    spans = _sentence_spans(blocks)
+    while batch := list(itertools.islice(spans, TOKEN_COUNT_BATCH_SIZE)):
+        for (start, sentence), tokens in zip(batch, count_tokens([sentence for _, sentence in batch])):
+            if tokens > max_tokens:
+                pieces = _split_long_sentence(start, sentence, tokens, max_tokens, count_tokens)
+            else:
+                pieces = [(start, sentence, tokens)]
+            for piece in pieces:
+                if current and total + piece[2] > max_tokens:
+                    if (chunk := _join_sentences(current, with_offsets)) is not None:
+                        yield chunk
+                    # 末尾の overlap 文を次のチャンクに引き継ぐ (チャンク全体は引き継がない)
+                    current = current[len(current) - min(overlap, len(current) - 1):]
+                    total = sum(t for _, _, t in current)
+                    while current and total + piece[2] > max_tokens:
+                        total -= current.pop(0)[2]
+                current.append(piece)
+                total += piece[2]
+
+    if current and (chunk := _join_sentences(current, with_offsets)) is not None:
+        yield chunk
+
+
+def sentence_chunking(text: str, max_tokens: int = 128, overlap: int = 1, count_tokens=count_chars):
+    """文の区切りとトークン数の上限でテキストをチャンク分割する (sentence_chunking_stream のリスト版)"""
+    return list(sentence_chunking_stream([text], max_tokens=max_tokens, overlap=overlap, count_tokens=count_tokens))
+
+
+def make_document_id(file_hash: str, chunking: str) -> str:
+    """
+    ファイルの内容のハッシュ(SHA-256)とチャンク分割の設定からドキュメントIDを作る
+    内容かチャンク分割の設定が変わると別のIDになるため、同じ名前のドキュメントの登録済みの版と区別できる
+    """
+    return hashlib.sha256(f"{chunking}\0{file_hash}".encode("utf-8")).hexdigest()
+
+
+def make_chunk_id(source: str, content: str) -> str:
+    """
+    ソースドキュメント名とチャンク内容のハッシュからチャンクIDを作る
+    内容を一部変更したドキュメントを再登録しても、変更のないチャンクは同じIDになり埋め込みを再利用できる
+    """
+    return hashlib.sha256(f"{source}\0{content}".encode("utf-8")).hexdigest()
 
 
 if __name__ == '__main__':
     input_text = "これはテスト用の長い文章です。" * 50
     chunked_text = chunking(input_text)
     result = {i: j for i, j in enumerate(chunked_text)}
-    print(result)
\ No newline at end of file
+    print(result)
+    print(sentence_chunking(input_text, max_tokens=50))
\ No newline at end of file
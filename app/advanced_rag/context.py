@@ -0,0 +1,94 @@
+from embedding import count_tokens
+
+# 回答生成のプロンプトに入れる検索結果(コンテキスト)の設定
+CONTEXT_MAX_TOKENS = 1024  # コンテキストのトークン数の上限 (埋め込みモデルのトークナイザーで数える)
+# 同じドキュメントのチャンクの間がこの文字数以下ならつなげる
+# 文で区切ったチャンクは前後の空白を除いているため、続きのチャンクとの間は改行などの空白1文字になる
+CONTEXT_MERGE_GAP = 1
+CONTEXT_MIN_TRUNCATED_TOKENS = 32  # 上限に収まらない範囲を切り詰めて入れる場合の最小トークン数
+CONTEXT_SEPARATOR = "\n"  # 範囲と範囲の間の区切り
+
+
+def _dedupe_key(content: str) -> str:
+    # 空白の違いだけのチャンクは同じ内容とみなす
+    return " ".join(content.split())
+
+
+def merge_spans(docs: list) -> list:
+    """
+    検索結果を元ドキュメント(doc_id)ごとに位置で並べ、重なる・隣接するチャンクを1つの範囲にまとめる
+    ドキュメント名(source)が同じでも内容が異なるアップロードは doc_id が異なるためつなげない
+    IDまたは内容が同じチャンクは1つにする。doc_id や位置を持たないチャンクはそのまま1つの範囲にする
+    docs: 関連度の高い順の検索結果 ({"id", "content", "source", "doc_id", "start", "end", ...})
+    戻り値: 範囲に含まれるチャンクの最も高い順位の順に並べた [{"content", "source", "doc_id", "start", "end", "rank"}, ...]
+    """
+    seen = set()
+    spans = []
+    by_document = {}
+    for rank, doc in enumerate(docs):
+        keys = {("content", _dedupe_key(doc["content"]))}
+        if doc.get("id"):
+            keys.add(("id", doc["id"]))
+        if keys & seen:
+            continue
+        seen |= keys
+        span = {
+            "content": doc["content"], "source": doc.get("source"), "doc_id": doc.get("doc_id"),
+            "start": doc.get("start"), "end": doc.get("end"), "rank": rank,
+        }
+        if span["doc_id"] is None or span["start"] is None or span["end"] is None:
+            spans.append(span)
+        else:
+            by_document.setdefault(span["doc_id"], []).append(span)
+
+    for items in by_document.values():
+        items.sort(key=lambda span: span["start"])
+        current = items[0]
+        for span in items[1:]:
+            gap = span["start"] - current["end"]
+            if gap > CONTEXT_MERGE_GAP:
+                spans.append(current)
+                current = span
+                continue
+            if span["end"] > current["end"]:
+                if gap > 0:
+                    current["content"] += "\n" + span["content"]
+                else:
+                    current["content"] += span["content"][current["end"] - span["start"]:]
+                current["end"] = span["end"]
+            current["rank"] = min(current["rank"], span["rank"])
+        spans.append(current)
+    return sorted(spans, key=lambda span: span["rank"])
+
+
+def _truncate(text: str, tokens: int, max_tokens: int, count_tokens) -> str:
+    # 先頭から max_tokens 以下に収まる長さに切り詰める
+    size = len(text) * max_tokens // tokens
+    while size > 0:
+        if count_tokens([text[:size]])[0] <= max_tokens:
+            return text[:size]
+        size = min(size - 1, size * 9 // 10)
+    return ""
+
+
+def pack_context(docs: list, max_tokens: int = CONTEXT_MAX_TOKENS, count_tokens=count_tokens) -> str:
+    """
+    検索結果から回答生成のプロンプトに入れるコンテキストを作る
+    重なる・隣接するチャンクをつなげて重複を除き、関連度の高い範囲から max_tokens に収まるだけ入れる
+    収まらない範囲は飛ばして次の範囲を試し、残りが CONTEXT_MIN_TRUNCATED_TOKENS 以上なら切り詰めて入れる
+    """
+    spans = merge_spans(docs)
+    if not spans:
+        return ""
+    parts = []
+    total = 0
+    for span, tokens in zip(spans, count_tokens([span["content"] for span in spans])):
+        if total + tokens <= max_tokens:
+            parts.append(span["content"])
+            total += tokens
+            continue
+        remaining = max_tokens - total
+        if remaining >= CONTEXT_MIN_TRUNCATED_TOKENS:
+            parts.append(_truncate(span["content"], tokens, remaining, count_tokens))
+            break
+    return CONTEXT_SEPARATOR.join(part for part in parts if part)
@@ -0,0 +1,44 @@
+# 複数の検索結果の統合 (Elasticsearch とローカルのバックエンドで共通)
+
+# ハイブリッド検索の設定
+FUSION_METHODS = ("rrf", "weighted")
+RRF_RANK_CONSTANT = 60  # Reciprocal Rank Fusion の定数k (大きいほど下位の順位も重視する)
+HYBRID_VECTOR_WEIGHT = 0.5  # weighted で統合する場合のベクトル検索の重み (BM25は 1 - この値)
+HYBRID_WINDOW_SIZE = 50  # 統合前に各検索から取得する件数の下限
+
+
+def fuse_results(
+    result_lists: dict,
+    top_k: int,
+    method: str = "rrf",
+    vector_weight: float = HYBRID_VECTOR_WEIGHT,
+    rank_constant: int = RRF_RANK_CONSTANT,
+) -> list:
+    """
+    複数の検索結果をチャンクIDで重複除去して1つのランキングに統合する
+    :param result_lists: {"bm25": [...], "vector": [...]} 形式の検索結果
+    :param method: "rrf" は順位の逆数の和、"weighted" は検索ごとに0〜1へ正規化したスコアの重み付き和
+    :return: 統合後のスコアの高い順に top_k 件
+    """
+    if method not in FUSION_METHODS:
+        raise ValueError(f"method must be one of {FUSION_METHODS}")
+
+    weights = {"vector": vector_weight, "bm25": 1.0 - vector_weight}
+    fused = {}
+    for name, results in result_lists.items():
+        if not results:
+            continue
+        if method == "weighted":
+            scores = [r["score"] for r in results]
+            low, high = min(scores), max(scores)
+        for rank, r in enumerate(results, 1):
+            if method == "rrf":
+                score = 1.0 / (rank_constant + rank)
+            else:
+                normalized = (r["score"] - low) / (high - low) if high > low else 1.0
+                score = weights.get(name, 1.0) * normalized
+            entry = fused.setdefault(r["id"], {**r, "score": 0.0})  # source, start, end などのフィールドも引き継ぐ
+            entry["score"] += score
+
+    # 同点の場合はIDの順で並べて結果を安定させる
+    return sorted(fused.values(), key=lambda d: (-d["score"], d["id"]))[:top_k]
@@ -0,0 +1,236 @@
+import asyncio
+import codecs
+from collections import deque
+
+from chunk import chunking_stream, make_chunk_id, make_document_id, sentence_chunking_stream
+from embedding import count_tokens, embed_texts
+from executors import run_ingest
+from metrics import INGEST_CHUNKS, INGEST_IN_FLIGHT, stage
+from vector_store import store
+
+# ストリーミング登録の設定
+READ_BLOCK_SIZE = 1024 * 1024  # アップロードファイルを読み込む単位(バイト)
+INGEST_BATCH_SIZE = 1000  # 埋め込み・書き込みをまとめて行うチャンク数
+INGEST_QUEUE_SIZE = 4  # ステージ間のキューに溜めておけるバッチ数の上限
+# 同時に書き込み中にできるバッチ数。Elasticsearchでは1バッチが BULK_CHUNK_SIZE 件ずつのリクエストに分かれ、
+# 全体で BULK_CONCURRENCY 個まで同時に送信する (1000件 × 2 / 500件 = 4 で上限まで使う)
+INGEST_WRITE_CONCURRENCY = 2
+# チャンク内容以外で、登録し直すと変わりうるフィールド (内容が同じ登録済みのチャンクはこれだけを更新する)
+CHUNK_LOCATION_FIELDS = ["doc_id", "start", "end"]
+
+# チャンク分割の方式
+## sentence: 文末(。！？と改行)で区切り、埋め込みモデルのトークナイザーで数えたトークン数の上限まで文を詰める (既定)
+## fixed: CHUNK_SIZE 文字ごとに区切る (文や単語の途中でも区切る)
+## 方式や設定を変えるとドキュメントIDが変わり、登録し直すと変更前のチャンク (新しい分割にないもの) は削除される
+CHUNKERS = ("sentence", "fixed")
+CHUNKER = "sentence"
+CHUNK_MAX_TOKENS = 128  # sentence: 1チャンクのトークン数の上限 (all-MiniLM-L6-v2 の最大入力長 256 以下)
+CHUNK_OVERLAP_SENTENCES = 1  # sentence: 前のチャンクと重複させる文の数
+CHUNK_SIZE = 50  # fixed: 1チャンクの文字数
+CHUNK_OVERLAP = 10  # fixed: チャンク間で重複させる文字数
+
+
+def iter_text_blocks(file, block_size: int = READ_BLOCK_SIZE):
+    """
+    ファイルをブロック単位で読み込み、文字列として順に返す
+    マルチバイト文字がブロックの境界で分断されても、インクリメンタルデコーダが次のブロックと合わせて復元する
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    while True:
+        data = file.read(block_size)
+        if not data:
+            break
+        text = decoder.decode(data)
+        if text:
+            yield text
+    tail = decoder.decode(b"", final=True)  # 不完全なバイト列が残っていればここでエラーになる
+    if tail:
+        yield tail
+
+
+def chunking_signature(chunker: str = CHUNKER) -> str:
+    """チャンク分割の方式と設定を表す文字列 (ドキュメントIDに含め、設定が変わったら登録し直す)"""
+    if chunker == "sentence":
+        return f"sentence:{CHUNK_MAX_TOKENS}:{CHUNK_OVERLAP_SENTENCES}"
+    return f"{chunker}:{CHUNK_SIZE}:{CHUNK_OVERLAP}"
+
+
+def document_id(uploaded_file) -> str:
+    """アップロードされたファイルの内容のハッシュ (uploaded_file.sha256) と現在のチャンク分割の設定から作るドキュメントID"""
+    return make_document_id(uploaded_file.sha256, chunking_signature())
+
+
+def iter_chunks(blocks, chunker: str = CHUNKER, with_offsets: bool = False):
+    """
+    テキストのブロックのイテラブルを、指定した方式でチャンク分割するジェネレータ
+    with_offsets=True の場合は (チャンク, 開始位置, 終了位置) を生成する
+    """
+    if chunker == "sentence":
+        return sentence_chunking_stream(
+            blocks, max_tokens=CHUNK_MAX_TOKENS, overlap=CHUNK_OVERLAP_SENTENCES,
+            count_tokens=count_tokens, with_offsets=with_offsets,
+        )
+    if chunker == "fixed":
+        return chunking_stream(blocks, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP, with_offsets=with_offsets)
+    raise ValueError(f"未対応のチャンク分割の方式です: {chunker} (指定できる方式: {', '.join(CHUNKERS)})")
+
+
+def iter_chunk_batches(uploaded_files, batch_size: int = INGEST_BATCH_SIZE):
+    """
+    アップロードされたファイルを順にチャンク分割し、batch_size 件ずつのチャンク情報のリストを返す
+    チャンク情報は元ドキュメント名 (source)、ドキュメントID (doc_id)、ドキュメント内の文字の位置 (start, end) を持つ
+    同じバッチ内で重複するチャンクは1件にまとめる
+    """
+    batch = {}
+    for uploaded_file in uploaded_files:
+        source = uploaded_file.filename
+        doc_id = document_id(uploaded_file)
+        blocks = iter_text_blocks(uploaded_file.file)
+        for chunk, start, end in iter_chunks(blocks, with_offsets=True):
+            chunk_id = make_chunk_id(source, chunk)
+            batch[chunk_id] = {"id": chunk_id, "source": source, "doc_id": doc_id, "content": chunk, "start": start, "end": end}
+            if len(batch) >= batch_size:
+                yield list(batch.values())
+                batch = {}
+    if batch:
+        yield list(batch.values())
+
+
+async def ingest_documents(
+    index_name: str,
+    uploaded_files,
+    batch_size: int = INGEST_BATCH_SIZE,
+    queue_size: int = INGEST_QUEUE_SIZE,
+    skip_batches: int = 0,
+    on_batch=None,
+) -> dict:
+    """
+    チャンク分割 → 埋め込み → 書き込みの各ステージを上限付きのキューでつなぎ、並行して実行する
+    メモリ上に保持するのは高々 queue_size 程度のバッチのみで、処理時間は各ステージの最大値に近づく
+    内容が同じチャンクが登録済みなら埋め込みを再利用し、ドキュメントID・位置 (CHUNK_LOCATION_FIELDS) だけを更新する
+    全てのバッチを書き込んだ後、同じ名前で登録済みの以前の版 (ドキュメントIDが異なるチャンク) を削除する
+    uploaded_files: filename, file, sha256 (ファイルの内容のハッシュ) を持つオブジェクトのリスト
+    skip_batches: 先頭から省略するバッチ数 (前回の実行で書き込みまで終わったバッチ。チャンク分割の結果は毎回同じになる)
+    on_batch: バッチの書き込みが終わるたびに、バッチの番号の順に await on_batch(番号, バッチの結果) で呼び出す
+    戻り値: {"chunks": 処理したチャンク数, "success": 登録件数, "skipped": 登録済みで省略した件数,
+            "deleted": 削除した以前の版のチャンク数, "errors": [...]}
+    """
+    embed_queue = asyncio.Queue(maxsize=queue_size)
+    write_queue = asyncio.Queue(maxsize=queue_size)
+    result = {"chunks": 0, "success": 0, "skipped": 0, "deleted": 0, "errors": []}
+    failed_sources = set()  # 書き込みに失敗したチャンクがあるドキュメント名
+
+    async def chunk_stage():
+        batches = iter_chunk_batches(uploaded_files, batch_size)
+        batch_no = 0
+        while True:
+            # ファイルの読み込みとチャンク分割は登録用のスレッド (ingest_executor) で1バッチずつ進める
+            with stage("index_chunk"):
+                batch = await run_ingest(next, batches, None)
+            if batch is None:
+                break
+            if batch_no >= skip_batches:
+                await embed_queue.put((batch_no, batch))
+            batch_no += 1
+        await embed_queue.put(None)
+
+    async def embed_stage():
+        # element_type: byte のインデックスには量子化した埋め込みを登録する
+        quantize = await store.vector_type(index_name) == "byte"
+        while (item := await embed_queue.get()) is not None:
+            batch_no, batch = item
+            # 登録済みのチャンクは埋め込み・書き込みを省略する
+            # 以前の版から変わっていないチャンクはドキュメントID・位置だけを更新し、以前の版の削除で消されないようにする
+            with stage("index_dedupe"):
+                known = await store.existing_documents(index_name, [doc["id"] for doc in batch], CHUNK_LOCATION_FIELDS)
+            INGEST_CHUNKS.labels("skipped").inc(len(known))
+            stats = {"chunks": len(batch), "success": 0, "skipped": len(known), "errors": []}
+            new_docs = [doc for doc in batch if doc["id"] not in known]
+            moved_docs = [
+                doc for doc in batch
+                if doc["id"] in known and any(known[doc["id"]].get(key) != doc[key] for key in CHUNK_LOCATION_FIELDS)
+            ]
+            if not new_docs:
+                # 書き込むものがなくても、番号の順に完了を伝えるため書き込みステージに渡す
+                await write_queue.put((batch_no, stats, new_docs, moved_docs))
+                continue
+            # 登録時の大量のチャンクでクエリ用のキャッシュを押し流さないようにキャッシュを使わない
+            # 埋め込みは登録用のスレッドで計算し、クエリ側のスレッドとイベントループを占有しない
+            with stage("index_embed"):
+                embeddings = await run_ingest(embed_texts, [doc["content"] for doc in new_docs], use_cache=False, quantize=quantize)
+            for doc, emb in zip(new_docs, embeddings):
+                doc["embedding"] = emb
+            await write_queue.put((batch_no, stats, new_docs, moved_docs))
+        await write_queue.put(None)
+
+    async def write_batch(batch_no: int, stats: dict, docs: list, moved_docs: list) -> tuple:
+        failed_ids = set()
+        if docs:
+            with stage("index_write"):
+                written = await store.bulk_add(index_name, docs)
+            stats["success"] = written["success"]
+            stats["errors"] = written["errors"]
+            INGEST_CHUNKS.labels("indexed").inc(written["success"])
+            failed_ids.update(error["id"] for error in written["errors"])
+        if moved_docs:
+            with stage("index_write"):
+                updated = await store.update_documents(
+                    index_name, [{"id": doc["id"], **{key: doc[key] for key in CHUNK_LOCATION_FIELDS}} for doc in moved_docs]
+                )
+            # 更新できなかったチャンクは以前の版のドキュメントIDのままで、以前の版と一緒に削除されてしまう
+            stats["errors"] = stats["errors"] + updated["errors"]
+            failed_ids.update(error["id"] for error in updated["errors"])
+        if failed_ids:
+            INGEST_CHUNKS.labels("failed").inc(len(failed_ids))
+            failed_sources.update(doc["source"] for doc in docs + moved_docs if doc["id"] in failed_ids)
+        return batch_no, stats
+
+    async def finish(task: asyncio.Task):
+        batch_no, stats = await task
+        for key in ("chunks", "success", "skipped"):
+            result[key] += stats[key]
+        result["errors"].extend(stats["errors"])
+        if on_batch is not None:
+            await on_batch(batch_no, stats)
+
+    async def write_stage():
+        # 最大 INGEST_WRITE_CONCURRENCY 個のバッチを並行して書き込み、完了は番号の順に記録する
+        # (チェックポイントは「ここまでのバッチは全て書き込み済み」を表すため)
+        in_flight = deque()
+        try:
+            while (item := await write_queue.get()) is not None:
+                in_flight.append(asyncio.create_task(write_batch(*item)))
+                if len(in_flight) >= INGEST_WRITE_CONCURRENCY:
+                    await finish(in_flight.popleft())
+            while in_flight:
+                await finish(in_flight.popleft())
+        finally:
+            for task in in_flight:
+                task.cancel()
+            await asyncio.gather(*in_flight, return_exceptions=True)
+
+    tasks = [asyncio.create_task(run()) for run in (chunk_stage, embed_stage, write_stage)]
+    INGEST_IN_FLIGHT.inc()
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # いずれかのステージが失敗したら残りのステージも止める
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        INGEST_IN_FLIGHT.dec()
+
+    # 同じ名前のファイルが複数ある場合は後のものを残す
+    # 書き込みに失敗したチャンクがあるドキュメントは、新しい版が揃っていないため以前の版を残す
+    documents = {uploaded_file.filename: document_id(uploaded_file) for uploaded_file in uploaded_files}
+    with stage("index_prune"):
+        for source, doc_id in documents.items():
+            if source in failed_sources:
+                print(f"'{source}' は書き込みに失敗したチャンクがあるため、以前の版を削除しません。")
+                continue
+            deleted = await store.delete_stale(index_name, source, doc_id)
+            INGEST_CHUNKS.labels("deleted").inc(deleted)
+            result["deleted"] += deleted
+    return result
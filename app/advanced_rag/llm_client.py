@@ -1,26 +1,155 @@
-import requests
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
+
+import httpx
 from fastapi import HTTPException
 
-def ask_llm(prompt: str) -> str:
-    try:
-        url = "http://localhost:11434/api/generate"  # OllamaのAPIエンドポイント
-        payload = {
-            "model": "llama3",
-            "prompt": prompt,
-            "stream": False 
-        }
+from metrics import LLM_IN_FLIGHT, LLM_WAITING, record_backend_error
 
-        resp = requests.post(url, json=payload)
+# Ollamaの設定
+OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://localhost:11434")  # OllamaのAPIエンドポイント (環境変数 OLLAMA_URL で変更できる)
+LLM_MODEL = "llama3"
+LLM_CONNECT_TIMEOUT = 5.0  # 接続タイムアウト(秒)
+LLM_READ_TIMEOUT = 300.0  # 応答待ちタイムアウト(秒)。生成が長い場合に備えて長めに取る
+# Ollamaに同時に生成させる最大数。超えた分はキューで待つ (環境変数 LLM_MAX_CONCURRENCY で変更できる。Ollama の OLLAMA_NUM_PARALLEL に合わせる)
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "2"))
+LLM_MAX_CONNECTIONS = 16  # コネクションプールの最大接続数
+LLM_MAX_KEEPALIVE = 8  # keep-aliveで保持しておく接続数
 
-        # HTTPエラーチェック
-        if resp.status_code != 200:
-            raise HTTPException(status_code=500, detail=f"Ollama API error: {resp.text}")
 
-        # JSONパース
-        data = resp.json()
+class OllamaClient:
+    """
+    アプリ全体で共有する非同期のOllamaクライアント
+    - keep-aliveのコネクションプールを使い回す
+    - セマフォで同時生成数を制限し、超えた要求はキューで順番を待つ
+    - キューの深さや処理件数を stats() で返す
+    """
+
+    def __init__(
+        self,
+        base_url: str = OLLAMA_URL,
+        model: str = LLM_MODEL,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        connect_timeout: float = LLM_CONNECT_TIMEOUT,
+        read_timeout: float = LLM_READ_TIMEOUT,
+    ):
+        self.base_url = base_url
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_KEEPALIVE)
+        self._client = None
+        self._semaphore = None
+        self.waiting = 0
+        self.max_waiting = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.errors = 0
 
-        # 応答テキスト取得
+    def _get_client(self) -> httpx.AsyncClient:
+        # イベントループ上で初めて使われたときに作成する
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=self.limits)
+        return self._client
+
+    @asynccontextmanager
+    async def _slot(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        LLM_WAITING.inc()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+            LLM_WAITING.dec()
+        self.in_flight += 1
+        LLM_IN_FLIGHT.inc()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            LLM_IN_FLIGHT.dec()
+            self._semaphore.release()
+
+    async def generate(self, prompt: str, stop: list = None, model: str = None) -> str:
+        """プロンプトを送り、生成されたテキスト全体を返す"""
+        payload = {"model": model or self.model, "prompt": prompt, "stream": False}
+        if stop:
+            payload["options"] = {"stop": stop}
+
+        async with self._slot():
+            try:
+                resp = await self._get_client().post("/api/generate", json=payload)
+                resp.raise_for_status()
+                data = resp.json()
+            except Exception:
+                self.errors += 1
+                record_backend_error("ollama", "generate")
+                raise
+            self.completed += 1
         return data.get("response", "")
 
+    async def stream(self, prompt: str, stop: list = None, model: str = None):
+        """
+        Ollamaのストリームモードで生成し、トークンを順に返す非同期ジェネレータ
+        途中で aclose() された場合(クライアントの切断など)は接続を閉じ、Ollama側の生成も打ち切られる
+        """
+        payload = {"model": model or self.model, "prompt": prompt, "stream": True}
+        if stop:
+            payload["options"] = {"stop": stop}
+
+        async with self._slot():
+            try:
+                async with self._get_client().stream("POST", "/api/generate", json=payload) as resp:
+                    if resp.status_code != 200:
+                        await resp.aread()
+                        resp.raise_for_status()
+                    # 1行に1つのJSONが届く
+                    async for line in resp.aiter_lines():
+                        if not line:
+                            continue
+                        data = json.loads(line)
+                        if "error" in data:
+                            raise RuntimeError(data["error"])
+                        if data.get("response"):
+                            yield data["response"]
+                        if data.get("done"):
+                            break
+            except Exception:
+                self.errors += 1
+                record_backend_error("ollama", "stream")
+                raise
+            self.completed += 1
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict:
+        return {
+            "waiting": self.waiting,
+            "max_waiting": self.max_waiting,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "completed": self.completed,
+            "errors": self.errors,
+        }
+
+
+# 全モジュールで共有するクライアント
+llm_client = OllamaClient()
+
+
+async def ask_llm(prompt: str) -> str:
+    try:
+        return await llm_client.generate(prompt)
+    except httpx.HTTPStatusError as e:
+        # HTTPエラーチェック
+        raise HTTPException(status_code=500, detail=f"Ollama API error: {e.response.text}")
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"LLM問い合わせ失敗: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"LLM問い合わせ失敗: {str(e)}")
@@ -0,0 +1,77 @@
+import threading
+import time
+
+
+class ModelRegistry:
+    """
+    モデルをプロセスごとに1回だけ読み込み、全モジュールで共有する
+    - モデルは初めて要求されたときに読み込む (同時に要求された場合も読み込みは1回だけ)
+    - warmup で起動時に読み込みと試しの推論を済ませておくと、初回のリクエストが読み込みを待たない
+    """
+
+    def __init__(self):
+        self._models = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._load_seconds = {}
+        self._warmup_seconds = {}
+        self._errors = {}
+
+    def get(self, name: str, loader, **kwargs):
+        """
+        name のモデルを返す。読み込まれていなければ loader(name, **kwargs) で読み込む
+        :param loader: SentenceTransformer や CrossEncoder などのモデルのクラス
+        """
+        model = self._models.get(name)
+        if model is not None:
+            return model
+        with self._lock:
+            lock = self._locks.setdefault(name, threading.Lock())
+        with lock:
+            if name not in self._models:
+                started = time.perf_counter()
+                self._models[name] = loader(name, **kwargs)
+                self._load_seconds[name] = time.perf_counter() - started
+                print(f"モデル '{name}' を読み込みました ({self._load_seconds[name]:.1f}秒)")
+        return self._models[name]
+
+    def warmup(self, name: str, loader, run, **kwargs) -> bool:
+        """
+        モデルを読み込み、run(model) で1回推論して初回の推論の準備を済ませる
+        失敗した場合はエラーを記録して False を返す (次に要求されたときに読み込みを再度試みる)
+        """
+        try:
+            model = self.get(name, loader, **kwargs)
+            started = time.perf_counter()
+            run(model)
+            self._warmup_seconds[name] = time.perf_counter() - started
+            self._errors.pop(name, None)
+            return True
+        except Exception as e:
+            self._errors[name] = str(e)
+            print(f"❌ モデル '{name}' のウォームアップ中にエラーが発生しました: {e}")
+            return False
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._models
+
+    def is_ready(self, name: str) -> bool:
+        """読み込みとウォームアップが終わっているか"""
+        return name in self._warmup_seconds
+
+    def stats(self) -> dict:
+        names = dict.fromkeys([*self._models, *self._errors])
+        return {
+            name: {
+                "loaded": name in self._models,
+                "ready": name in self._warmup_seconds,
+                "load_seconds": self._load_seconds.get(name),
+                "warmup_seconds": self._warmup_seconds.get(name),
+                "error": self._errors.get(name),
+            }
+            for name in names
+        }
+
+
+# プロセス全体で共有するモデルの一覧
+registry = ModelRegistry()
@@ -0,0 +1,139 @@
+import asyncio
+import time
+from typing import List
+
+from context import pack_context
+from embedding import embed_query, embed_texts
+from executors import run_cpu
+from metrics import stage
+from query_rewriter import rewrite_query
+from reranking import reranking
+from schemas import QueryRequest
+from vector_store import store
+
+
+async def retrieve(question: str, req: QueryRequest):
+    """
+    質問をベクトル化して類似チャンクを検索し、検索結果と検索ごとの処理時間(ミリ秒)を返す
+    retrieval_mode が hybrid の場合はBM25とkNNの検索を1回のmsearchで実行して統合する
+    """
+    with stage("embed"):
+        q_emb = await embed_query(question)  # 入力テキストをベクトル化
+    if req.retrieval_mode == "hybrid":
+        with stage("search"):
+            result = await store.search_hybrid(
+                req.index_name, question, q_emb, req.top_k,
+                fusion=req.fusion, num_candidates=req.num_candidates,
+            )
+        return result["docs"], result["timings"]
+
+    started = time.perf_counter()
+    with stage("search"):
+        docs = await store.search_vector(
+            req.index_name, q_emb, req.top_k, mode=req.search_mode, num_candidates=req.num_candidates
+        )  # 類似度を計算して取得
+    return docs, {"vector_ms": (time.perf_counter() - started) * 1000}
+
+
+async def timed_rewrite(question: str) -> str:
+    # 検索と並行して実行するクエリの書き換えの時間を記録する
+    with stage("rewrite"):
+        return await rewrite_query(question)
+
+
+async def rewrite_and_retrieve(req: QueryRequest) -> tuple:
+    """
+    クエリを書き換え、multi_query の場合は書き換えたクエリでも検索する
+    戻り値: (書き換えたクエリ, 書き換えたクエリの検索結果, 処理時間)。検索しなかった場合は空の検索結果と処理時間
+    """
+    rewritten_query = await timed_rewrite(req.question)
+    if not req.multi_query or not rewritten_query or rewritten_query == req.question:
+        return rewritten_query, [], {}
+    docs, timings = await retrieve(rewritten_query, req)
+    return rewritten_query, docs, timings
+
+
+async def rewrite_and_retrieve_batch(requests: List[QueryRequest]) -> list:
+    """
+    複数の質問のクエリを書き換え、書き換えたクエリを1回の embed_texts でベクトル化して1回の search_batch で検索する
+    requests は質問以外の検索条件が同じであること (/query/batch の各質問)
+    戻り値: 質問の順に、rewrite_and_retrieve と同じ形式のタプルまたは失敗した理由の例外
+    """
+    rewritten = await asyncio.gather(*(timed_rewrite(r.question) for r in requests), return_exceptions=True)
+    results = [query if isinstance(query, BaseException) else (query, [], {}) for query in rewritten]
+    targets = [
+        i for i, (r, query) in enumerate(zip(requests, rewritten))
+        if r.multi_query and isinstance(query, str) and query and query != r.question
+    ]
+    if not targets:
+        return results
+
+    req = requests[0]
+    queries = [rewritten[i] for i in targets]
+    try:
+        with stage("embed"):
+            embeddings = await run_cpu(embed_texts, queries)
+        with stage("search"):
+            searched = await store.search_batch(
+                req.index_name, queries, embeddings, req.top_k,
+                retrieval_mode=req.retrieval_mode, mode=req.search_mode, fusion=req.fusion, num_candidates=req.num_candidates,
+            )
+    except Exception as e:
+        print(f"書き換えたクエリのまとめた検索に失敗しました: {e}")
+        searched = [{"docs": [], "timings": None, "error": f"検索に失敗しました: {e}"} for _ in targets]
+    for i, result in zip(targets, searched):
+        if result["error"] is not None:
+            results[i] = RuntimeError(result["error"])
+        else:
+            results[i] = (rewritten[i], result["docs"], result["timings"])
+    return results
+
+
+def merge_results(*result_lists: List[dict]) -> List[dict]:
+    """
+    複数の検索結果をチャンクIDで重複除去して統合し、スコアの高い順に並べる
+    同じチャンクが複数の結果に含まれる場合は高い方のスコアを採用する
+    """
+    merged = {}
+    for results in result_lists:
+        for doc in results:
+            key = doc.get("id") or doc["content"]
+            if key not in merged or doc["score"] > merged[key]["score"]:
+                merged[key] = doc
+    return sorted(merged.values(), key=lambda d: d["score"], reverse=True)
+
+
+async def prepare_prompt(req: QueryRequest, retrieved: tuple = None, rewritten=None):
+    """
+    検索・再評価・クエリの書き換えを行い、検索結果、回答生成用のプロンプト、検索ごとの処理時間を返す
+    互いに依存しない段階は並行して実行する
+    - クエリの書き換え(LLM)と書き換えたクエリの検索は、元のクエリのベクトル化・検索と同時に開始する
+    - 元のクエリの検索結果の再評価は、書き換え・書き換えたクエリの検索と同時に進める
+    - multi_query の場合は、書き換えたクエリの検索結果のうち元の結果にない候補だけを追加で再評価して統合する
+      (同じ質問に対する同じ方式の再評価のスコアは比較できるため、まとめて再評価した場合と同じ順に並ぶ)
+    retrieved: 元のクエリの (検索結果, 処理時間)。/query/batch でまとめて検索した場合に渡し、検索を省略する
+    rewritten: rewrite_and_retrieve の代わりに待つ awaitable。/query/batch で書き換えたクエリをまとめて検索した場合に渡す
+    """
+    rewrite_task = asyncio.ensure_future(rewritten if rewritten is not None else rewrite_and_retrieve(req))  # クエリを書き換え
+    try:
+        docs, timings = retrieved if retrieved is not None else await retrieve(req.question, req)
+        with stage("rerank"):
+            rerank_result = await reranking(req.question, docs, req.reranker)  # 計算結果を再評価
+        rewritten_query, rewritten_docs, rewritten_timings = await rewrite_task
+        seen = {doc.get("id") or doc["content"] for doc in docs}
+        new_docs = [doc for doc in rewritten_docs if (doc.get("id") or doc["content"]) not in seen]
+        if new_docs:
+            with stage("rerank"):
+                rerank_result = merge_results(rerank_result, await reranking(req.question, new_docs, req.reranker))
+        if rewritten_docs:
+            docs = merge_results(docs, rewritten_docs)
+        timings.update({f"rewritten_{name}": ms for name, ms in rewritten_timings.items()})
+    finally:
+        if not rewrite_task.done():
+            rewrite_task.cancel()
+
+    # 重なる・隣接するチャンクをつなげて重複を除き、トークン数の上限に収める
+    with stage("pack_context"):
+        context = await run_cpu(pack_context, rerank_result[:req.top_k])
+    prompt = f"以下の情報を参考に質問に答えてください:\n{context}\n質問: {rewritten_query}"  # マージ
+    return docs[:req.top_k], prompt, timings
@@ -1,8 +1,9 @@
-from langchain_ollama import OllamaLLM
+import asyncio
 from langchain import PromptTemplate
+from llm_client import llm_client
 
-# 1. LLMのセットアップ
-llm = OllamaLLM(model="llama3", stop=["<|eot_id|>"])
+# 1. LLMのセットアップ (全モジュールで共有するOllamaクライアントを使用)
+STOP_TOKENS = ["<|eot_id|>"]
 
 template = """
 <|begin_of_text|>
@@ -19,12 +20,12 @@ Rewritten query:
 
 prompt = PromptTemplate(input_variables=["user_query"], template=template)
 
-def rewrite_query(user_query: str) -> str:
+async def rewrite_query(user_query: str) -> str:
     formatted = prompt.format(user_query=user_query)
-    response = llm(formatted)
+    response = await llm_client.generate(formatted, stop=STOP_TOKENS)
     return response.strip()
 
 if __name__ == '__main__':    
     # 使用例
-    rw = rewrite_query("東京の首都を教えてください")
+    rw = asyncio.run(rewrite_query("東京の首都を教えてください"))
     print("Rewritten:", rw)
\ No newline at end of file
@@ -1,23 +1,148 @@
-from langchain_ollama import OllamaLLM
+import asyncio
 import json
+import re
 from typing import List
 
-# OllamaLLMの初期化
-llm = OllamaLLM(model="llama3", stop=["<|eot_id|>"])
+from sentence_transformers import CrossEncoder
 
-def reranking(query: str, candidates: List[dict], llm=llm) -> List[dict]:
+from executors import run_cpu
+from llm_client import OllamaClient, llm_client
+from model_registry import registry
+
+# LLMによる再評価の設定 (全モジュールで共有するOllamaクライアントを使用)
+STOP_TOKENS = ["<|eot_id|>"]
+
+# クロスエンコーダーによる再評価の設定
+CROSS_ENCODER_MODEL = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"  # 日本語を含む多言語対応のモデル
+RERANK_BATCH_SIZE = 32  # 1回の推論でまとめて評価するペア数
+RERANK_MAX_CHARS = 512  # 評価に使用する候補の最大文字数
+RERANK_MAX_LENGTH = 256  # クエリと候補を合わせた最大トークン数
+
+DEFAULT_RERANKER = "cross_encoder"
+
+
+def sort_candidates(candidates: List[dict], scores: List[float]) -> List[dict]:
     """
-    LLMを用いて候補のリストを再評価し、スコア順に並び替える
+    候補にスコアを付け替えてスコアの高い順に並べたリストを返す
+    元の候補は変更せず、同点の場合は元の順序を保つ
+    """
+    order = sorted(range(len(candidates)), key=lambda i: (-scores[i], i))
+    return [{**candidates[i], "score": float(scores[i])} for i in order]
+
+
+class Reranker:
+    """再評価の共通インターフェース。候補をクエリとの関連度の高い順に並べた新しいリストを返す"""
+
+    name = ""
+
+    async def rerank(self, query: str, candidates: List[dict]) -> List[dict]:
+        raise NotImplementedError
+
+    def warmup(self) -> bool:
+        """使用するモデルを事前に読み込む (読み込むモデルがない場合は何もしない)"""
+        return True
+
+    def is_ready(self) -> bool:
+        return True
+
+
+class CrossEncoderReranker(Reranker):
+    """
+    クロスエンコーダーでクエリと候補のペアをCPU上でまとめて評価する
+    LLMによる再評価より高速で、結果は常にスコア順に並ぶ
     """
-    if not candidates:
-        print("候補が空です")
-        return []
 
-    # 候補を文字列化
-    candidate_texts = "\n".join([f"{i+1}. {c['content']}" for i, c in enumerate(candidates)])
+    name = "cross_encoder"
+
+    def __init__(
+        self,
+        model_name: str = CROSS_ENCODER_MODEL,
+        batch_size: int = RERANK_BATCH_SIZE,
+        max_chars: int = RERANK_MAX_CHARS,
+        max_length: int = RERANK_MAX_LENGTH,
+    ):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_chars = max_chars
+        self.max_length = max_length
+
+    @property
+    def model(self) -> CrossEncoder:
+        # 初めて使われたときに読み込み、プロセス内で共有する
+        return registry.get(self.model_name, CrossEncoder, max_length=self.max_length)
+
+    def warmup(self) -> bool:
+        return registry.warmup(
+            self.model_name, CrossEncoder,
+            lambda model: model.predict([("ウォームアップ", "ウォームアップ用の文です。")], show_progress_bar=False),
+            max_length=self.max_length,
+        )
+
+    def is_ready(self) -> bool:
+        return registry.is_ready(self.model_name)
+
+    def score(self, query: str, candidates: List[dict]) -> List[float]:
+        pairs = [(query, c["content"][:self.max_chars]) for c in candidates]
+        return self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False).tolist()
+
+    async def rerank(self, query: str, candidates: List[dict]) -> List[dict]:
+        if not candidates:
+            return []
+        scores = await run_cpu(self.score, query, candidates)
+        return sort_candidates(candidates, scores)
+
+
+class LLMReranker(Reranker):
+    """
+    LLMを用いて候補のリストを再評価し、スコア順に並び替える
+    LLMが評価しなかった候補は評価済みの候補の後ろに元の順序で並べる
+    """
 
-    # プロンプト生成
-    prompt = f"""
+    name = "llm"
+
+    def __init__(self, client: OllamaClient = llm_client):
+        self.client = client
+
+    @staticmethod
+    def parse_scores(response: str, size: int) -> dict:
+        """LLMの応答から {候補の位置(0始まり): スコア} を取り出す"""
+        try:
+            items = json.loads(response)
+        except json.JSONDecodeError:
+            # 前後に説明文が付いている場合はJSON配列の部分だけを取り出す
+            match = re.search(r"\[.*\]", response, re.DOTALL)
+            if not match:
+                return {}
+            try:
+                items = json.loads(match.group(0))
+            except json.JSONDecodeError:
+                return {}
+        if not isinstance(items, list):
+            return {}
+
+        scores = {}
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            try:
+                idx = int(item.get("index")) - 1  # プロンプトの番号は1始まり
+                score = float(item.get("score"))
+            except (TypeError, ValueError):
+                continue
+            if 0 <= idx < size and idx not in scores:
+                scores[idx] = score
+        return scores
+
+    async def rerank(self, query: str, candidates: List[dict]) -> List[dict]:
+        if not candidates:
+            print("候補が空です")
+            return []
+
+        # 候補を文字列化
+        candidate_texts = "\n".join([f"{i+1}. {c['content']}" for i, c in enumerate(candidates)])
+
+        # プロンプト生成
+        prompt = f"""
 以下の検索結果候補を、ユーザーの検索クエリにどれだけ関連しているかを評価し、最も関連性の高い順に並び替えてください。
 
 検索クエリ:
@@ -26,36 +151,39 @@ def reranking(query: str, candidates: List[dict], llm=llm) -> List[dict]:
 候補:
 {candidate_texts}
 
-出力はJSON形式で "index" と "score" をつけてください。
+出力は候補の番号を "index"、関連度を "score" とした要素のJSON配列のみで返してください。
 """
 
-    # LLMに問い合わせ
-    response = llm.invoke(prompt)
+        # LLMに問い合わせ
+        response = await self.client.generate(prompt, stop=STOP_TOKENS)
+
+        scores = self.parse_scores(response or "", len(candidates))
+        if not scores:
+            print("LLM応答から評価を読み取れません。元の候補を返します。")
+            return [dict(c) for c in candidates]
+
+        # LLMの評価順に候補を並べ替え、評価されなかった候補は元の順序で後ろに並べる
+        scored = sorted(scores, key=lambda i: (-scores[i], i))
+        reranked = [{**candidates[i], "score": scores[i]} for i in scored]
+        reranked.extend(dict(c) for i, c in enumerate(candidates) if i not in scores)
+        return reranked
 
-    # デバッグ用: 生応答を表示
-    print("LLM生応答:", response)
 
-    if not response or response.strip() == "":
-        print("LLMから応答がありません。元の候補を返します。")
-        return candidates
+RERANKERS = {reranker.name: reranker for reranker in (CrossEncoderReranker(), LLMReranker())}
 
-    # JSONパースを例外処理
-    try:
-        reranked_indices = json.loads(response)
-    except json.JSONDecodeError:
-        print("LLM応答がJSON形式ではありません。元の候補を返します。")
-        return candidates
 
-    # LLMの評価順に候補を並べ替え
-    reranked = []
-    for item in reranked_indices:
-        idx = item.get("index")
-        score = item.get("score")
-        if idx is not None and 0 <= idx < len(candidates):
-            candidates[idx]["score"] = score
-            reranked.append(candidates[idx])
+def get_reranker(name: str = DEFAULT_RERANKER) -> Reranker:
+    if name not in RERANKERS:
+        raise ValueError(f"reranker must be one of {list(RERANKERS)}")
+    return RERANKERS[name]
 
-    return reranked
+
+async def reranking(query: str, candidates: List[dict], method: str = DEFAULT_RERANKER) -> List[dict]:
+    """
+    指定した方式で候補を再評価し、関連度の高い順に並べた新しいリストを返す
+    method: "cross_encoder" (既定) または "llm"
+    """
+    return await get_reranker(method).rerank(query, candidates)
 
 
 if __name__ == '__main__':
@@ -66,9 +194,10 @@ if __name__ == '__main__':
     embed_data = embed_texts(input_data)
     
     # Elasticsearchで類似検索
-    result = search_similar(embed_data[0], top_k=5, index_name="test")  # index_nameやtop_kは適宜変更
+    result = asyncio.run(search_similar(embed_data[0], top_k=5, index_name="test"))  # index_nameやtop_kは適宜変更
     print("検索結果:", result)
 
-    # LLMで再評価
-    reranked_result = reranking(input_data[0], result, llm)
-    print("再評価後の結果:", reranked_result)
\ No newline at end of file
+    # クロスエンコーダーとLLMで再評価
+    for method in RERANKERS:
+        reranked_result = asyncio.run(reranking(input_data[0], result, method))
+        print(f"再評価後の結果({method}):", reranked_result)
@@ -1,9 +1,10 @@
+import asyncio
 from typing import List, Dict
 from llm_client import ask_llm
 from elasticsearch_client import search_similar
 from embedding import embed_texts
 
-def evaluate_answer(query: str, answer: str, docs: List[Dict]) -> float:
+async def evaluate_answer(query: str, answer: str, docs: List[Dict]) -> float:
     """
     回答の精度を LLM に評価させ、0〜1 のスコアで返す
     """
@@ -19,7 +20,7 @@ def evaluate_answer(query: str, answer: str, docs: List[Dict]) -> float:
 回答:
 {answer}
 """
-    score_str = ask_llm(prompt)
+    score_str = await ask_llm(prompt)
     try:
         return float(score_str.strip())
     except:
@@ -28,9 +29,9 @@ def evaluate_answer(query: str, answer: str, docs: List[Dict]) -> float:
 if __name__ == '__main__':
     query = ["総理大臣の名前は？"]
     emb_result = embed_texts(query)
-    docs = search_similar(emb_result[0], 3, "test")
+    docs = asyncio.run(search_similar(emb_result[0], 3, "test"))
     context = "\n".join([d["content"]] for d in docs)  # マージ
     prompt = f"以下の情報を参考に質問に答えてください:\n{context}\n質問: {query[0]}"  # マージ
-    answer = ask_llm(prompt) 
-    # score = evaluate_answer(query[0], answer, docs)
+    answer = asyncio.run(ask_llm(prompt))
+    # score = asyncio.run(evaluate_answer(query[0], answer, docs))
     # print("評価スコア:", score)
\ No newline at end of file
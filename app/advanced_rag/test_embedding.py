@@ -0,0 +1,54 @@
+import asyncio
+import threading
+import unittest
+
+import numpy as np
+
+from embedding import EmbeddingBatcher
+
+
+class BlockingModel:
+    """最初の encode を release まで止める、テキストの長さを返すだけのモデル"""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def encode(self, texts):
+        self.started.set()
+        self.release.wait(5)
+        return np.array([[float(len(text))] for text in texts])
+
+
+class EmbeddingBatcherTest(unittest.TestCase):
+    def test_cancelled_request_does_not_stop_worker(self):
+        model = BlockingModel()
+        batcher = EmbeddingBatcher(lambda: model, max_wait_ms=0)
+
+        async def scenario():
+            first = asyncio.ensure_future(batcher.embed("a"))
+            await asyncio.get_running_loop().run_in_executor(None, model.started.wait, 5)
+            # encode 中にキューに入った要求をキャンセルする
+            cancelled = asyncio.ensure_future(batcher.embed("bb"))
+            await asyncio.sleep(0.01)
+            cancelled.cancel()
+            await asyncio.sleep(0.01)
+            model.release.set()
+            self.assertEqual(await asyncio.wait_for(first, 5), [1.0])
+            self.assertEqual(await asyncio.wait_for(batcher.embed("ccc"), 5), [3.0])
+
+        asyncio.run(scenario())
+        self.assertTrue(batcher._worker.is_alive())
+
+    def test_worker_is_restarted(self):
+        model = BlockingModel()
+        model.release.set()
+        batcher = EmbeddingBatcher(lambda: model)
+        batcher._worker = threading.Thread(target=lambda: None)
+        batcher._worker.start()
+        batcher._worker.join()
+        self.assertEqual(asyncio.run(asyncio.wait_for(batcher.embed("dd"), 5)), [2.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,699 @@
+import json
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter
+
+import numpy as np
+
+from executors import run_cpu
+from fusion import HYBRID_WINDOW_SIZE, fuse_results
+from metrics import record_backend_error
+
+# 検索バックエンドの設定
+VECTOR_STORE_BACKEND = "elasticsearch"  # "elasticsearch" または "local"
+LOCAL_STORE_DIR = "vector_store_data"  # local バックエンドのデータを保存するディレクトリ
+LOCAL_STORE_DTYPE = "float32"  # local バックエンドで埋め込みを保存する型 ("float32" または "float16")
+LOCAL_STORE_COMPACT_RATIO = 0.3  # 削除した行がこの割合以上あれば、インデックスを開くときにファイルを詰め直す
+EMBEDDING_DIM = 384  # all-MiniLM-L6-v2 の次元数
+SEARCH_BLOCK_ROWS = 65536  # 類似度をまとめて計算する行数 (一時メモリの上限)
+EXPORT_PAGE_SIZE = 1000  # fetch_page で1回に取得するドキュメント数
+
+# local バックエンドのインデックス名に使えない文字 (Elasticsearchのインデックス名の規則と同じ)
+INDEX_NAME_INVALID_CHARS = set('\\/*?"<>|, #:\0')
+
+# BM25のパラメータ
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+class VectorStore:
+    """
+    チャンクの保存と検索を行うバックエンドの共通インターフェース
+    documents は {"id": ..., "content": ..., "embedding": ..., その他のフィールド} 形式の辞書
+    検索結果は [{"id": ..., "content": ..., "score": ...}, ...] 形式のリスト
+    メソッドはすべて非同期で、イベントループをブロックしない
+    """
+
+    async def index_exists(self, index_name: str) -> bool:
+        raise NotImplementedError
+
+    async def create_index(self, index_name: str, vector_type: str = "float"):
+        """vector_type: 埋め込みの保存形式 ("float", "int8_hnsw", "byte")"""
+        raise NotImplementedError
+
+    async def vector_type(self, index_name: str) -> str:
+        """インデックスの埋め込みの保存形式。"byte" の場合は量子化した埋め込みを登録する"""
+        raise NotImplementedError
+
+    async def existing_documents(self, index_name: str, ids: list, fields: list) -> dict:
+        """ids のうち登録済みのものを {ID: {フィールド: 値, ...}} で返す (fields のフィールドのみ)"""
+        raise NotImplementedError
+
+    async def bulk_add(self, index_name: str, documents) -> dict:
+        """戻り値: {"success": 成功件数, "errors": [{"id": ..., "status": ..., "error": ...}, ...]}"""
+        raise NotImplementedError
+
+    async def update_documents(self, index_name: str, documents) -> dict:
+        """
+        登録済みのドキュメントの、documents に含まれるフィールドだけを更新する (埋め込みはそのまま)
+        戻り値は bulk_add と同じ形式
+        """
+        raise NotImplementedError
+
+    async def delete_stale(self, index_name: str, source: str, doc_id: str) -> int:
+        """source のチャンクのうち doc_id が異なるもの (同じ名前で以前に登録した版) を削除し、削除件数を返す"""
+        raise NotImplementedError
+
+    async def search_vector(self, index_name: str, embedding: list, top_k: int, mode: str = "knn", num_candidates: int = 100) -> list:
+        raise NotImplementedError
+
+    async def search_text(self, index_name: str, query_text: str, top_k: int) -> list:
+        raise NotImplementedError
+
+    async def search_hybrid(
+        self, index_name: str, query_text: str, embedding: list, top_k: int,
+        fusion: str = "rrf", num_candidates: int = 100,
+    ) -> dict:
+        """戻り値: {"docs": 統合後の検索結果, "timings": 検索ごとの処理時間(ミリ秒)}"""
+        raise NotImplementedError
+
+    async def search_batch(
+        self, index_name: str, query_texts: list, embeddings: list, top_k: int,
+        retrieval_mode: str = "vector", mode: str = "knn", fusion: str = "rrf", num_candidates: int = 100,
+    ) -> list:
+        """
+        複数の質問をまとめて検索する (retrieval_mode: "vector" は search_vector、"hybrid" は search_hybrid と同じ検索)
+        戻り値: 質問の順に [{"docs": 検索結果, "timings": 処理時間(ミリ秒), "error": 失敗した場合の理由 (成功した場合は None)}, ...]
+        """
+        raise NotImplementedError
+
+    async def count(self, index_name: str) -> int:
+        raise NotImplementedError
+
+    async def fetch_page(self, index_name: str, cursor: str = None, size: int = EXPORT_PAGE_SIZE) -> tuple:
+        """
+        cursor の位置から size 件のチャンクを返す (cursor が None なら先頭から)
+        戻り値: ([{"id": ..., "content": ...}, ...], 次のページのカーソル (最後のページなら None))
+        カーソルが不正または期限切れの場合は ValueError
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        """接続などのリソースを解放する (アプリの終了時に呼ぶ)"""
+
+
+class ElasticsearchStore(VectorStore):
+    """elasticsearch_client の関数を使うバックエンド"""
+
+    def __init__(self):
+        # local バックエンドだけを使う場合に elasticsearch パッケージを必要としないよう、ここで読み込む
+        import elasticsearch_client
+        self.client = elasticsearch_client
+
+    async def _call(self, operation: str, func, *args, **kwargs):
+        # Elasticsearchの呼び出しが失敗した数を操作ごとに記録する (カーソルの誤りなどの ValueError は除く)
+        try:
+            return await func(*args, **kwargs)
+        except ValueError:
+            raise
+        except Exception:
+            record_backend_error("elasticsearch", operation)
+            raise
+
+    async def index_exists(self, index_name: str) -> bool:
+        return await self._call("index_exists", self.client.index_exists, index_name)
+
+    async def create_index(self, index_name: str, vector_type: str = "float"):
+        await self._call("create_index", self.client.create_index, index_name, vector_type=vector_type)
+
+    async def vector_type(self, index_name: str) -> str:
+        return await self._call("get_mapping", self.client.get_vector_type, index_name)
+
+    async def existing_documents(self, index_name: str, ids: list, fields: list) -> dict:
+        return await self._call("mget", self.client.existing_documents, index_name, ids, fields)
+
+    async def bulk_add(self, index_name: str, documents) -> dict:
+        result = await self._call("bulk", self.client.bulk_add_documents, index_name, documents)
+        if result["errors"]:
+            # ドキュメント単位の失敗は例外にならないため件数を加える
+            record_backend_error("elasticsearch", "bulk_item", len(result["errors"]))
+        return result
+
+    async def update_documents(self, index_name: str, documents) -> dict:
+        result = await self._call("bulk", self.client.bulk_update_documents, index_name, documents)
+        if result["errors"]:
+            record_backend_error("elasticsearch", "bulk_item", len(result["errors"]))
+        return result
+
+    async def delete_stale(self, index_name: str, source: str, doc_id: str) -> int:
+        return await self._call("delete_by_query", self.client.delete_stale_chunks, index_name, source, doc_id)
+
+    async def search_vector(self, index_name, embedding, top_k, mode="knn", num_candidates=100):
+        return await self._call(
+            "search", self.client.search_similar, embedding, top_k, index_name, mode=mode, num_candidates=num_candidates
+        )
+
+    async def search_text(self, index_name, query_text, top_k):
+        return await self._call("search", self.client.search_bm25, query_text, top_k, index_name)
+
+    async def search_hybrid(self, index_name, query_text, embedding, top_k, fusion="rrf", num_candidates=100):
+        return await self._call(
+            "msearch", self.client.search_hybrid,
+            query_text, embedding, top_k, index_name, fusion=fusion, num_candidates=num_candidates,
+        )
+
+    async def search_batch(
+        self, index_name, query_texts, embeddings, top_k,
+        retrieval_mode="vector", mode="knn", fusion="rrf", num_candidates=100,
+    ):
+        # 全ての質問の検索を1回の _msearch で実行する
+        return await self._call(
+            "msearch", self.client.search_batch, query_texts, embeddings, top_k, index_name,
+            retrieval_mode=retrieval_mode, mode=mode, fusion=fusion, num_candidates=num_candidates,
+        )
+
+    async def count(self, index_name: str) -> int:
+        return (await self._call("count", self.client.es.count, index=index_name))["count"]
+
+    async def fetch_page(self, index_name: str, cursor: str = None, size: int = EXPORT_PAGE_SIZE) -> tuple:
+        return await self._call("export", self.client.export_page, index_name, cursor, size)
+
+    async def close(self):
+        await self.client.close()
+
+
+def _text_tokens(text: str) -> list:
+    """BM25用のトークン。分かち書きを使わずに、正規化したテキストの文字bigramを使う"""
+    normalized = re.sub(r"\s+", "", unicodedata.normalize("NFKC", text).lower())
+    if len(normalized) < 2:
+        return [normalized] if normalized else []
+    return [normalized[i:i + 2] for i in range(len(normalized) - 1)]
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """スコアの高い順に上位k件の位置を返す。全件をソートせず argpartition で絞り込む"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def validate_index_name(index_name: str):
+    """
+    local バックエンドのインデックス名を確認する (Elasticsearchと同じ規則)
+    インデックス名はディレクトリ名になるため、区切り文字や .. で LOCAL_STORE_DIR の外を指せないようにする
+    """
+    if (
+        not index_name
+        or index_name != index_name.lower()
+        or index_name.startswith((".", "-", "_", "+"))
+        or ".." in index_name
+        or any(c in INDEX_NAME_INVALID_CHARS for c in index_name)
+        or len(index_name.encode("utf-8")) > 255
+    ):
+        raise ValueError(
+            f"インデックス名が正しくありません: '{index_name}' "
+            "(小文字のみ。/ \\ * ? \" < > | , # : 空白 と .. は使えず、先頭に . - _ + は使えません)"
+        )
+
+
+class _LocalIndex:
+    """
+    1つのインデックスのデータ
+    - vectors.bin: 正規化した埋め込みを行方向に並べた連続した行列 (np.memmap でゼロコピーで読み込む)
+    - docs.jsonl: 各行のチャンク情報 (同じIDが複数ある場合は後の行が有効。_deleted の行は削除の記録)
+    - meta.json: 次元数・型・行数と、使用中のデータファイルの名前
+    削除した行は記録だけを追記して検索から除き、LOCAL_STORE_COMPACT_RATIO 以上溜まったら開くときに詰め直す
+    """
+
+    def __init__(self, path: str, dim: int, dtype: np.dtype):
+        self.path = path
+        self.meta_path = os.path.join(path, "meta.json")
+        self.rows = {}  # ID -> 行番号
+        self.docs = []  # 行番号 -> チャンク情報(埋め込みを除く)。削除した行は None
+        self.sources = {}  # ドキュメント名 -> 行番号の集合
+        self.dead = np.empty(0, dtype=np.int64)  # 削除した行番号
+        self._postings = None  # BM25用の転置インデックス: トークン -> [行番号のリスト, 出現回数のリスト, 配列に変換したもの]
+        self._lengths = None  # 行ごとのトークン数
+
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            self.dim = meta["dim"]
+            self.dtype = np.dtype(meta["dtype"])
+            self.version = meta.get("version", 0)
+            self._set_files(meta.get("vectors", "vectors.bin"), meta.get("docs", "docs.jsonl"))
+            self._load_docs()
+            self.dead = np.array([row for row, doc in enumerate(self.docs) if doc is None], dtype=np.int64)
+            if len(self.dead) and len(self.dead) >= len(self.docs) * LOCAL_STORE_COMPACT_RATIO:
+                self._compact()
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.dim = dim
+            self.dtype = dtype
+            self.version = 0
+            self._set_files("vectors.bin", "docs.jsonl")
+            open(self.vectors_path, "ab").close()
+            open(self.docs_path, "ab").close()
+            self._write_meta()
+        self.vectors = self._map()
+
+    def _load_docs(self):
+        """
+        docs.jsonl を読み込み、途中で停止した登録の書きかけの部分を取り除く
+        add は埋め込みを vectors.bin に書いてから docs.jsonl に追記するため、
+        - 埋め込みのない行を指す行(以前の形式で書きかけたバッチ)と途中で切れた最後の行以降は docs.jsonl から削除する
+        - docs.jsonl にない行の埋め込みは vectors.bin から削除する
+        """
+        row_bytes = self.dim * self.dtype.itemsize
+        vector_rows = os.path.getsize(self.vectors_path) // row_bytes
+        valid_bytes = 0
+        with open(self.docs_path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                doc = json.loads(line)
+                row = doc.pop("_row")
+                if row >= vector_rows:
+                    break
+                self._set_row(row, None if doc.get("_deleted") else doc)
+                valid_bytes += len(line)
+        if valid_bytes < os.path.getsize(self.docs_path):
+            os.truncate(self.docs_path, valid_bytes)
+            print(f"インデックス '{os.path.basename(self.path)}' の書き込み途中のチャンク情報を削除しました。")
+        if os.path.getsize(self.vectors_path) > len(self.docs) * row_bytes:
+            os.truncate(self.vectors_path, len(self.docs) * row_bytes)
+            print(f"インデックス '{os.path.basename(self.path)}' の書き込み途中の埋め込みを削除しました。")
+
+    def _set_files(self, vectors_name: str, docs_name: str):
+        self.vectors_name, self.docs_name = vectors_name, docs_name
+        self.vectors_path = os.path.join(self.path, vectors_name)
+        self.docs_path = os.path.join(self.path, docs_name)
+
+    def _set_row(self, row: int, doc: dict):
+        """行の内容を doc にする (None は削除)。ID・ドキュメント名から行への対応も更新する"""
+        old = self.docs[row] if row < len(self.docs) else None
+        if old is not None:
+            if self.rows.get(old["id"]) == row:
+                del self.rows[old["id"]]
+            self.sources.get(old.get("source"), set()).discard(row)
+        if row == len(self.docs):
+            self.docs.append(doc)
+        else:
+            self.docs[row] = doc
+        if doc is not None:
+            self.rows[doc["id"]] = row
+            self.sources.setdefault(doc.get("source"), set()).add(row)
+
+    def _write_meta(self):
+        # 書き込み途中で停止しても壊れないよう、一時ファイルに書いてから置き換える
+        meta = {
+            "dim": self.dim, "dtype": self.dtype.name, "count": len(self.docs), "version": self.version,
+            "vectors": self.vectors_name, "docs": self.docs_name,
+        }
+        with open(self.meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(self.meta_path + ".tmp", self.meta_path)
+
+    def _map(self) -> np.ndarray:
+        if not self.docs:
+            return np.empty((0, self.dim), dtype=self.dtype)
+        return np.memmap(self.vectors_path, dtype=self.dtype, mode="r", shape=(len(self.docs), self.dim))
+
+    def _compact(self):
+        """
+        削除していない行だけを新しい名前のファイルに書き出し、meta.json を置き換えてから古いファイルを消す
+        meta.json を置き換える前に停止した場合は古いファイルがそのまま使われる
+        """
+        live = [row for row, doc in enumerate(self.docs) if doc is not None]
+        vectors = self._map()
+        old_files = [self.vectors_path, self.docs_path]
+        self.version += 1
+        self._set_files(f"vectors.{self.version}.bin", f"docs.{self.version}.jsonl")
+        with open(self.vectors_path, "wb") as f:
+            for start in range(0, len(live), SEARCH_BLOCK_ROWS):
+                f.write(np.ascontiguousarray(vectors[live[start:start + SEARCH_BLOCK_ROWS]]).tobytes())
+        with open(self.docs_path, "w", encoding="utf-8") as f:
+            for new_row, row in enumerate(live):
+                f.write(json.dumps({**self.docs[row], "_row": new_row}, ensure_ascii=False) + "\n")
+        del vectors
+
+        docs = [self.docs[row] for row in live]
+        self.rows, self.docs, self.sources = {}, [], {}
+        for row, doc in enumerate(docs):
+            self._set_row(row, doc)
+        self.dead = np.empty(0, dtype=np.int64)
+        self._postings = None
+        self._write_meta()
+        for path in old_files:
+            os.remove(path)
+        print(f"インデックス '{os.path.basename(self.path)}' の削除した行を詰め直しました ({len(docs)} 行)。")
+
+    def add(self, documents: list) -> dict:
+        errors = []
+        valid = {}  # 同じIDが複数ある場合は後のものを登録する
+        for doc in documents:
+            vector = np.asarray(doc["embedding"], dtype=np.float32)
+            if vector.shape != (self.dim,):
+                errors.append({"id": doc["id"], "status": 400, "error": f"embedding must have {self.dim} dimensions"})
+                continue
+            norm = np.linalg.norm(vector)
+            valid[doc["id"]] = (doc, vector / norm if norm > 0 else vector)
+        valid = list(valid.values())
+
+        appended = []
+        updates = []
+        for doc, vector in valid:
+            info = {key: value for key, value in doc.items() if key != "embedding"}
+            row = self.rows.get(doc["id"])
+            if row is None:
+                appended.append((len(self.docs) + len(appended), info, vector))
+            else:
+                updates.append((row, info, vector))
+
+        # 途中で停止しても docs.jsonl が埋め込みのない行を指さないよう、埋め込みを先に書き込む
+        if appended:
+            with open(self.vectors_path, "ab") as f:
+                f.write(np.stack([v for _, _, v in appended]).astype(self.dtype).tobytes())
+        if updates:
+            writable = np.memmap(
+                self.vectors_path, dtype=self.dtype, mode="r+", shape=(len(self.docs) + len(appended), self.dim)
+            )
+            for row, _, vector in updates:
+                writable[row] = vector.astype(self.dtype)
+            writable.flush()
+            del writable
+        with open(self.docs_path, "a", encoding="utf-8") as docs_file:
+            for row, info, _ in appended + updates:
+                docs_file.write(json.dumps({**info, "_row": row}, ensure_ascii=False) + "\n")
+
+        changed = False  # 内容が変わった行があれば転置インデックスを作り直す
+        for row, info, _ in appended + updates:
+            old = self.docs[row] if row < len(self.docs) else None
+            changed = changed or (old is not None and old["content"] != info["content"])
+            self._set_row(row, info)
+
+        self._write_meta()
+        self.vectors = self._map()
+        if changed:
+            self._postings = None
+        elif self._postings is not None:
+            self._index_text([row for row, _, _ in appended])
+        return {"success": len(valid), "errors": errors}
+
+    def update(self, documents: list) -> dict:
+        """登録済みの行のフィールドを上書きする。埋め込みと本文は変えないため転置インデックスはそのまま使える"""
+        errors = []
+        updates = []
+        for doc in documents:
+            row = self.rows.get(doc["id"])
+            if row is None:
+                errors.append({"id": doc["id"], "status": 404, "error": "document missing"})
+                continue
+            updates.append((row, {**self.docs[row], **doc}))
+        with open(self.docs_path, "a", encoding="utf-8") as docs_file:
+            for row, info in updates:
+                docs_file.write(json.dumps({**info, "_row": row}, ensure_ascii=False) + "\n")
+        for row, info in updates:
+            self._set_row(row, info)
+        return {"success": len(updates), "errors": errors}
+
+    def delete_stale(self, source: str, doc_id: str) -> int:
+        rows = [row for row in self.sources.get(source, ()) if self.docs[row].get("doc_id") != doc_id]
+        if not rows:
+            return 0
+        with open(self.docs_path, "a", encoding="utf-8") as docs_file:
+            for row in rows:
+                docs_file.write(json.dumps({"id": self.docs[row]["id"], "_row": row, "_deleted": True}) + "\n")
+        for row in rows:
+            self._set_row(row, None)
+        self.dead = np.union1d(self.dead, np.array(rows, dtype=np.int64))
+        if self._postings is not None:
+            # 転置インデックスには残るが、検索では削除した行を除く (詰め直すときに作り直す)
+            self._lengths = self._lengths.copy()
+            self._lengths[rows] = 0
+        return len(rows)
+
+    def text_index(self, tokens) -> tuple:
+        """
+        BM25用の転置インデックスから tokens を含む行番号と出現回数の配列、行ごとのトークン数を返す
+        最初の検索時に作成し、以降は登録したバッチの行だけを追加する (ロックを取って呼び出す)
+        """
+        if self._postings is None:
+            self._postings = {}
+            self._lengths = np.zeros(0, dtype=np.float32)
+            self._index_text(range(len(self.docs)))
+        found = {}
+        for token in tokens:
+            entry = self._postings.get(token)
+            if entry is None:
+                continue
+            if entry[2] is None:
+                entry[2] = (np.array(entry[0]), np.array(entry[1], dtype=np.float32))
+            found[token] = entry[2]
+        return found, self._lengths
+
+    def _index_text(self, rows):
+        # rows は転置インデックスに未登録の末尾の行
+        start = len(self._lengths)
+        lengths = np.zeros(len(self.docs) - start, dtype=np.float32)
+        for row in rows:
+            doc = self.docs[row]
+            if doc is None:
+                continue
+            tokens = _text_tokens(doc["content"])
+            lengths[row - start] = len(tokens)
+            for token, tf in Counter(tokens).items():
+                entry = self._postings.setdefault(token, [[], [], None])
+                entry[0].append(row)
+                entry[1].append(tf)
+                entry[2] = None
+        self._lengths = np.concatenate([self._lengths, lengths])
+
+
+class LocalVectorStore(VectorStore):
+    """
+    埋め込みをローカルのファイルに連続した行列として保存し、プロセス内で検索するバックエンド
+    起動時はメモリマップでゼロコピーで読み込み、類似度はブロックごとの行列積と argpartition で上位k件を求める
+    小規模な環境やテストでElasticsearchを立ち上げずに使う
+    ファイルの読み書きと検索の計算は executors の cpu_executor で実行する
+    """
+
+    def __init__(self, root: str = LOCAL_STORE_DIR, dtype: str = LOCAL_STORE_DTYPE, dim: int = EMBEDDING_DIM):
+        self.root = root
+        self.dtype = np.dtype(dtype)
+        self.dim = dim
+        self._indices = {}
+        self._lock = threading.Lock()
+
+    def _path(self, index_name: str) -> str:
+        validate_index_name(index_name)
+        path = os.path.join(self.root, index_name)
+        if os.path.dirname(os.path.realpath(path)) != os.path.realpath(self.root):
+            raise ValueError(f"インデックス名が正しくありません: '{index_name}'")
+        return path
+
+    def _get(self, index_name: str) -> _LocalIndex:
+        with self._lock:
+            index = self._indices.get(index_name)
+            if index is None:
+                if not os.path.exists(os.path.join(self._path(index_name), "meta.json")):
+                    raise KeyError(f"インデックス '{index_name}' は存在しません。")
+                index = self._indices[index_name] = _LocalIndex(self._path(index_name), self.dim, self.dtype)
+            return index
+
+    async def index_exists(self, index_name: str) -> bool:
+        return index_name in self._indices or os.path.exists(os.path.join(self._path(index_name), "meta.json"))
+
+    def _create_index(self, index_name: str):
+        with self._lock:
+            if index_name not in self._indices:
+                self._indices[index_name] = _LocalIndex(self._path(index_name), self.dim, self.dtype)
+
+    async def create_index(self, index_name: str, vector_type: str = "float"):
+        # 保存する型は LOCAL_STORE_DTYPE で指定する
+        if vector_type != "float":
+            raise ValueError("local バックエンドは vector_type='float' のみ対応しています (保存する型は LOCAL_STORE_DTYPE で指定してください)")
+        await run_cpu(self._create_index, index_name)
+
+    async def vector_type(self, index_name: str) -> str:
+        return "float"
+
+    def _existing_documents(self, index_name: str, ids: list, fields: list) -> dict:
+        index = self._get(index_name)
+        found = {}
+        with self._lock:
+            for doc_id in ids:
+                row = index.rows.get(doc_id)
+                if row is not None:
+                    doc = index.docs[row]
+                    found[doc_id] = {key: doc[key] for key in fields if key in doc}
+        return found
+
+    async def existing_documents(self, index_name: str, ids: list, fields: list) -> dict:
+        return await run_cpu(self._existing_documents, index_name, ids, fields)
+
+    def _bulk_add(self, index_name: str, documents) -> dict:
+        index = self._get(index_name)
+        with self._lock:
+            result = index.add(list(documents))
+        print(f"インデックス '{index_name}' に {result['success']} 件のドキュメントを登録しました (失敗: {len(result['errors'])} 件)。")
+        return result
+
+    async def bulk_add(self, index_name: str, documents) -> dict:
+        return await run_cpu(self._bulk_add, index_name, documents)
+
+    def _update_documents(self, index_name: str, documents) -> dict:
+        index = self._get(index_name)
+        with self._lock:
+            result = index.update(list(documents))
+        print(f"インデックス '{index_name}' の {result['success']} 件のドキュメントを更新しました (失敗: {len(result['errors'])} 件)。")
+        return result
+
+    async def update_documents(self, index_name: str, documents) -> dict:
+        return await run_cpu(self._update_documents, index_name, documents)
+
+    def _delete_stale(self, index_name: str, source: str, doc_id: str) -> int:
+        index = self._get(index_name)
+        with self._lock:
+            deleted = index.delete_stale(source, doc_id)
+        if deleted:
+            print(f"インデックス '{index_name}' から '{source}' の以前の版のチャンクを {deleted} 件削除しました。")
+        return deleted
+
+    async def delete_stale(self, index_name: str, source: str, doc_id: str) -> int:
+        return await run_cpu(self._delete_stale, index_name, source, doc_id)
+
+    def search_vectors(self, index_name: str, embeddings: list, top_k: int) -> list:
+        """
+        複数のクエリをまとめて検索する。戻り値はクエリごとの検索結果のリスト
+        スコアはElasticsearchのkNN検索(cosine)と同じ (1 + コサイン類似度) / 2
+        """
+        index = self._get(index_name)
+        with self._lock:
+            vectors, docs, dead = index.vectors, index.docs, index.dead
+        queries = np.asarray(embeddings, dtype=np.float32).reshape(-1, index.dim)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms > 0, norms, 1.0)
+
+        count = len(vectors)
+        scores = np.empty((len(queries), count), dtype=np.float32)
+        for start in range(0, count, SEARCH_BLOCK_ROWS):
+            block = vectors[start:start + SEARCH_BLOCK_ROWS]
+            if block.dtype != np.float32:
+                block = block.astype(np.float32)
+            scores[:, start:start + len(block)] = queries @ block.T
+        scores[:, dead[dead < count]] = -np.inf
+
+        results = []
+        for query_scores in scores:
+            results.append([
+                {**docs[row], "score": float((1.0 + query_scores[row]) / 2.0)}
+                for row in _top_k(query_scores, top_k) if docs[row] is not None
+            ])
+        return results
+
+    async def search_vector(self, index_name, embedding, top_k, mode="knn", num_candidates=100):
+        # 全件を計算するため mode と num_candidates によらず厳密な結果になる
+        return (await run_cpu(self.search_vectors, index_name, [embedding], top_k))[0]
+
+    def _search_text(self, index_name, query_text, top_k):
+        index = self._get(index_name)
+        tokens = set(_text_tokens(query_text))
+        with self._lock:
+            docs = index.docs
+            postings, lengths = index.text_index(tokens)
+            live = len(index.rows)
+            dead = index.dead
+        if not live:
+            return []
+        scores = np.zeros(len(lengths), dtype=np.float32)
+        avg_length = float(lengths.sum()) / live or 1.0
+        for rows, tfs in postings.values():
+            # 削除した行は転置インデックスに残っているため、文書頻度から除く
+            df = len(rows) - int(np.isin(rows, dead).sum()) if len(dead) else len(rows)
+            idf = math.log(1.0 + (live - df + 0.5) / (df + 0.5))
+            norm = BM25_K1 * (1.0 - BM25_B + BM25_B * lengths[rows] / avg_length)
+            scores[rows] += idf * tfs * (BM25_K1 + 1.0) / (tfs + norm)
+        # 削除した行はトークン数が0のためスコアが高くなり、上位k件の枠を埋めてしまう
+        scores[dead[dead < len(scores)]] = 0
+        return [
+            {**docs[row], "score": float(scores[row])}
+            for row in _top_k(scores, top_k) if scores[row] > 0 and docs[row] is not None
+        ]
+
+    async def search_text(self, index_name, query_text, top_k):
+        return await run_cpu(self._search_text, index_name, query_text, top_k)
+
+    def _search_hybrid(self, index_name, query_text, embedding, top_k, fusion="rrf"):
+        size = max(HYBRID_WINDOW_SIZE, top_k)
+        timings = {}
+        started = time.perf_counter()
+        bm25 = self._search_text(index_name, query_text, size)
+        timings["bm25_ms"] = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        vector = self.search_vectors(index_name, [embedding], size)[0]
+        timings["vector_ms"] = (time.perf_counter() - started) * 1000
+        return {"docs": fuse_results({"bm25": bm25, "vector": vector}, top_k, method=fusion), "timings": timings}
+
+    async def search_hybrid(self, index_name, query_text, embedding, top_k, fusion="rrf", num_candidates=100):
+        return await run_cpu(self._search_hybrid, index_name, query_text, embedding, top_k, fusion)
+
+    def _search_batch(self, index_name, query_texts, embeddings, top_k, retrieval_mode="vector", fusion="rrf"):
+        # ベクトル検索は全ての質問をまとめて1回の行列積で計算する
+        size = max(HYBRID_WINDOW_SIZE, top_k) if retrieval_mode == "hybrid" else top_k
+        started = time.perf_counter()
+        vector_results = self.search_vectors(index_name, embeddings, size)
+        vector_ms = (time.perf_counter() - started) * 1000
+        results = []
+        for query_text, vector in zip(query_texts, vector_results):
+            timings = {"vector_ms": vector_ms}  # 全ての質問をまとめた計算の時間
+            if retrieval_mode != "hybrid":
+                results.append({"docs": vector, "timings": timings, "error": None})
+                continue
+            started = time.perf_counter()
+            bm25 = self._search_text(index_name, query_text, size)
+            timings["bm25_ms"] = (time.perf_counter() - started) * 1000
+            docs = fuse_results({"bm25": bm25, "vector": vector}, top_k, method=fusion)
+            results.append({"docs": docs, "timings": timings, "error": None})
+        return results
+
+    async def search_batch(
+        self, index_name, query_texts, embeddings, top_k,
+        retrieval_mode="vector", mode="knn", fusion="rrf", num_candidates=100,
+    ):
+        return await run_cpu(self._search_batch, index_name, query_texts, embeddings, top_k, retrieval_mode, fusion)
+
+    async def count(self, index_name: str) -> int:
+        return len((await run_cpu(self._get, index_name)).rows)
+
+    def _fetch_page(self, index_name: str, cursor: str = None, size: int = EXPORT_PAGE_SIZE) -> tuple:
+        # カーソルは次に返す行番号。行は追記のみで並びが変わらないため、途中で登録があっても続きから取得できる
+        # (削除した行は飛ばす。行を詰め直すのはインデックスを開くときだけ)
+        docs = self._get(index_name).docs
+        start = int(cursor) if cursor is not None and cursor.isdigit() else 0
+        if cursor is not None and not cursor.isdigit():
+            raise ValueError("カーソルの形式が正しくありません")
+        page = [{"id": doc["id"], "content": doc["content"]} for doc in docs[start:start + size] if doc is not None]
+        end = min(start + size, len(docs))
+        return page, (str(end) if end < len(docs) else None)
+
+    async def fetch_page(self, index_name: str, cursor: str = None, size: int = EXPORT_PAGE_SIZE) -> tuple:
+        return await run_cpu(self._fetch_page, index_name, cursor, size)
+
+
+def create_store(backend: str = VECTOR_STORE_BACKEND) -> VectorStore:
+    if backend == "elasticsearch":
+        return ElasticsearchStore()
+    if backend == "local":
+        return LocalVectorStore()
+    raise ValueError('backend must be "elasticsearch" or "local"')
+
+
+# アプリ全体で使用するバックエンド
+store = create_store()
@@ -0,0 +1,326 @@
+"""
+ベンチマーク用のElasticsearchの代わりになるHTTPサーバー
+
+アプリが使うAPI (インデックスの作成・マッピング取得、_bulk、_mget、_search、_msearch、_count、_delete_by_query、point-in-time) を
+メモリ上のドキュメントで処理する。ベクトル検索は全件のコサイン類似度、全文検索は文字bigramの一致数で計算する。
+処理ごとに指定した遅延を入れ、呼び出し回数・ドキュメント数・転送バイト数を記録する。
+"""
+import json
+import threading
+import time
+import uuid
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+
+def _bigrams(text: str) -> set:
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+class FakeIndex:
+    def __init__(self, mappings: dict):
+        self.mappings = mappings
+        self.ids = {}  # ID -> 登録順の番号
+        self.docs = []  # 登録順のドキュメント (_id と _source)
+        self._matrix = None
+
+    def put(self, doc_id: str, source: dict) -> str:
+        if doc_id in self.ids:
+            self.docs[self.ids[doc_id]]["_source"] = source
+            result = "updated"
+        else:
+            self.ids[doc_id] = len(self.docs)
+            self.docs.append({"_id": doc_id, "_source": source})
+            result = "created"
+        self._matrix = None
+        return result
+
+    def delete(self, rows: list):
+        """指定した行のドキュメントを削除し、残りの登録順を詰める"""
+        removed = set(rows)
+        self.docs = [doc for row, doc in enumerate(self.docs) if row not in removed]
+        self.ids = {doc["_id"]: row for row, doc in enumerate(self.docs)}
+        self._matrix = None
+
+    def matrix(self) -> np.ndarray:
+        """正規化した埋め込みの行列 (登録があるたびに作り直す)"""
+        if self._matrix is None:
+            vectors = np.array([doc["_source"].get("embedding") or [] for doc in self.docs], dtype=np.float32)
+            if vectors.size:
+                vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            self._matrix = vectors
+        return self._matrix
+
+
+class FakeElasticsearch:
+    """
+    :param latency_ms: 処理ごとの遅延(ミリ秒)。キーは "search", "msearch", "bulk", "mget", "other"
+    """
+
+    def __init__(self, latency_ms: dict = None):
+        self.latency_ms = latency_ms or {}
+        self.indices = {}
+        self.pits = {}
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = defaultdict(lambda: {"calls": 0, "docs": 0, "request_bytes": 0, "response_bytes": 0})
+
+    def record(self, operation: str, docs: int, request_bytes: int, response_bytes: int):
+        with self.lock:
+            entry = self.stats[operation]
+            entry["calls"] += 1
+            entry["docs"] += docs
+            entry["request_bytes"] += request_bytes
+            entry["response_bytes"] += response_bytes
+
+    def sleep(self, operation: str):
+        delay = self.latency_ms.get(operation, self.latency_ms.get("other", 0))
+        if delay:
+            time.sleep(delay / 1000)
+
+    # 各APIの処理。戻り値は (ステータスコード, レスポンス, 記録する処理名, 処理したドキュメント数)
+    def handle(self, method: str, path: str, params: dict, body: bytes) -> tuple:
+        parts = [part for part in path.split("/") if part]
+        if not parts:
+            return 200, {"version": {"number": "8.15.0"}, "tagline": "You Know, for Search"}, "other", 0
+        if parts[0] == "_bulk":
+            return self.bulk(body)
+        if parts[0] == "_msearch":
+            return self.msearch(body)
+        if parts[0] == "_search":
+            return self.search(None, json.loads(body or b"{}"), params)
+        if parts[0] == "_pit" and method == "DELETE":
+            self.pits.pop(json.loads(body)["id"], None)
+            return 200, {"succeeded": True, "num_freed": 1}, "other", 0
+
+        index_name = parts[0]
+        action = parts[1] if len(parts) > 1 else None
+        if action is None:
+            if method == "PUT":
+                if index_name in self.indices:
+                    return 400, {"error": {"type": "resource_already_exists_exception"}, "status": 400}, "other", 0
+                self.indices[index_name] = FakeIndex(json.loads(body or b"{}").get("mappings", {}))
+                return 200, {"acknowledged": True, "index": index_name}, "other", 0
+            if method == "DELETE":
+                self.indices.pop(index_name, None)
+                return 200, {"acknowledged": True}, "other", 0
+            if index_name not in self.indices:
+                return self.not_found(index_name)
+            return 200, {index_name: {"mappings": self.indices[index_name].mappings}}, "other", 0
+
+        if index_name not in self.indices:
+            return self.not_found(index_name)
+        index = self.indices[index_name]
+        request = json.loads(body) if body else {}
+        if action == "_mapping":
+            return 200, {index_name: {"mappings": index.mappings}}, "other", 0
+        if action == "_count":
+            return 200, {"count": len(index.docs)}, "other", 0
+        if action == "_refresh":
+            return 200, {"_shards": {"total": 1, "successful": 1, "failed": 0}}, "other", 0
+        if action == "_pit":
+            pit_id = uuid.uuid4().hex
+            self.pits[pit_id] = index_name
+            return 200, {"id": pit_id}, "other", 0
+        if action == "_mget":
+            # _source=false は本文を返さず、フィールド名の並びはそのフィールドだけを返す
+            fields = params.get("_source", "false")
+            docs = []
+            for doc_id in request.get("ids", []):
+                doc = {"_index": index_name, "_id": doc_id, "found": doc_id in index.ids}
+                if doc["found"] and fields != "false":
+                    source = index.docs[index.ids[doc_id]]["_source"]
+                    doc["_source"] = {key: source[key] for key in fields.split(",") if key in source}
+                docs.append(doc)
+            return 200, {"docs": docs}, "mget", len(docs)
+        if action == "_search":
+            return self.search(index_name, request, params)
+        if action == "_delete_by_query":
+            rows = [row for row, doc in enumerate(index.docs) if self.matches(doc["_source"], request.get("query", {}))]
+            index.delete(rows)
+            return 200, {"took": 1, "deleted": len(rows), "failures": []}, "delete_by_query", len(rows)
+        return 400, {"error": {"type": "illegal_argument_exception", "reason": f"unsupported: {method} {path}"}}, "other", 0
+
+    def not_found(self, index_name: str) -> tuple:
+        error = {"type": "index_not_found_exception", "reason": f"no such index [{index_name}]", "index": index_name}
+        return 404, {"error": {"root_cause": [error], **error}, "status": 404}, "other", 0
+
+    def bulk(self, body: bytes) -> tuple:
+        lines = [line for line in body.split(b"\n") if line.strip()]
+        items = []
+        for action_line, source_line in zip(lines[::2], lines[1::2]):
+            op, meta = next(iter(json.loads(action_line).items()))
+            index = self.indices.get(meta["_index"])
+            if index is None:
+                # 実際のElasticsearchと同じく、存在しないインデックスには動的マッピングで作成する
+                index = self.indices[meta["_index"]] = FakeIndex({})
+            source = json.loads(source_line)
+            if op == "update":
+                # 部分更新: 登録済みのドキュメントに doc のフィールドを上書きする
+                if meta["_id"] not in index.ids:
+                    error = {"type": "document_missing_exception", "reason": f"[{meta['_id']}]: document missing"}
+                    items.append({op: {"_index": meta["_index"], "_id": meta["_id"], "status": 404, "error": error}})
+                    continue
+                source = {**index.docs[index.ids[meta["_id"]]]["_source"], **source["doc"]}
+            result = index.put(meta["_id"], source)
+            items.append({op: {"_index": meta["_index"], "_id": meta["_id"], "result": result, "status": 201 if result == "created" else 200}})
+        errors = any("error" in next(iter(item.values())) for item in items)
+        return 200, {"took": 1, "errors": errors, "items": items}, "bulk", len(items)
+
+    def msearch(self, body: bytes) -> tuple:
+        lines = [json.loads(line) for line in body.split(b"\n") if line.strip()]
+        responses = []
+        for header, request in zip(lines[::2], lines[1::2]):
+            status, response, _, _ = self.search(header.get("index"), request, {})
+            responses.append({**response, "status": status})
+        return 200, {"took": 1, "responses": responses}, "msearch", len(responses)
+
+    def search(self, index_name, request: dict, params: dict) -> tuple:
+        started = time.perf_counter()
+        pit = request.get("pit")
+        if pit is not None:
+            index_name = self.pits.get(pit["id"])
+            if index_name is None:
+                error = {"type": "search_context_missing_exception", "reason": "No search context found"}
+                return 404, {"error": {"root_cause": [error], **error}, "status": 404}, "search", 0
+        if index_name not in self.indices:
+            return self.not_found(index_name)
+        index = self.indices[index_name]
+
+        size = request.get("size", params.get("size", 10))
+        rows, scores = self.score(index, request)
+        if pit is not None:
+            after = (request.get("search_after") or [-1])[0]
+            rows = [row for row in range(len(index.docs)) if row > after]
+            scores = [None] * len(rows)
+        order = list(zip(rows, scores))[:int(size)]
+
+        includes = request.get("_source", params.get("_source_includes"))
+        excludes = params.get("_source_excludes")
+        if isinstance(includes, str):
+            includes = includes.split(",")
+        if isinstance(excludes, str):
+            excludes = excludes.split(",")
+        hits = []
+        for row, score in order:
+            doc = index.docs[row]
+            source = doc["_source"]
+            if includes is False or includes == "false":
+                source = None
+            elif isinstance(includes, list):
+                source = {key: value for key, value in source.items() if key in includes}
+            if source is not None and excludes:
+                source = {key: value for key, value in source.items() if key not in excludes}
+            hit = {"_index": index_name, "_id": doc["_id"], "_score": score}
+            if source is not None:
+                hit["_source"] = source
+            if pit is not None:
+                hit["sort"] = [row]
+            hits.append(hit)
+
+        response = {
+            "took": int((time.perf_counter() - started) * 1000),
+            "timed_out": False,
+            "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+            "hits": {
+                "total": {"value": len(rows), "relation": "eq"},
+                "max_score": max((s for _, s in order if s is not None), default=None),
+                "hits": hits,
+            },
+        }
+        if pit is not None:
+            response["pit_id"] = pit["id"]
+        return 200, response, "search", len(hits)
+
+    def score(self, index: FakeIndex, request: dict) -> tuple:
+        """検索条件に一致する行番号とスコアをスコアの降順で返す"""
+        if "knn" in request:
+            knn = request["knn"]
+            return self.vector_scores(index, knn["query_vector"], knn.get("k", 10), knn=True)
+
+        query = request.get("query", {"match_all": {}})
+        if "script_score" in query:
+            vector = query["script_score"]["script"]["params"]["query_vector"]
+            return self.vector_scores(index, vector, len(index.docs), knn=False)
+        if "match" in query:
+            field, condition = next(iter(query["match"].items()))
+            text = condition["query"] if isinstance(condition, dict) else condition
+            terms = _bigrams(text)
+            scored = [
+                (row, float(len(terms & _bigrams(doc["_source"].get(field, "")))))
+                for row, doc in enumerate(index.docs)
+            ]
+            scored = sorted((item for item in scored if item[1] > 0), key=lambda item: -item[1])
+            return [row for row, _ in scored], [score for _, score in scored]
+        if "term" in query:
+            field, condition = next(iter(query["term"].items()))
+            value = condition["value"] if isinstance(condition, dict) else condition
+            field = field.split(".")[0]
+            rows = [row for row, doc in enumerate(index.docs) if doc["_source"].get(field) == value]
+            return rows, [1.0] * len(rows)
+        return list(range(len(index.docs))), [1.0] * len(index.docs)
+
+    def matches(self, source: dict, query: dict) -> bool:
+        """フィルター条件 (term と、bool の filter / must_not) に一致するか"""
+        if "term" in query:
+            field, condition = next(iter(query["term"].items()))
+            value = condition["value"] if isinstance(condition, dict) else condition
+            return source.get(field.split(".")[0]) == value
+        if "bool" in query:
+            conditions = query["bool"]
+            return (
+                all(self.matches(source, item) for item in conditions.get("filter", []))
+                and not any(self.matches(source, item) for item in conditions.get("must_not", []))
+            )
+        return "match_all" in query
+
+    def vector_scores(self, index: FakeIndex, vector: list, k: int, knn: bool) -> tuple:
+        matrix = index.matrix()
+        if not len(matrix):
+            return [], []
+        query = np.asarray(vector, dtype=np.float32)
+        query /= max(np.linalg.norm(query), 1e-12)
+        similarity = matrix @ query
+        rows = np.argsort(-similarity)[:k]
+        # knn の cosine は (1 + cos) / 2、script_score は cosineSimilarity + 1.0
+        scores = (1 + similarity[rows]) / 2 if knn else similarity[rows] + 1.0
+        return rows.tolist(), scores.tolist()
+
+    def serve(self, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+        """別スレッドでHTTPサーバーを起動して返す (port=0 なら空いているポート)"""
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                url = urlsplit(self.path)
+                params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                with fake.lock:
+                    status, response, operation, docs = fake.handle(self.command, url.path, params, body)
+                fake.sleep(operation)
+                payload = json.dumps(response).encode("utf-8")
+                fake.record(operation, docs, len(body), len(payload))
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.send_header("X-Elastic-Product", "Elasticsearch")  # Pythonクライアントの製品チェック用
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(payload)
+
+            do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _handle
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="fake-elasticsearch", daemon=True).start()
+        return server
@@ -0,0 +1,105 @@
+"""
+ベンチマーク用のOllamaの代わりになるHTTPサーバー
+
+/api/generate を、指定したトークン数・生成速度・最初のトークンまでの時間で応答する (stream の有無に対応)。
+同時に生成できる数を parallel で制限し、超えた要求は実際のOllamaと同じく順番を待つ。
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ANSWER_TOKENS = ["東京", "は", "日本", "の", "首都", "です", "。"]
+
+
+class FakeOllama:
+    def __init__(
+        self,
+        tokens: int = 64,
+        tokens_per_sec: float = 30.0,
+        first_token_ms: float = 200.0,
+        parallel: int = 4,
+    ):
+        """
+        :param tokens: 1回の生成で返すトークン数
+        :param tokens_per_sec: 2トークン目以降の生成速度
+        :param first_token_ms: 最初のトークンを返すまでの時間 (プロンプトの処理時間に相当)
+        :param parallel: 同時に生成できる数
+        """
+        self.tokens = tokens
+        self.tokens_per_sec = tokens_per_sec
+        self.first_token_ms = first_token_ms
+        self.slots = threading.Semaphore(parallel)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "streamed": 0, "tokens": 0, "prompt_chars": 0, "max_waiting": 0}
+        self._waiting = 0
+
+    def generate(self):
+        """トークンを生成速度に合わせて1つずつ返す"""
+        time.sleep(self.first_token_ms / 1000)
+        for i in range(self.tokens):
+            if i:
+                time.sleep(1 / self.tokens_per_sec)
+            yield ANSWER_TOKENS[i % len(ANSWER_TOKENS)]
+
+    def serve(self, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+        """別スレッドでHTTPサーバーを起動して返す (port=0 なら空いているポート)"""
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+                stream = request.get("stream", True)  # Ollamaの既定はストリーム
+                with fake.lock:
+                    fake.stats["requests"] += 1
+                    fake.stats["streamed"] += int(stream)
+                    fake.stats["prompt_chars"] += len(request.get("prompt", ""))
+                    fake._waiting += 1
+                    fake.stats["max_waiting"] = max(fake.stats["max_waiting"], fake._waiting)
+                with fake.slots:
+                    with fake.lock:
+                        fake._waiting -= 1
+                    if stream:
+                        self.stream_response(request)
+                    else:
+                        text = "".join(fake.generate())
+                        self.send_json({"model": request.get("model"), "response": text, "done": True})
+                    with fake.lock:
+                        fake.stats["tokens"] += fake.tokens
+
+            def send_json(self, data: dict):
+                payload = json.dumps(data, ensure_ascii=False).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def stream_response(self, request: dict):
+                # Ollamaと同じく1行に1つのJSONをチャンク転送で返す
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                try:
+                    for token in fake.generate():
+                        self.write_chunk({"model": request.get("model"), "response": token, "done": False})
+                    self.write_chunk({"model": request.get("model"), "response": "", "done": True})
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # クライアントが切断した場合は生成を打ち切る
+
+            def write_chunk(self, data: dict):
+                line = (json.dumps(data, ensure_ascii=False) + "\n").encode("utf-8")
+                self.wfile.write(f"{len(line):X}\r\n".encode("ascii") + line + b"\r\n")
+                self.wfile.flush()
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="fake-ollama", daemon=True).start()
+        return server
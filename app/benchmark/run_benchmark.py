@@ -0,0 +1,346 @@
+"""
+simple_rag / advanced_rag のオフラインベンチマーク
+
+Elasticsearch と Ollama の代わりに fake_elasticsearch / fake_ollama のサーバーを起動し、
+アプリを uvicorn で起動して (環境変数 ES_URL / OLLAMA_URL で接続先を差し替える) 以下を計測する。
+
+- 起動: プロセスの起動から /ready が200を返すまでの時間
+- /index: 生成した文書の登録ジョブが完了するまでの chunks/秒 (登録済みのチャンクを省略する2回目の登録も計測)
+- /query: 指定した同時実行数ごとのレイテンシの p50 / p95 / p99 とスループット
+- /query/batch: 同じ回数の質問を --batch-size 件ずつまとめて送った場合の質問数/秒 (同時実行数1の /query との比較)
+
+埋め込みモデルは実際のものを使う。結果はJSONで保存し、--baseline に前回の結果を指定すると差分を表示する。
+
+    python run_benchmark.py --apps simple_rag advanced_rag --concurrency 1 8 --output bench_results.json
+    python run_benchmark.py --apps simple_rag --baseline bench_results.json --output bench_results_new.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+import numpy as np
+
+from fake_elasticsearch import FakeElasticsearch
+from fake_ollama import FakeOllama
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APPS = ("simple_rag", "advanced_rag")
+
+SUBJECTS = ["東京", "大阪", "京都", "札幌", "福岡", "岩手県一関市", "検索エンジン", "埋め込みモデル", "サッカー", "お寿司"]
+PREDICATES = [
+    "は日本の都市です。", "について説明します。", "は多くの人に人気があります。", "の歴史は長いです。",
+    "の特徴を比較しました。", "は夏に訪れるのがおすすめです。", "を使うと検索の精度が上がります。",
+]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_documents(count: int, chars: int, seed: int = 0) -> list:
+    """内容が重複しない文書を生成する (チャンクIDは内容から作られるため)"""
+    rng = np.random.default_rng(seed)
+    documents = []
+    for i in range(count):
+        sentences = []
+        length = 0
+        while length < chars:
+            sentence = f"{rng.choice(SUBJECTS)}{rng.choice(PREDICATES)}({i}-{len(sentences)})"
+            sentences.append(sentence)
+            length += len(sentence)
+        documents.append((f"doc{i:04d}.txt", "".join(sentences)[:chars]))
+    return documents
+
+
+def percentiles(latencies: list) -> dict:
+    values = np.array(latencies) * 1000
+    if not len(values):
+        return {}
+    return {
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "mean_ms": float(values.mean()),
+        "max_ms": float(values.max()),
+    }
+
+
+def question_for(i: int) -> str:
+    return f"{SUBJECTS[i % len(SUBJECTS)]}について教えてください ({i})"
+
+
+def start_app(app: str, port: int, env: dict, timeout: float) -> tuple:
+    """アプリを起動し、/ready が200を返すまで待つ。戻り値は (プロセス, /ready までの秒数)"""
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=os.path.join(APP_ROOT, app),
+        env={**os.environ, **env},
+    )
+    url = f"http://127.0.0.1:{port}/ready"
+    while time.perf_counter() - started < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"{app} の起動に失敗しました (終了コード {process.returncode})")
+        try:
+            if httpx.get(url, timeout=1.0).status_code == 200:
+                return process, time.perf_counter() - started
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"{app} が {timeout} 秒以内に準備完了になりませんでした")
+
+
+def bench_index(base_url: str, index_name: str, documents: list, timeout: float = 3600.0) -> dict:
+    """/index で登録ジョブを作成し、GET /index/jobs/{id} で完了するまで待つ (アップロードから完了までの時間を計測)"""
+    files = [("documents", (name, text.encode("utf-8"), "text/plain")) for name, text in documents]
+    started = time.perf_counter()
+    resp = httpx.post(f"{base_url}/index", data={"index_name": index_name}, files=files, timeout=None)
+    resp.raise_for_status()
+    accepted = time.perf_counter() - started
+    status_url = f"{base_url}{resp.json()['status_url']}"
+    while True:
+        job = httpx.get(status_url, timeout=10).json()
+        if job["status"] in ("completed", "failed"):
+            break
+        if time.perf_counter() - started > timeout:
+            raise RuntimeError(f"登録ジョブが {timeout} 秒以内に終わりませんでした: {job}")
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    if job["status"] == "failed":
+        raise RuntimeError(f"登録ジョブが失敗しました: {job['error']}")
+    return {
+        "seconds": elapsed,
+        "accepted_seconds": accepted,  # /index がジョブIDを返すまでの時間
+        "chunks": job["chunks"],
+        "indexed": job["indexed"],
+        "skipped": job["skipped"],
+        "errors": job["failed"],
+        "chunks_per_sec": job["chunks"] / elapsed if elapsed else 0.0,
+    }
+
+
+async def bench_query(base_url: str, index_name: str, requests: int, concurrency: int, top_k: int, retrieval_mode: str) -> dict:
+    """同時実行数を concurrency に保ちながら /query を requests 回送る (回答キャッシュは使わない)"""
+    latencies = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal errors
+        for i in counter:
+            body = {
+                "question": question_for(i),
+                "top_k": top_k,
+                "index_name": index_name,
+                "retrieval_mode": retrieval_mode,
+                "use_cache": False,
+            }
+            started = time.perf_counter()
+            try:
+                resp = await client.post(f"{base_url}/query", json=body)
+                resp.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+            except httpx.HTTPError:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "seconds": elapsed,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        **percentiles(latencies),
+    }
+
+
+def bench_batch(base_url: str, index_name: str, requests: int, batch_size: int, top_k: int, retrieval_mode: str) -> dict:
+    """requests 件の質問を batch_size 件ずつ /query/batch で順に送る (回答キャッシュは使わない)"""
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    with httpx.Client(timeout=None) as client:
+        for offset in range(0, requests, batch_size):
+            body = {
+                "questions": [question_for(i) for i in range(offset, min(offset + batch_size, requests))],
+                "top_k": top_k,
+                "index_name": index_name,
+                "retrieval_mode": retrieval_mode,
+                "use_cache": False,
+            }
+            batch_started = time.perf_counter()
+            try:
+                resp = client.post(f"{base_url}/query/batch", json=body)
+                resp.raise_for_status()
+                latencies.append(time.perf_counter() - batch_started)
+                errors += resp.json()["errors"]
+            except httpx.HTTPError:
+                errors += len(body["questions"])
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": requests,
+        "batch_size": batch_size,
+        "errors": errors,
+        "seconds": elapsed,
+        "questions_per_sec": (requests - errors) / elapsed if elapsed else 0.0,
+        **percentiles(latencies),  # 1回の /query/batch のレイテンシ
+    }
+
+
+def run_app(app: str, args, fake_es: FakeElasticsearch, fake_llm: FakeOllama, env: dict) -> dict:
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    process, startup_seconds = start_app(app, port, env, args.startup_timeout)
+    result = {"startup_seconds": startup_seconds}
+    try:
+        index_name = f"bench-{app.replace('_', '-')}-{int(time.time())}"
+        documents = make_documents(args.docs, args.doc_chars)
+
+        fake_es.reset_stats()
+        result["index"] = bench_index(base_url, index_name, documents)
+        result["reindex"] = bench_index(base_url, index_name, documents)  # 全チャンクが登録済みの場合
+        result["index"]["elasticsearch"] = dict(fake_es.stats)
+        print(f"[{app}] /index: {result['index']['chunks_per_sec']:.1f} chunks/s ({result['index']['chunks']} chunks)")
+
+        result["query"] = {}
+        for concurrency in args.concurrency:
+            fake_es.reset_stats()
+            llm_requests = fake_llm.stats["requests"]
+            stats = asyncio.run(bench_query(base_url, index_name, args.queries, concurrency, args.top_k, args.retrieval_mode))
+            stats["elasticsearch"] = dict(fake_es.stats)
+            stats["llm_requests"] = fake_llm.stats["requests"] - llm_requests
+            result["query"][f"c{concurrency}"] = stats
+            print(
+                f"[{app}] /query c={concurrency}: p50 {stats.get('p50_ms', 0):.1f} ms, "
+                f"p95 {stats.get('p95_ms', 0):.1f} ms, p99 {stats.get('p99_ms', 0):.1f} ms, "
+                f"{stats['throughput_rps']:.2f} req/s, エラー {stats['errors']} 件"
+            )
+
+        if args.batch_size:
+            fake_es.reset_stats()
+            llm_requests = fake_llm.stats["requests"]
+            stats = bench_batch(base_url, index_name, args.queries, args.batch_size, args.top_k, args.retrieval_mode)
+            stats["elasticsearch"] = dict(fake_es.stats)
+            stats["llm_requests"] = fake_llm.stats["requests"] - llm_requests
+            loop = result["query"].get("c1")
+            if loop and loop["seconds"]:
+                # 同時実行数1の /query (クライアント側のループ) に対する速度
+                stats["speedup_vs_c1"] = loop["seconds"] / stats["seconds"] if stats["seconds"] else 0.0
+            result["query_batch"] = stats
+            print(
+                f"[{app}] /query/batch size={args.batch_size}: {stats['questions_per_sec']:.2f} questions/s, "
+                f"c=1 の /query の {stats.get('speedup_vs_c1', 0):.1f} 倍, エラー {stats['errors']} 件"
+            )
+        result["stats"] = httpx.get(f"{base_url}/stats", timeout=10).json()
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+    return result
+
+
+def compare(report: dict, baseline: dict):
+    """前回の結果との差分 (変化率) を表示する"""
+    def change(new, old):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "-"
+
+    for app, result in report["results"].items():
+        base = baseline.get("results", {}).get(app)
+        if not base:
+            continue
+        new, old = result["index"]["chunks_per_sec"], base["index"]["chunks_per_sec"]
+        print(f"[{app}] /index chunks/s: {old:.1f} → {new:.1f} ({change(new, old)})")
+        for key, stats in result["query"].items():
+            old_stats = base.get("query", {}).get(key)
+            if not old_stats:
+                continue
+            for metric in ("p50_ms", "p95_ms", "p99_ms"):
+                new, old = stats.get(metric, 0), old_stats.get(metric, 0)
+                print(f"[{app}] /query {key} {metric}: {old:.1f} → {new:.1f} ({change(new, old)})")
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=APP_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--apps", nargs="+", default=list(APPS), choices=APPS)
+    parser.add_argument("--docs", type=int, default=20, help="/index で登録する文書数")
+    parser.add_argument("--doc-chars", type=int, default=20000, help="1文書の文字数")
+    parser.add_argument("--queries", type=int, default=100, help="同時実行数ごとに送る /query の回数")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8])
+    parser.add_argument("--batch-size", type=int, default=32, help="/query/batch の1リクエストの質問数 (0なら計測しない)")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--retrieval-mode", default="vector", choices=["vector", "hybrid"])
+    parser.add_argument("--es-search-latency-ms", type=float, default=2.0)
+    parser.add_argument("--es-bulk-latency-ms", type=float, default=20.0)
+    parser.add_argument("--es-other-latency-ms", type=float, default=1.0)
+    parser.add_argument("--llm-tokens", type=int, default=64, help="1回の生成で返すトークン数")
+    parser.add_argument("--llm-tokens-per-sec", type=float, default=30.0)
+    parser.add_argument("--llm-first-token-ms", type=float, default=200.0)
+    parser.add_argument("--llm-parallel", type=int, default=4, help="Ollamaが同時に生成できる数")
+    parser.add_argument("--startup-timeout", type=float, default=300.0)
+    parser.add_argument("--baseline", help="比較する前回の結果のJSON")
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+
+    fake_es = FakeElasticsearch({
+        "search": args.es_search_latency_ms,
+        "msearch": args.es_search_latency_ms,
+        "bulk": args.es_bulk_latency_ms,
+        "mget": args.es_other_latency_ms,
+        "other": args.es_other_latency_ms,
+    })
+    fake_llm = FakeOllama(args.llm_tokens, args.llm_tokens_per_sec, args.llm_first_token_ms, args.llm_parallel)
+    es_server = fake_es.serve()
+    llm_server = fake_llm.serve()
+    env = {
+        "ES_URL": f"http://127.0.0.1:{es_server.server_address[1]}",
+        "OLLAMA_URL": f"http://127.0.0.1:{llm_server.server_address[1]}",
+        # アプリの同時生成数を fake_ollama が同時に生成できる数に合わせる
+        "LLM_MAX_CONCURRENCY": str(args.llm_parallel),
+    }
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_commit": git_commit(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("baseline", "output")},
+        "results": {},
+    }
+    try:
+        for app in args.apps:
+            report["results"][app] = run_app(app, args, fake_es, fake_llm, env)
+    finally:
+        es_server.shutdown()
+        llm_server.shutdown()
+    report["ollama"] = fake_llm.stats
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"結果を {args.output} に保存しました。")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
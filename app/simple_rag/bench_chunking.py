@@ -0,0 +1,145 @@
+"""
+チャンク分割の方式(ingestion.CHUNKERS)ごとに、同じコーパスでのチャンク数・分割の速度・検索の精度を比較するスクリプト
+
+    python bench_chunking.py --docs data.txt --num-queries 200 --top-k 3
+    python bench_chunking.py --num-docs 50  # --docs を省略した場合は生成した日本語の文書を使う
+
+- chunks / chunks_per_sec: チャンク数と、1秒あたりに分割できたチャンク数 (トークン数を数える時間を含む)
+- chars_mean / tokens_mean / tokens_max: チャンクの平均文字数と、埋め込みモデルのトークナイザーで数えた平均・最大トークン数
+- embed_seconds: 全チャンクの埋め込みにかかった時間 (チャンク数に比例する /index のコスト)
+- recall_at_k: コーパスから選んだ文を質問とし、上位 top_k 件のチャンクのいずれかがその文を途中で切らずに含む割合
+- mrr: その文を含む最初のチャンクの順位の逆数の平均 (top_k 件に含まれなければ0)
+"""
+import argparse
+import json
+import re
+import time
+
+import numpy as np
+
+from chunk import split_sentences
+from embedding import count_tokens, embed_texts
+from ingestion import CHUNKERS, iter_chunks, iter_text_blocks
+
+MIN_QUERY_CHARS = 10  # 質問に使う文の最小文字数 (短すぎる文は多くのチャンクに含まれるため使わない)
+
+
+def generate_documents(num_docs: int, sentences_per_doc: int = 200, seed: int = 0) -> list:
+    """段落ごとに改行を入れた、内容が重複しない日本語の文書を生成する"""
+    rng = np.random.default_rng(seed)
+    subjects = ["東京", "大阪", "京都", "岩手県一関市", "検索エンジン", "埋め込みモデル", "サッカー観戦", "今日の昼ごはん"]
+    predicates = [
+        "は日本でも有数の観光地として知られています。", "について詳しく説明します！", "の特徴は何でしょうか？",
+        "を三つの観点から比較しました。", "は多くの人に長く愛されてきました。", "を使うと検索の精度が上がります。",
+    ]
+    documents = []
+    for i in range(num_docs):
+        paragraphs = []
+        for p in range(0, sentences_per_doc, 5):
+            paragraphs.append("".join(
+                f"{rng.choice(subjects)}({i}-{p + s}){rng.choice(predicates)}" for s in range(min(5, sentences_per_doc - p))
+            ))
+        documents.append("\n".join(paragraphs))
+    return documents
+
+
+def load_documents(paths: list, num_docs: int) -> list:
+    if not paths:
+        return generate_documents(num_docs)
+    documents = []
+    for path in paths:
+        with open(path, "rb") as f:
+            documents.append("".join(iter_text_blocks(f)))
+    return documents
+
+
+def compact(text: str) -> str:
+    # 空白と改行を除いて比較する (チャンクの前後の空白は取り除かれるため)
+    return re.sub(r"\s+", "", text)
+
+
+def select_queries(documents: list, num_queries: int, seed: int = 0) -> list:
+    """コーパスの文から等確率で質問を選ぶ (末尾の記号は取り除く)"""
+    sentences = [
+        sentence.strip().rstrip("。！？!?")
+        for document in documents
+        for sentence in split_sentences([document])
+    ]
+    sentences = list(dict.fromkeys(s for s in sentences if len(s) >= MIN_QUERY_CHARS))
+    rng = np.random.default_rng(seed)
+    picked = rng.choice(len(sentences), size=min(num_queries, len(sentences)), replace=False)
+    return [sentences[i] for i in picked]
+
+
+def bench_chunker(chunker: str, documents: list, queries: list, query_vectors: np.ndarray, top_k: int) -> dict:
+    started = time.perf_counter()
+    chunks = [chunk for document in documents for chunk in iter_chunks([document], chunker)]
+    chunk_seconds = time.perf_counter() - started
+
+    tokens = np.array(count_tokens(chunks))
+    started = time.perf_counter()
+    vectors = np.asarray(embed_texts(chunks, use_cache=False), dtype=np.float32)
+    embed_seconds = time.perf_counter() - started
+
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    scores = query_vectors @ vectors.T
+    top = np.argsort(-scores, axis=1)[:, :top_k]
+    compact_chunks = [compact(chunk) for chunk in chunks]
+    hits = 0
+    reciprocal_ranks = []
+    for query, row in zip(queries, top):
+        target = compact(query)
+        rank = next((r for r, i in enumerate(row, 1) if target in compact_chunks[i]), None)
+        hits += rank is not None
+        reciprocal_ranks.append(1.0 / rank if rank else 0.0)
+
+    return {
+        "chunker": chunker,
+        "chunks": len(chunks),
+        "chunk_seconds": chunk_seconds,
+        "chunks_per_sec": len(chunks) / chunk_seconds if chunk_seconds else 0.0,
+        "chars_mean": float(np.mean([len(chunk) for chunk in chunks])),
+        "tokens_mean": float(tokens.mean()),
+        "tokens_max": int(tokens.max()),
+        "embed_seconds": embed_seconds,
+        "recall_at_k": hits / len(queries),
+        "mrr": float(np.mean(reciprocal_ranks)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", nargs="*", default=[], help="チャンク分割するテキストファイル (1ファイルを1文書とする)")
+    parser.add_argument("--num-docs", type=int, default=20, help="--docs を省略した場合に生成する文書数")
+    parser.add_argument("--chunkers", nargs="+", default=list(CHUNKERS), choices=CHUNKERS)
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--output", default="bench_chunking.json")
+    args = parser.parse_args()
+
+    documents = load_documents(args.docs, args.num_docs)
+    queries = select_queries(documents, args.num_queries)
+    print(f"{len(documents)} 件の文書 ({sum(len(d) for d in documents)} 文字) と {len(queries)} 件の質問で計測します。")
+
+    # モデルの読み込みを計測に含めないよう、先に質問を埋め込んでおく
+    query_vectors = np.asarray(embed_texts(queries, use_cache=False), dtype=np.float32)
+    query_vectors /= np.maximum(np.linalg.norm(query_vectors, axis=1, keepdims=True), 1e-12)
+    count_tokens(queries[:1])
+
+    results = []
+    for chunker in args.chunkers:
+        result = bench_chunker(chunker, documents, queries, query_vectors, args.top_k)
+        results.append(result)
+        print(
+            f"{chunker}: {result['chunks']} chunks, {result['chunks_per_sec']:.0f} chunks/s, "
+            f"平均 {result['chars_mean']:.1f} 文字 / {result['tokens_mean']:.1f} トークン, "
+            f"埋め込み {result['embed_seconds']:.2f} 秒, recall@{args.top_k} {result['recall_at_k']:.3f}, MRR {result['mrr']:.3f}"
+        )
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"docs": len(documents), "queries": len(queries), "top_k": args.top_k, "results": results}, f, ensure_ascii=False, indent=2)
+    print(f"結果を {args.output} に保存しました。")
+
+
+if __name__ == "__main__":
+    main()
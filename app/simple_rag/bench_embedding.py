@@ -0,0 +1,119 @@
+"""
+埋め込みの実行方式(embedding.EMBEDDING_BACKENDS)ごとのスループットと、torch との埋め込みの近さを比較するスクリプト
+
+    python bench_embedding.py --docs data.txt --backends torch torch_int8 onnx onnx_int8 --threads 1 4
+    python bench_embedding.py --num-chunks 2000 --threads 2  # --docs を省略した場合は生成した日本語の文を使う
+
+- chunks_per_sec: 1秒あたりに埋め込めたチャンク数 (chunks_per_sec_per_thread はスレッド数で割った値)
+- similarity: 同じチャンクの torch の埋め込みとのコサイン類似度の平均と最小値
+  最小値が下限(MIN_SIMILARITY または --min-similarity)を下回った実行方式があれば終了コード1で終了する
+"""
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+from embedding import EMBEDDING_BACKENDS, load_model
+from ingestion import CHUNK_SIZE, INGEST_BATCH_SIZE, iter_chunks, iter_text_blocks
+
+# torch の埋め込みとのコサイン類似度の下限 (int8 は量子化の誤差を見込んで緩める)
+MIN_SIMILARITY = {"torch": 0.999, "onnx": 0.999, "torch_int8": 0.97, "onnx_int8": 0.97}
+
+
+def load_chunks(paths: list, num_chunks: int) -> list:
+    if not paths:
+        # 文書がない場合は、語彙を組み合わせた日本語の文をチャンクとして使う
+        rng = np.random.default_rng(0)
+        subjects = ["東京", "大阪", "検索エンジン", "埋め込みモデル", "今日の昼ごはん", "岩手県一関市", "サッカー観戦"]
+        predicates = ["について説明します。", "は人気があります。", "の特徴は何ですか。", "を比較しました。", "が好きです。"]
+        return [
+            "".join(rng.choice(subjects) + rng.choice(predicates) for _ in range(4))[:CHUNK_SIZE]
+            for _ in range(num_chunks)
+        ]
+    chunks = []
+    for path in paths:
+        with open(path, "rb") as f:
+            chunks.extend(iter_chunks(iter_text_blocks(f)))
+    return chunks[:num_chunks]
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def bench_backend(backend: str, threads: int, chunks: list, batch_size: int, repeat: int):
+    started = time.perf_counter()
+    model = load_model(backend=backend, threads=threads)
+    load_seconds = time.perf_counter() - started
+    model.encode(chunks[:batch_size])  # ウォームアップ
+
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        # /index と同じく INGEST_BATCH_SIZE 件ずつまとめて encode する
+        vectors = np.concatenate([
+            model.encode(chunks[start:start + INGEST_BATCH_SIZE], batch_size=batch_size)
+            for start in range(0, len(chunks), INGEST_BATCH_SIZE)
+        ])
+        best = min(best, time.perf_counter() - started)
+    return vectors, {
+        "load_seconds": load_seconds,
+        "encode_seconds": best,
+        "chunks_per_sec": len(chunks) / best,
+        "chunks_per_sec_per_thread": len(chunks) / best / threads if threads else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", nargs="*", default=[], help="チャンク分割して埋め込むテキストファイル")
+    parser.add_argument("--num-chunks", type=int, default=2000)
+    parser.add_argument("--backends", nargs="+", default=list(EMBEDDING_BACKENDS), choices=EMBEDDING_BACKENDS)
+    parser.add_argument("--threads", nargs="+", type=int, default=[0], help="intra-op スレッド数 (0はライブラリの既定値)")
+    parser.add_argument("--batch-size", type=int, default=32, help="encode の batch_size")
+    parser.add_argument("--repeat", type=int, default=3, help="計測の繰り返し回数 (最速の回を採用)")
+    parser.add_argument("--min-similarity", type=float, help="全ての実行方式に共通の類似度の下限 (省略時は MIN_SIMILARITY)")
+    parser.add_argument("--output", default="bench_embedding.json")
+    args = parser.parse_args()
+
+    chunks = load_chunks(args.docs, args.num_chunks)
+    print(f"{len(chunks)} 件のチャンクで計測します。")
+
+    # 比較の基準は torch の埋め込み
+    reference, _ = bench_backend("torch", args.threads[0], chunks, args.batch_size, 1)
+    reference = normalize(reference)
+
+    results = []
+    failed = []
+    for backend in args.backends:
+        for threads in args.threads:
+            vectors, result = bench_backend(backend, threads, chunks, args.batch_size, args.repeat)
+            similarity = np.sum(normalize(vectors) * reference, axis=1)
+            result.update({
+                "backend": backend,
+                "threads": threads,
+                "similarity_mean": float(similarity.mean()),
+                "similarity_min": float(similarity.min()),
+            })
+            results.append(result)
+            print(
+                f"{backend} (threads={threads}): {result['chunks_per_sec']:.1f} chunks/s, "
+                f"類似度 平均 {result['similarity_mean']:.4f} / 最小 {result['similarity_min']:.4f}"
+            )
+            min_similarity = args.min_similarity if args.min_similarity is not None else MIN_SIMILARITY[backend]
+            if result["similarity_min"] < min_similarity:
+                failed.append(f"{backend} (threads={threads}, 下限 {min_similarity})")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"chunks": len(chunks), "batch_size": args.batch_size, "results": results}, f, ensure_ascii=False, indent=2)
+    print(f"結果を {args.output} に保存しました。")
+
+    if failed:
+        print(f"❌ torch の埋め込みとの類似度が下限を下回りました: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
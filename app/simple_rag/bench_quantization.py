@@ -0,0 +1,167 @@
+"""
+量子化したベクトル(int8)での検索の再現率を float32 の全件検索と比較するスクリプト
+
+    # テキストファイルをチャンク分割・埋め込みして比較 (質問は1行に1つ)
+    python bench_quantization.py --docs data.txt --queries questions.txt --top-k 10
+    # Elasticsearch に float / int8_hnsw / byte のインデックスを作成して kNN 検索の再現率とサイズも比較
+    python bench_quantization.py --docs data.txt --queries questions.txt --es
+    # 埋め込みモデルを使わず、クラスタ構造を持つ乱数のベクトルで量子化の誤差だけを確認
+    python bench_quantization.py --synthetic 100000
+
+正解は float32 での全件のコサイン類似度の上位 top_k 件とし、recall@k = 正解と一致した件数 / top_k の平均を出力する
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+
+from ingestion import iter_chunks, iter_text_blocks
+
+EMBEDDING_DIM = 384
+
+
+def load_chunks(paths: list) -> list:
+    chunks = []
+    for path in paths:
+        with open(path, "rb") as f:
+            chunks.extend(iter_chunks(iter_text_blocks(f)))
+    return list(dict.fromkeys(chunks))  # 同じ内容のチャンクは1つにまとめる
+
+
+def synthetic_vectors(n_docs: int, n_queries: int, dim: int = EMBEDDING_DIM, n_clusters: int = 256, seed: int = 0):
+    """文の埋め込みのように、いくつかの話題の周りに集まった正規化済みのベクトルを生成する"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+
+    def sample(n):
+        vectors = centers[rng.integers(0, n_clusters, n)] + 0.8 * rng.standard_normal((n, dim)).astype(np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    return sample(n_docs), sample(n_queries)
+
+
+def exact_top_k(docs: np.ndarray, queries: np.ndarray, top_k: int) -> np.ndarray:
+    """コサイン類似度の上位 top_k 件の行番号 (スコアの降順)"""
+    docs = docs / np.maximum(np.linalg.norm(docs, axis=1, keepdims=True), 1e-12)
+    queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+    scores = queries @ docs.T
+    top = np.argpartition(-scores, min(top_k, scores.shape[1] - 1), axis=1)[:, :top_k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def recall(truth: np.ndarray, found: list, top_k: int) -> float:
+    return float(np.mean([len(set(t[:top_k]) & set(f[:top_k])) / top_k for t, f in zip(truth, found)]))
+
+
+def bench_offline(doc_vectors: np.ndarray, query_vectors: np.ndarray, truth: np.ndarray, top_k: int) -> dict:
+    """クライアント側でint8に量子化したベクトルの全件検索 (ES の element_type: byte の全件検索に相当)"""
+    from embedding import quantize_int8
+
+    docs_q = np.asarray(quantize_int8(doc_vectors), dtype=np.float32)
+    queries_q = np.asarray(quantize_int8(query_vectors), dtype=np.float32)
+    found = exact_top_k(docs_q, queries_q, top_k)
+    return {
+        "recall_at_k": recall(truth, found, top_k),
+        "bytes_per_vector": {"float": doc_vectors.shape[1] * 4, "byte": doc_vectors.shape[1]},
+    }
+
+
+async def bench_elasticsearch(
+    chunks: list, doc_vectors: np.ndarray, query_vectors: np.ndarray, truth: np.ndarray,
+    top_k: int, num_candidates: int, index_prefix: str,
+) -> dict:
+    """float / int8_hnsw / byte のインデックスを作成し、kNN検索の再現率とインデックスのサイズを比較する"""
+    import elasticsearch_client as client
+    from embedding import quantize_int8
+
+    results = {}
+    try:
+        for vector_type in client.VECTOR_TYPES:
+            index_name = f"{index_prefix}-{vector_type}"
+            if await client.index_exists(index_name):
+                await client.es.indices.delete(index=index_name)
+            await client.create_index(index_name, vector_type=vector_type)
+            vectors = quantize_int8(doc_vectors) if vector_type == "byte" else doc_vectors.tolist()
+            documents = ({"id": str(i), "content": c, "embedding": v} for i, (c, v) in enumerate(zip(chunks, vectors)))
+            await client.bulk_add_documents(index_name, documents)
+            await client.es.indices.refresh(index=index_name)
+            # セグメントを1つにまとめてからサイズを比較する
+            await client.es.indices.forcemerge(index=index_name, max_num_segments=1)
+            stats = await client.es.indices.stats(index=index_name, metric="store")
+            size = stats["_all"]["primaries"]["store"]["size_in_bytes"]
+
+            found = []
+            latencies = []
+            for query in query_vectors.tolist():
+                started = time.perf_counter()
+                hits = await client.search_similar(query, top_k, index_name, mode="knn", num_candidates=num_candidates)
+                latencies.append((time.perf_counter() - started) * 1000)
+                found.append([int(hit["id"]) for hit in hits])
+            results[vector_type] = {
+                "recall_at_k": recall(truth, found, top_k),
+                "store_size_bytes": size,
+                "p50_ms": float(np.percentile(latencies, 50)),
+                "p95_ms": float(np.percentile(latencies, 95)),
+            }
+            print(f"{vector_type}: {results[vector_type]}")
+    finally:
+        await client.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", nargs="*", default=[], help="チャンク分割して登録するテキストファイル")
+    parser.add_argument("--queries", help="質問を1行に1つ書いたファイル (省略時はチャンクの一部を質問に使う)")
+    parser.add_argument("--synthetic", type=int, default=0, help="埋め込みの代わりに使う乱数のベクトルの件数")
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--num-candidates", type=int, default=100)
+    parser.add_argument("--es", action="store_true", help="Elasticsearch のインデックスでも比較する")
+    parser.add_argument("--index-prefix", default="bench-quantization")
+    parser.add_argument("--output", default="bench_quantization.json")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        doc_vectors, query_vectors = synthetic_vectors(args.synthetic, args.num_queries)
+        chunks = [f"synthetic-{i}" for i in range(len(doc_vectors))]
+    else:
+        from embedding import embed_texts
+
+        chunks = load_chunks(args.docs)
+        if not chunks:
+            parser.error("--docs または --synthetic を指定してください")
+        if args.queries:
+            with open(args.queries, encoding="utf-8") as f:
+                queries = [line.strip() for line in f if line.strip()]
+        else:
+            # 質問がない場合は、等間隔に選んだチャンクの前半を質問として使う
+            step = max(len(chunks) // args.num_queries, 1)
+            queries = [chunk[: len(chunk) // 2] for chunk in chunks[::step][: args.num_queries]]
+        doc_vectors = np.asarray(embed_texts(chunks, use_cache=False), dtype=np.float32)
+        query_vectors = np.asarray(embed_texts(queries, use_cache=False), dtype=np.float32)
+
+    truth = exact_top_k(doc_vectors, query_vectors, args.top_k)
+    report = {
+        "docs": len(doc_vectors),
+        "queries": len(query_vectors),
+        "top_k": args.top_k,
+        "source": "synthetic" if args.synthetic else "embedding",
+        "offline_int8": bench_offline(doc_vectors, query_vectors, truth, args.top_k),
+    }
+    print(f"offline int8: {report['offline_int8']}")
+    if args.es:
+        report["elasticsearch"] = asyncio.run(bench_elasticsearch(
+            chunks, doc_vectors, query_vectors, truth, args.top_k, args.num_candidates, args.index_prefix
+        ))
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"結果を {args.output} に保存しました。")
+
+
+if __name__ == "__main__":
+    main()
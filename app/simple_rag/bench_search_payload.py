@@ -0,0 +1,132 @@
+"""
+検索レスポンスのサイズ・往復時間・パース時間を、_source の絞り込みと filter_path の有無で比較するスクリプト
+
+    # Elasticsearch のインデックスに対して kNN と BM25 の検索で比較
+    python bench_search_payload.py --index test --question "日本の首都は？" --top-k 50
+    # Elasticsearch を使わず、同じ形式のレスポンスを生成してサイズとパース時間だけを比較
+    python bench_search_payload.py --synthetic --top-k 50
+
+- before: 変更前の検索 (_source 全体 = 埋め込みを含む、レスポンスの絞り込みなし)
+- after: elasticsearch_client.run_search と同じ検索 (_source は SEARCH_SOURCE_FIELDS のみ、filter_path で絞り込み)
+"""
+import argparse
+import json
+import statistics
+import time
+import urllib.request
+
+import numpy as np
+
+from elasticsearch_client import ES_URL, SEARCH_FILTER_PATH, SEARCH_SOURCE_FIELDS, knn_query
+
+EMBEDDING_DIM = 384
+
+
+def measure_parse(body: bytes, repeat: int) -> float:
+    """レスポンスの本文を json.loads するのにかかる時間の中央値(ミリ秒)"""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        json.loads(body)
+        times.append((time.perf_counter() - started) * 1000)
+    return statistics.median(times)
+
+
+def post_search(index_name: str, body: dict, filter_path: list = None) -> tuple:
+    url = f"{ES_URL}/{index_name}/_search"
+    if filter_path:
+        url += "?filter_path=" + ",".join(filter_path)
+    request = urllib.request.Request(
+        url, data=json.dumps(body).encode("utf-8"), headers={"Content-Type": "application/json"}, method="POST"
+    )
+    started = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        payload = response.read()
+    return payload, (time.perf_counter() - started) * 1000
+
+
+def bench_elasticsearch(index_name: str, question: str, top_k: int, repeat: int) -> dict:
+    from embedding import embed_texts
+
+    embedding = embed_texts([question], use_cache=False)[0]
+    searches = {
+        "knn": {"knn": knn_query(embedding, top_k), "size": top_k},
+        "bm25": {"query": {"match": {"content": question}}, "size": top_k},
+    }
+    report = {}
+    for name, body in searches.items():
+        variants = {
+            "before": (body, None),
+            "after": ({**body, "_source": SEARCH_SOURCE_FIELDS}, SEARCH_FILTER_PATH),
+        }
+        report[name] = {}
+        for variant, (variant_body, filter_path) in variants.items():
+            post_search(index_name, variant_body, filter_path)  # ウォームアップ
+            latencies = []
+            for _ in range(repeat):
+                payload, elapsed_ms = post_search(index_name, variant_body, filter_path)
+                latencies.append(elapsed_ms)
+            report[name][variant] = {
+                "bytes": len(payload),
+                "hits": len(json.loads(payload).get("hits", {}).get("hits", [])),
+                "round_trip_ms_p50": statistics.median(latencies),
+                "parse_ms_p50": measure_parse(payload, repeat),
+            }
+    return report
+
+
+def bench_synthetic(top_k: int, repeat: int) -> dict:
+    """Elasticsearch の検索レスポンスと同じ形式の本文を生成して比較する"""
+    rng = np.random.default_rng(0)
+
+    def hit(i: int, with_embedding: bool) -> dict:
+        source = {
+            "content": "東京は日本の首都です。大阪は食の都です。" * 2, "source": "sample.txt", "doc_id": "0" * 64,
+            "start": i * 40, "end": i * 40 + 40,
+        }
+        if with_embedding:
+            source["embedding"] = [float(x) for x in rng.standard_normal(EMBEDDING_DIM).astype(np.float32) / 20]
+            return {"_index": "test", "_id": f"{i:064x}", "_score": 0.9 - i / 1000, "_source": source}
+        return {"_id": f"{i:064x}", "_score": 0.9 - i / 1000, "_source": {key: source[key] for key in SEARCH_SOURCE_FIELDS}}
+
+    before = {
+        "took": 3, "timed_out": False,
+        "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+        "hits": {"total": {"value": top_k, "relation": "eq"}, "max_score": 0.9, "hits": [hit(i, True) for i in range(top_k)]},
+    }
+    after = {"hits": {"hits": [hit(i, False) for i in range(top_k)]}}
+    report = {}
+    for variant, body in (("before", before), ("after", after)):
+        payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        report[variant] = {"bytes": len(payload), "hits": top_k, "parse_ms_p50": measure_parse(payload, repeat)}
+    return {"synthetic": report}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--index", default="test")
+    parser.add_argument("--question", default="日本の首都は？")
+    parser.add_argument("--top-k", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--synthetic", action="store_true", help="Elasticsearch を使わずに生成したレスポンスで比較する")
+    parser.add_argument("--output", default="bench_search_payload.json")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        report = bench_synthetic(args.top_k, args.repeat)
+    else:
+        report = bench_elasticsearch(args.index, args.question, args.top_k, args.repeat)
+
+    for name, variants in report.items():
+        before, after = variants["before"], variants["after"]
+        print(
+            f"{name}: {before['bytes']:,} → {after['bytes']:,} バイト ({before['bytes'] / after['bytes']:.1f}倍), "
+            f"パース {before['parse_ms_p50']:.3f} → {after['parse_ms_p50']:.3f} ms"
+        )
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"top_k": args.top_k, "results": report}, f, ensure_ascii=False, indent=2)
+    print(f"結果を {args.output} に保存しました。")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,38 @@
-from elasticsearch import Elasticsearch
+import asyncio
+import base64
+import copy
+import json
+import os
+import time
+from elasticsearch import AsyncElasticsearch
 from elasticsearch.exceptions import NotFoundError
+from elasticsearch.helpers import async_streaming_bulk
+from fusion import FUSION_METHODS, HYBRID_WINDOW_SIZE, fuse_results
 from chunk import chunking
+from embedding import quantize_int8
 
 ES_COMPAT_VERSION = "8"  # Elasticsearch 8系なので8を指定
-ES_URL = "http://localhost:9200"
+ES_URL = os.environ.get("ES_URL", "http://localhost:9200")  # 環境変数 ES_URL で変更できる
+
+# 接続の設定
+ES_NODE_CLASS = "httpxasync"  # httpx で通信する (aiohttp をインストールした場合は "aiohttp" も使える)
+ES_MAX_CONNECTIONS = 16  # コネクションプールの最大接続数 (同時に送信中にできるリクエスト数)
+ES_REQUEST_TIMEOUT = 30.0  # 応答待ちタイムアウト(秒)
+ES_MAX_RETRIES = 3  # 接続エラー・タイムアウト時の再試行回数
 
 # Elasticsearchクライアント初期化（互換モード対応）
-es = Elasticsearch(
+# イベントループをブロックしない非同期クライアント。接続はプールで使い回し、アプリの終了時に close() で閉じる
+es = AsyncElasticsearch(
     ES_URL,
     headers={
         "Accept": f"application/vnd.elasticsearch+json; compatible-with={ES_COMPAT_VERSION}",
         "Content-Type": f"application/vnd.elasticsearch+json; compatible-with={ES_COMPAT_VERSION}"
-    }
+    },
+    node_class=ES_NODE_CLASS,
+    connections_per_node=ES_MAX_CONNECTIONS,
+    request_timeout=ES_REQUEST_TIMEOUT,
+    max_retries=ES_MAX_RETRIES,
+    retry_on_timeout=True,
 )
 
 
@@ -20,6 +41,11 @@ mapping = {
     "mappings": {
         "properties": {
             "content": {"type": "text"},
+            "source": {"type": "keyword"},  # チャンクの元ドキュメント名
+            "doc_id": {"type": "keyword"},  # 元ドキュメントの内容とチャンク分割の設定から作るID (再登録時に以前の版を削除する)
+            # 元ドキュメント内のチャンクの文字の位置 (プロンプトを作るときに隣接・重複するチャンクをつなげる)
+            "start": {"type": "integer", "index": False},
+            "end": {"type": "integer", "index": False},
             "embedding": {
                 "type": "dense_vector",
                 "dims": 384,
@@ -30,17 +56,51 @@ mapping = {
     }
 }
 
-def get_documents(index_name: str, size: int = 10):
+# ベクトルの保存形式
+## float: float32 のまま保存 (1次元あたり4バイト)
+## int8_hnsw: 元のfloatも保存した上で、HNSWグラフをElasticsearch側でint8に量子化して持つ (8.12以降、メモリ約1/4)
+## byte: クライアント側でint8に量子化した値だけを保存 (8.6以降、メモリ・ディスクとも約1/4)
+VECTOR_TYPES = ("float", "int8_hnsw", "byte")
+DEFAULT_VECTOR_TYPE = "float"
+
+# Bulk API によるドキュメント一括登録の設定
+BULK_CHUNK_SIZE = 500  # 1バッチあたりの最大ドキュメント数
+BULK_MAX_CHUNK_BYTES = 10 * 1024 * 1024  # 1バッチあたりの最大バイト数
+BULK_CONCURRENCY = 4  # プロセス全体で同時に送信中にできるバッチ数 (登録ジョブ・呼び出しをまたいで共有する)
+MGET_BATCH_SIZE = 1000  # 登録済みIDの確認で1リクエストに含めるID数
+bulk_semaphore = asyncio.Semaphore(BULK_CONCURRENCY)  # 送信中のバッチ数の上限 (send_bulk の全ての呼び出しで共有)
+
+# 検索結果として受け取るフィールド (埋め込みなど使わないフィールドは転送・パースしない)
+SEARCH_SOURCE_FIELDS = ["content", "source", "doc_id", "start", "end"]
+SEARCH_FILTER_PATH = ["hits.hits._id", "hits.hits._score", "hits.hits._source"]
+MSEARCH_FILTER_PATH = ["responses.took", "responses.error"] + [f"responses.{path}" for path in SEARCH_FILTER_PATH]
+
+# ドキュメントの書き出し(ページ送り)の設定
+EXPORT_PAGE_SIZE = 1000  # 1回の検索で取得するドキュメント数
+EXPORT_KEEP_ALIVE = "5m"  # point-in-time の有効期間 (ページを取得するたびに延長される)
+
+# ベクトル検索の設定
+SEARCH_MODES = ("knn", "exact")
+SEARCH_MODE = "knn"  # "knn": HNSWによる近似検索, "exact": script_scoreによる全件計算
+KNN_NUM_CANDIDATES = 100  # kNN検索で各シャードから集める候補数
+
+async def close():
+    """コネクションプールを閉じる"""
+    await es.close()
+
+async def get_documents(index_name: str, size: int = 10):
     """
     指定インデックスの最初の `size` 件のドキュメントを取得して表示
     """
     try:
-        resp = es.search(
+        resp = await es.search(
             index=index_name,
             query={"match_all": {}},  # 全件取得
-            size=size
+            size=size,
+            source_excludes=["embedding"],  # 埋め込み以外のフィールドを取得
+            filter_path=["hits.hits._source"],
         )
-        hits = resp["hits"]["hits"]
+        hits = search_hits(resp)
         documents = [hit["_source"] for hit in hits]  # _source にドキュメント内容が入る
         # for i, doc in enumerate(documents, 1):
             # print(f"{i}: {doc}")
@@ -49,9 +109,9 @@ def get_documents(index_name: str, size: int = 10):
         print(f"ドキュメント取得時にエラー: {e}")
         return []
 
-def get_document_count(index_name):
+async def get_document_count(index_name):
     try:
-        count_result = es.count(index=index_name)
+        count_result = await es.count(index=index_name)
         # print(count_result)
         # print('---------------')
         doc_count = count_result["count"]
@@ -59,9 +119,9 @@ def get_document_count(index_name):
     except Exception as e:
         print(f"ドキュメント数取得時にエラー: {e}")
 
-def index_exists(index_name: str) -> bool:
+async def index_exists(index_name: str) -> bool:
     try:
-        es.indices.get(index=index_name)
+        await es.indices.get(index=index_name)
         return True
     except NotFoundError:
         return False
@@ -70,23 +130,61 @@ def index_exists(index_name: str) -> bool:
         raise
 
 
+def index_mapping(vector_type: str = DEFAULT_VECTOR_TYPE) -> dict:
+    """ベクトルの保存形式に合わせたマッピングを返す"""
+    if vector_type not in VECTOR_TYPES:
+        raise ValueError(f"vector_type must be one of {VECTOR_TYPES}")
+    body = copy.deepcopy(mapping)
+    embedding = body["mappings"]["properties"]["embedding"]
+    if vector_type == "int8_hnsw":
+        embedding["index_options"] = {"type": "int8_hnsw"}
+    elif vector_type == "byte":
+        embedding["element_type"] = "byte"
+    return body
+
+# インデックスごとのベクトルの保存形式 (マッピングは作成後に変わらないのでキャッシュする)
+_vector_types = {}
+
+async def get_vector_type(index_name: str) -> str:
+    """インデックスのマッピングからベクトルの保存形式を判定する"""
+    if index_name not in _vector_types:
+        resp = await es.indices.get_mapping(index=index_name)
+        for name in resp:
+            props = resp[name]["mappings"]["properties"]["embedding"]
+            if props.get("element_type") == "byte":
+                vector_type = "byte"
+            elif props.get("index_options", {}).get("type") == "int8_hnsw":
+                vector_type = "int8_hnsw"
+            else:
+                vector_type = "float"
+            break
+        _vector_types[index_name] = vector_type
+    return _vector_types[index_name]
+
+async def query_vector_for(index_name: str, embedding: list) -> list:
+    """byte のインデックスには登録時と同じ方法で量子化したクエリのベクトルで検索する"""
+    if await get_vector_type(index_name) == "byte":
+        return quantize_int8([embedding])[0]
+    return embedding
+
 # インデックス作成を index_name パラメータ対応に
-def create_index(index_name: str):
-    if not index_exists(index_name):
+async def create_index(index_name: str, vector_type: str = DEFAULT_VECTOR_TYPE):
+    if not await index_exists(index_name):
         try:
-            es.indices.create(index=index_name, body=mapping)
-            print(f"✅ インデックス '{index_name}' を作成しました。")
+            await es.indices.create(index=index_name, body=index_mapping(vector_type))
+            _vector_types[index_name] = vector_type
+            print(f"✅ インデックス '{index_name}' を作成しました。(ベクトル形式: {vector_type})")
         except Exception as e:
             print(f"❌ インデックス作成時にエラーが発生しました: {e}")
             raise
     else:
         print(f"インデックス '{index_name}' は既に存在します。")
 
-def add_document(index_name: str, id: str, content: str, embedding: list):
-    if index_exists(index_name):
+async def add_document(index_name: str, id: str, content: str, embedding: list):
+    if await index_exists(index_name):
         doc = {"content": content, "embedding": embedding}
         try:
-            es.index(index=index_name, id=id, document=doc)
+            await es.index(index=index_name, id=id, document=doc)
             print(f"ドキュメント {id} をインデックス '{index_name}' に追加しました。")
         except Exception as e:
             print(f"ドキュメント追加時にエラーが発生しました: {e}")
@@ -94,36 +192,265 @@ def add_document(index_name: str, id: str, content: str, embedding: list):
     else:
         print(f"インデックス '{index_name}' は存在しません。")
 
-# 入力クエリとベクトルDBに格納されたIndexの類似度を計算
-def search_similar(embedding: list, top_k: int = 3, index_name: str = "test"):
-    query = {
-        "script_score": {
-            "query": {"match_all": {}},
-            "script": {
-                "source": "cosineSimilarity(params.query_vector, 'embedding') + 1.0",
-                "params": {"query_vector": embedding}
+async def send_bulk(
+    actions: list,
+    chunk_size: int = BULK_CHUNK_SIZE,
+    max_chunk_bytes: int = BULK_MAX_CHUNK_BYTES,
+) -> dict:
+    """
+    Bulk APIのアクションを chunk_size 件ずつのバッチに分けて送信する
+    同時に送信中のバッチ数は全ての呼び出しを合わせて BULK_CONCURRENCY 個まで
+    (登録ジョブは複数のバッチの書き込みを並行して呼び出すため、上限まで並行して送信できる)
+    :param actions: async_streaming_bulk に渡すアクションのリスト
+    :param chunk_size: 1バッチあたりの最大ドキュメント数
+    :param max_chunk_bytes: 1バッチあたりの最大バイト数
+    :return: {"success": 成功件数, "errors": [{"id": ..., "status": ..., "error": ...}, ...]}
+    """
+    options = {
+        "chunk_size": chunk_size,
+        "max_chunk_bytes": max_chunk_bytes,
+        "raise_on_error": False,  # 失敗したドキュメントは結果として受け取る
+        "raise_on_exception": False,
+    }
+
+    async def send(batch: list) -> list:
+        async with bulk_semaphore:
+            return [result async for result in async_streaming_bulk(es, batch, **options)]
+
+    batches = [actions[start:start + chunk_size] for start in range(0, len(actions), chunk_size)]
+    results = await asyncio.gather(*(send(batch) for batch in batches))
+
+    success = 0
+    errors = []
+    for ok, item in (result for batch_results in results for result in batch_results):
+        if ok:
+            success += 1
+            continue
+        # item は {"index": {"_id": ..., "status": ..., "error": ...}} の形式
+        op_result = next(iter(item.values()))
+        error = op_result.get("error")
+        errors.append({
+            "id": op_result.get("_id"),
+            "status": op_result.get("status"),
+            "error": error if isinstance(error, dict) else str(error),
+        })
+    return {"success": success, "errors": errors}
+
+async def bulk_add_documents(
+    index_name: str,
+    documents,
+    chunk_size: int = BULK_CHUNK_SIZE,
+    max_chunk_bytes: int = BULK_MAX_CHUNK_BYTES,
+) -> dict:
+    """
+    Bulk APIを用いてドキュメントをまとめて登録する
+    :param index_name: 登録先のインデックス (存在確認は呼び出し側で1回だけ行う)
+    :param documents: {"id": ..., "content": ..., "embedding": ...} 形式の辞書のイテラブル
+    :param chunk_size: 1バッチあたりの最大ドキュメント数
+    :param max_chunk_bytes: 1バッチあたりの最大バイト数
+    :return: {"success": 成功件数, "errors": [{"id": ..., "status": ..., "error": ...}, ...]}
+    """
+    actions = [
+        {
+            "_op_type": "index",
+            "_index": index_name,
+            "_id": doc["id"],
+            "_source": {key: value for key, value in doc.items() if key != "id"},
+        }
+        for doc in documents
+    ]
+    result = await send_bulk(actions, chunk_size, max_chunk_bytes)
+    print(f"インデックス '{index_name}' に {result['success']} 件のドキュメントを登録しました (失敗: {len(result['errors'])} 件)。")
+    return result
+
+async def bulk_update_documents(
+    index_name: str,
+    documents,
+    chunk_size: int = BULK_CHUNK_SIZE,
+    max_chunk_bytes: int = BULK_MAX_CHUNK_BYTES,
+) -> dict:
+    """
+    Bulk APIを用いて登録済みドキュメントの一部のフィールドだけをまとめて更新する (埋め込みは送り直さない)
+    :param index_name: 更新対象のインデックス
+    :param documents: {"id": ..., 更新するフィールド: 値, ...} 形式の辞書のイテラブル
+    :param chunk_size: 1バッチあたりの最大ドキュメント数
+    :param max_chunk_bytes: 1バッチあたりの最大バイト数
+    :return: {"success": 成功件数, "errors": [{"id": ..., "status": ..., "error": ...}, ...]}
+    """
+    actions = [
+        {
+            "_op_type": "update",
+            "_index": index_name,
+            "_id": doc["id"],
+            "doc": {key: value for key, value in doc.items() if key != "id"},
+        }
+        for doc in documents
+    ]
+    result = await send_bulk(actions, chunk_size, max_chunk_bytes)
+    print(f"インデックス '{index_name}' の {result['success']} 件のドキュメントを更新しました (失敗: {len(result['errors'])} 件)。")
+    return result
+
+async def existing_documents(index_name: str, ids: list, fields: list, batch_size: int = MGET_BATCH_SIZE) -> dict:
+    """
+    指定したIDのうちインデックスに登録済みのものを、指定したフィールドの値と合わせて返す
+    :param index_name: 確認対象のインデックス
+    :param ids: 確認するドキュメントIDのリスト
+    :param fields: 取得するフィールド (埋め込みなど大きいフィールドは含めない)
+    :param batch_size: 1回の mget に含めるID数
+    :return: {ID: {フィールド: 値, ...}} 形式の辞書 (未登録のIDは含まない)
+    """
+    found = {}
+    try:
+        for start in range(0, len(ids), batch_size):
+            resp = await es.mget(index=index_name, ids=ids[start:start + batch_size], source=fields)
+            found.update((doc["_id"], doc.get("_source", {})) for doc in resp["docs"] if doc.get("found"))
+    except Exception as e:
+        print(f"登録済みID確認時にエラーが発生しました: {e}")
+        raise
+    return found
+
+async def delete_stale_chunks(index_name: str, source: str, doc_id: str) -> int:
+    """
+    source のチャンクのうち doc_id が異なるもの (同じ名前で以前に登録した版) を delete_by_query で削除する
+    :return: 削除したチャンク数
+    """
+    try:
+        resp = await es.delete_by_query(
+            index=index_name,
+            query={"bool": {"filter": [{"term": {"source": source}}], "must_not": [{"term": {"doc_id": doc_id}}]}},
+            conflicts="proceed",
+            refresh=True,  # 削除したチャンクが直後の検索で返らないようにする
+        )
+    except Exception as e:
+        print(f"以前の版のチャンクの削除時にエラーが発生しました: {e}")
+        raise
+    return resp["deleted"]
+
+def encode_cursor(pit_id: str, search_after: list) -> str:
+    """point-in-time のIDと最後のドキュメントのソート値を、URLに含められる文字列にする"""
+    state = json.dumps({"pit": pit_id, "after": search_after}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(state.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return state["pit"], state["after"]
+    except Exception:
+        raise ValueError("カーソルの形式が正しくありません")
+
+async def export_page(
+    index_name: str,
+    cursor: str = None,
+    size: int = EXPORT_PAGE_SIZE,
+    keep_alive: str = EXPORT_KEEP_ALIVE,
+) -> tuple:
+    """
+    point-in-time と search_after で、インデックスのドキュメントを先頭から size 件ずつ取得する
+    検索中に登録されたドキュメントの影響を受けず、件数の上限(10,000件)なしに全件を取得できる
+    :param cursor: 前のページで返されたカーソル (None なら point-in-time を開いて先頭から取得する)
+    :return: ([{"id": ..., "content": ...}, ...], 次のページのカーソル (最後のページなら None))
+    """
+    if cursor is None:
+        pit_id = (await es.open_point_in_time(index=index_name, keep_alive=keep_alive))["id"]
+        search_after = None
+    else:
+        pit_id, search_after = decode_cursor(cursor)
+
+    options = {"search_after": search_after} if search_after else {}
+    try:
+        resp = await es.search(
+            pit={"id": pit_id, "keep_alive": keep_alive},
+            sort=["_shard_doc"],  # point-in-time 内で一意になる最も軽いソート
+            size=size,
+            source_includes=["content"],  # 埋め込みは返さない
+            track_total_hits=False,
+            filter_path=["pit_id", "hits.hits._id", "hits.hits._source", "hits.hits.sort"],
+            **options,
+        )
+    except NotFoundError as e:
+        if cursor is not None:
+            raise ValueError(f"カーソルの有効期限が切れています。先頭から取得し直してください: {e}")
+        raise
+
+    hits = search_hits(resp)
+    pit_id = resp.get("pit_id", pit_id)  # point-in-time のIDは検索ごとに変わることがある
+    docs = [{"id": hit["_id"], "content": hit["_source"]["content"]} for hit in hits]
+    if len(hits) < size:
+        # 最後のページを返したら point-in-time を閉じる
+        await es.close_point_in_time(id=pit_id)
+        return docs, None
+    return docs, encode_cursor(pit_id, hits[-1]["sort"])
+
+def search_hits(resp) -> list:
+    """検索結果のヒットのリスト (filter_path で絞り込んだ場合、ヒットがなければ hits 自体が返らない)"""
+    return resp.get("hits", {}).get("hits", [])
+
+def hit_to_doc(hit: dict) -> dict:
+    """ヒットを {"id": ..., "content": ..., "score": ..., "source": ..., "doc_id": ..., "start": ..., "end": ...} に変換する (古いチャンクは持たないフィールドがある)"""
+    return {"id": hit["_id"], **hit["_source"], "score": hit["_score"]}
+
+async def run_search(index_name: str, size: int, **body) -> list:
+    """
+    検索を実行し、[{"id": ..., "content": ..., "score": ..., "source": ..., "start": ..., "end": ...}, ...] を返す
+    _source は SEARCH_SOURCE_FIELDS のみ、レスポンスは filter_path で必要なフィールドだけに絞り込む
+    """
+    resp = await es.search(
+        index=index_name, size=size, source=SEARCH_SOURCE_FIELDS, filter_path=SEARCH_FILTER_PATH, **body
+    )
+    return [hit_to_doc(hit) for hit in search_hits(resp)]
+
+def knn_query(embedding: list, top_k: int, num_candidates: int = KNN_NUM_CANDIDATES) -> dict:
+    """トップレベルの knn 検索の条件"""
+    return {
+        "field": "embedding",
+        "query_vector": embedding,
+        "k": top_k,
+        "num_candidates": max(num_candidates, top_k),
+    }
+
+def vector_search_body(embedding: list, top_k: int, mode: str = SEARCH_MODE, num_candidates: int = KNN_NUM_CANDIDATES) -> dict:
+    """ベクトル検索のリクエストの本文 (run_search のキーワード引数・_msearch の検索に使う)"""
+    if mode == "knn":
+        # mapping の dense_vector (index: True) に構築されたHNSWグラフを使用
+        return {"knn": knn_query(embedding, top_k, num_candidates)}
+    # 小規模なインデックスや再現率の確認用に全件を総当たりで計算
+    return {
+        "query": {
+            "script_score": {
+                "query": {"match_all": {}},
+                "script": {
+                    "source": "cosineSimilarity(params.query_vector, 'embedding') + 1.0",
+                    "params": {"query_vector": embedding}
+                }
             }
         }
     }
+
+# 入力クエリとベクトルDBに格納されたIndexの類似度を計算
+async def search_similar(
+    embedding: list,
+    top_k: int = 3,
+    index_name: str = "test",
+    mode: str = SEARCH_MODE,
+    num_candidates: int = KNN_NUM_CANDIDATES,
+):
+    """
+    :param mode: "knn" はHNSWによる近似kNN検索、"exact" は script_score による全件のコサイン類似度計算
+    :param num_candidates: kNN検索で各シャードから集める候補数 (大きいほど再現率が上がり遅くなる)
+    """
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"mode must be one of {SEARCH_MODES}")
+
     try:
-        resp = es.search(index=index_name, query=query, size=top_k)
-        hits = resp["hits"]["hits"]
-
-        # content と score の両方を返す
-        results = [
-            {
-                "content": hit["_source"]["content"],
-                "score": hit["_score"]  # 類似度スコア
-            }
-            for hit in hits
-        ]
-        return results
+        embedding = await query_vector_for(index_name, embedding)
+        # content と score (類似度スコア) を返す
+        return await run_search(index_name, top_k, **vector_search_body(embedding, top_k, mode, num_candidates))
 
     except Exception as e:
         print(f"類似検索時にエラーが発生しました: {e}")
         raise
 
-def search_bm25(query_text: str, top_k: int = 5, index_name: str = "test"):
+async def search_bm25(query_text: str, top_k: int = 5, index_name: str = "test"):
     """
     BM25による全文検索
     :param query_text: 検索クエリ文字列
@@ -140,22 +467,12 @@ def search_bm25(query_text: str, top_k: int = 5, index_name: str = "test"):
     }
     
     try:
-        resp = es.search(index=index_name, query=bm25_query, size=top_k)
-        hits = resp["hits"]["hits"]
-
-        results = [
-            {
-                "content": hit["_source"]["content"],
-                "score": hit["_score"]  # BM25スコア
-            }
-            for hit in hits
-        ]
-        return results
+        return await run_search(index_name, top_k, query=bm25_query)  # score はBM25スコア
     except Exception as e:
         print(f"BM25検索時にエラーが発生しました: {e}")
         raise
     
-def search_keyword(keyword: str, top_k: int = 5, index_name: str = "test"):
+async def search_keyword(keyword: str, top_k: int = 5, index_name: str = "test"):
     """
     キーワード検索（完全一致に近い検索）
     :param keyword: 検索キーワード
@@ -172,37 +489,162 @@ def search_keyword(keyword: str, top_k: int = 5, index_name: str = "test"):
     }
 
     try:
-        resp = es.search(index=index_name, query=keyword_query, size=top_k)
-        hits = resp["hits"]["hits"]
+        return await run_search(index_name, top_k, query=keyword_query)  # score はキーワード検索スコア
+    except Exception as e:
+        print(f"キーワード検索時にエラーが発生しました: {e}")
+        raise
 
-        results = [
-            {
-                "content": hit["_source"]["content"],
-                "score": hit["_score"]  # キーワード検索スコア
-            }
-            for hit in hits
+def hybrid_searches(index_name: str, query_text: str, embedding: list, size: int, num_candidates: int) -> list:
+    """1件の質問のBM25とkNNの検索 (_msearch のヘッダーと本文の組)"""
+    return [
+        {"index": index_name},
+        {"query": {"match": {"content": {"query": query_text}}}, "size": size, "_source": SEARCH_SOURCE_FIELDS},
+        {"index": index_name},
+        {"knn": knn_query(embedding, size, num_candidates), "size": size, "_source": SEARCH_SOURCE_FIELDS},
+    ]
+
+def fuse_hybrid_responses(responses: list, top_k: int, fusion: str, timings: dict) -> dict:
+    """
+    hybrid_searches の2件の検索のレスポンスを統合する
+    :param timings: 検索ごとの処理時間を加える辞書
+    :return: {"docs": [...], "timings": timings}
+    """
+    result_lists = {}
+    for name, sub_resp in zip(("bm25", "vector"), responses):
+        if "error" in sub_resp:
+            # 片方の検索が失敗しても、もう片方の結果で回答できるようにする
+            print(f"ハイブリッド検索({name})でエラーが発生しました: {sub_resp['error']}")
+            result_lists[name] = []
+            continue
+        timings[f"{name}_ms"] = sub_resp["took"]  # Elasticsearch側の処理時間
+        result_lists[name] = [
+            hit_to_doc(hit) for hit in search_hits(sub_resp)
         ]
-        return results
+    if all("error" in sub_resp for sub_resp in responses):
+        raise RuntimeError(f"ハイブリッド検索の全ての検索が失敗しました: {responses[0]['error']}")
+
+    return {"docs": fuse_results(result_lists, top_k, method=fusion), "timings": timings}
+
+async def search_hybrid(
+    query_text: str,
+    embedding: list,
+    top_k: int = 3,
+    index_name: str = "test",
+    fusion: str = "rrf",
+    num_candidates: int = KNN_NUM_CANDIDATES,
+    window_size: int = HYBRID_WINDOW_SIZE,
+) -> dict:
+    """
+    BM25とkNNの検索を1回の _msearch リクエストで実行し、結果を統合する
+    :param query_text: BM25検索に使用するクエリ文字列
+    :param embedding: kNN検索に使用するクエリのベクトル
+    :param fusion: "rrf" または "weighted"
+    :param window_size: 統合前に各検索から取得する件数 (top_k より小さい場合は top_k)
+    :return: {"docs": [{'id': ..., 'content': ..., 'score': ...}, ...], "timings": {"bm25_ms": ..., "vector_ms": ..., "msearch_ms": ...}}
+    """
+    if fusion not in FUSION_METHODS:
+        raise ValueError(f"fusion must be one of {FUSION_METHODS}")
+
+    size = max(window_size, top_k)
+    embedding = await query_vector_for(index_name, embedding)
+    try:
+        started = time.perf_counter()
+        resp = await es.msearch(
+            searches=hybrid_searches(index_name, query_text, embedding, size, num_candidates),
+            filter_path=MSEARCH_FILTER_PATH,
+        )
+        elapsed_ms = (time.perf_counter() - started) * 1000
     except Exception as e:
-        print(f"キーワード検索時にエラーが発生しました: {e}")
+        print(f"ハイブリッド検索時にエラーが発生しました: {e}")
         raise
 
+    # msearch全体の往復時間
+    return fuse_hybrid_responses(resp["responses"], top_k, fusion, {"msearch_ms": elapsed_ms})
+
+async def search_batch(
+    query_texts: list,
+    embeddings: list,
+    top_k: int = 3,
+    index_name: str = "test",
+    retrieval_mode: str = "vector",
+    mode: str = SEARCH_MODE,
+    fusion: str = "rrf",
+    num_candidates: int = KNN_NUM_CANDIDATES,
+    window_size: int = HYBRID_WINDOW_SIZE,
+) -> list:
+    """
+    複数の質問の検索を1回の _msearch リクエストで実行する
+    retrieval_mode が "hybrid" の場合は質問ごとにBM25とkNNの検索を含め、質問ごとに統合する
+    一部の質問の検索が失敗しても、その質問の error に理由を入れて他の質問の結果を返す
+    :param query_texts: 質問の文字列のリスト (BM25検索に使用)
+    :param embeddings: 質問のベクトルのリスト (query_texts と同じ順)
+    :return: 質問の順に [{"docs": [...], "timings": {...}, "error": 失敗した場合の理由 (成功した場合は None)}, ...]
+    """
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"mode must be one of {SEARCH_MODES}")
+    if fusion not in FUSION_METHODS:
+        raise ValueError(f"fusion must be one of {FUSION_METHODS}")
+    if not query_texts:
+        return []
+
+    hybrid = retrieval_mode == "hybrid"
+    size = max(window_size, top_k) if hybrid else top_k
+    if await get_vector_type(index_name) == "byte":
+        # query_vector_for と同じ量子化を全ての質問にまとめて行う
+        embeddings = quantize_int8(embeddings)
+    searches = []
+    for query_text, embedding in zip(query_texts, embeddings):
+        if hybrid:
+            searches.extend(hybrid_searches(index_name, query_text, embedding, size, num_candidates))
+        else:
+            searches.append({"index": index_name})
+            searches.append({**vector_search_body(embedding, size, mode, num_candidates), "size": size, "_source": SEARCH_SOURCE_FIELDS})
+    try:
+        started = time.perf_counter()
+        resp = await es.msearch(searches=searches, filter_path=MSEARCH_FILTER_PATH)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+    except Exception as e:
+        print(f"一括検索時にエラーが発生しました: {e}")
+        raise
+
+    per_query = 2 if hybrid else 1
+    results = []
+    for i in range(len(query_texts)):
+        responses = resp["responses"][i * per_query:(i + 1) * per_query]
+        timings = {"msearch_ms": elapsed_ms}  # 全ての質問をまとめたmsearchの往復時間
+        if hybrid:
+            try:
+                results.append({**fuse_hybrid_responses(responses, top_k, fusion, timings), "error": None})
+            except RuntimeError as e:
+                results.append({"docs": [], "timings": timings, "error": str(e)})
+        elif "error" in responses[0]:
+            print(f"一括検索({i + 1}件目)でエラーが発生しました: {responses[0]['error']}")
+            results.append({"docs": [], "timings": timings, "error": f"検索に失敗しました: {responses[0]['error']}"})
+        else:
+            timings["vector_ms"] = responses[0]["took"]  # Elasticsearch側の処理時間
+            results.append({"docs": [hit_to_doc(hit) for hit in search_hits(responses[0])], "timings": timings, "error": None})
+    return results
+
 if __name__ == '__main__':
     from embedding import embed_texts
-    
-    # # test_data = ["総理大臣の名前は齋藤一樹です。", "今日の昼ごはんはカツ丼でした。","好きな食べ物はお寿司です。", "趣味はサッカー観戦です。", "東京都に住んでいます。", "生まれは岩手県一関市です。" ]
-    # embed_data = embed_texts(test_data)
-    # # create_index("test01")
-    input_data = ["今日の昼ごはんは？"]
-    embed_input_data = embed_texts(input_data)
-    search_result = search_similar(embed_input_data[0], top_k = 6, index_name = "test02")
-    print(search_result)
-    # # print(get_document_count("test"))
-    # print(len(get_documents('test02')))
-    
-    bm25_results = search_bm25("夏に食べたくなるものは？", top_k=3, index_name="test")
-    for r in bm25_results:
-        print(r["score"], r["content"])
-    # keyword_results = search_keyword("夏は冷たいものが食べたくなります。", top_k=3, index_name="test")
-    # for r in keyword_results:
-    #     print(r["score"], r["content"])
\ No newline at end of file
+
+    async def main():
+        # # test_data = ["総理大臣の名前は齋藤一樹です。", "今日の昼ごはんはカツ丼でした。","好きな食べ物はお寿司です。", "趣味はサッカー観戦です。", "東京都に住んでいます。", "生まれは岩手県一関市です。" ]
+        # embed_data = embed_texts(test_data)
+        # # await create_index("test01")
+        input_data = ["今日の昼ごはんは？"]
+        embed_input_data = embed_texts(input_data)
+        search_result = await search_similar(embed_input_data[0], top_k = 6, index_name = "test02")
+        print(search_result)
+        # # print(await get_document_count("test"))
+        # print(len(await get_documents('test02')))
+
+        bm25_results = await search_bm25("夏に食べたくなるものは？", top_k=3, index_name="test")
+        for r in bm25_results:
+            print(r["score"], r["content"])
+        # keyword_results = await search_keyword("夏は冷たいものが食べたくなります。", top_k=3, index_name="test")
+        # for r in keyword_results:
+        #     print(r["score"], r["content"])
+        await close()
+
+    asyncio.run(main())
\ No newline at end of file
@@ -1,9 +1,317 @@
+import asyncio
+import copy
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+from queue import Empty, Queue
+
+import numpy as np
 from sentence_transformers import SentenceTransformer
 
+from model_registry import registry
+
 # Hugging Faceの埋め込み用公開モデルを指定
 ## all-MiniLM-L6-v2は384 次元の密ベクトルに変換するモデル
-model = SentenceTransformer("all-MiniLM-L6-v2")
+MODEL_NAME = "all-MiniLM-L6-v2"
+WARMUP_TEXTS = ["ウォームアップ用の文です。"]  # 起動時に試しに埋め込むテキスト
+
+# 埋め込みの実行方式
+## torch: PyTorch のまま実行 (既定)
+## torch_int8: Linear層を動的int8量子化したPyTorchのモデルをCPUで実行
+## onnx: ONNXに変換したモデルを ONNX Runtime で実行 (初回の読み込み時に変換する)
+## onnx_int8: 動的int8量子化済みのONNXモデルを ONNX Runtime で実行
+EMBEDDING_BACKENDS = ("torch", "torch_int8", "onnx", "onnx_int8")
+EMBEDDING_BACKEND = "torch"
+EMBEDDING_THREADS = 0  # 1回の推論に使うスレッド数(intra-op)。0はライブラリの既定値
+ONNX_INT8_FILE = "onnx/model_qint8_avx2.onnx"  # 量子化済みのONNXモデル (CPUに合わせて model_qint8_avx512_vnni.onnx なども選べる)
+
+# クエリ埋め込みキャッシュの設定
+EMBEDDING_CACHE_SIZE = 10000  # キャッシュする埋め込みの最大件数 (0で無効)
+
+# クエリ埋め込みのマイクロバッチ設定
+BATCH_MAX_SIZE = 32  # 1回のencodeにまとめる最大件数
+BATCH_MAX_WAIT_MS = 2.0  # 先頭の要求を受けてから後続の要求を待つ最大時間(ミリ秒)
+
+
+class EmbeddingCache:
+    """
+    正規化したテキストとモデル名をキーに埋め込みを保持するLRUキャッシュ
+    max_size を超えた分は最も長く参照されていないものから破棄する
+    """
+
+    def __init__(self, max_size: int = EMBEDDING_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def put(self, key, vector: list):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+embedding_cache = EmbeddingCache()
+
+def load_model(name: str = MODEL_NAME, backend: str = EMBEDDING_BACKEND, threads: int = EMBEDDING_THREADS) -> SentenceTransformer:
+    """指定した実行方式で埋め込みモデルを読み込む"""
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"backend must be one of {EMBEDDING_BACKENDS}")
+
+    if backend in ("torch", "torch_int8"):
+        import torch
+
+        if threads:
+            torch.set_num_threads(threads)
+        if backend == "torch":
+            return SentenceTransformer(name)
+        # 動的量子化はCPUでのみ動作する。重みをint8で持ち、活性化は推論時に量子化する
+        model = SentenceTransformer(name, device="cpu")
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    if threads:
+        options.intra_op_num_threads = threads
+    model_kwargs = {"provider": "CPUExecutionProvider", "session_options": options}
+    if backend == "onnx_int8":
+        model_kwargs["file_name"] = ONNX_INT8_FILE
+    return SentenceTransformer(name, device="cpu", backend="onnx", model_kwargs=model_kwargs)
+
+def get_model() -> SentenceTransformer:
+    """埋め込みモデル (初めて使われたときに読み込み、プロセス内の全モジュールで共有する)"""
+    return registry.get(MODEL_NAME, load_model)
+
+def warmup() -> bool:
+    """埋め込みモデルを読み込み、1回 encode して初回のリクエストの遅延をなくす"""
+    return registry.warmup(MODEL_NAME, load_model, lambda model: model.encode(WARMUP_TEXTS))
+
+# トークン数を数えるためのトークナイザー (チャンク分割で使う)
+_token_counter = None
+_token_counter_lock = threading.Lock()
+
+def count_tokens(texts: list) -> list:
+    """
+    埋め込みモデルのトークナイザーで各テキストのトークン数を数える (特殊トークンを除く)
+    encode はトークナイザーの切り詰め・パディングの設定を変更するため、推論と競合しないよう複製したものを使う
+    """
+    global _token_counter
+    with _token_counter_lock:
+        if _token_counter is None:
+            _token_counter = copy.deepcopy(get_model().tokenizer)
+        return [len(ids) for ids in _token_counter(texts, add_special_tokens=False)["input_ids"]]
+
+# 表記揺れ(全角/半角、前後や連続する空白)を吸収したキャッシュキーを作る
+def normalize_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+def _cache_key(text: str) -> tuple:
+    # 実行方式によって埋め込みがわずかに異なるため、実行方式もキーに含める
+    return (MODEL_NAME, EMBEDDING_BACKEND, normalize_text(text))
+
+def quantize_int8(vectors) -> list:
+    """
+    埋め込みをベクトルごとのスカラー量子化で int8 (-128〜127) の整数に変換する
+    各ベクトルを最大絶対値が127になるように拡大してから丸める。
+    コサイン類似度はベクトルの大きさに依らないため、スケールを保存しなくても類似度の順位はほぼ保たれる
+    """
+    arr = np.asarray(vectors, dtype=np.float32)
+    if arr.size == 0:
+        return []
+    scale = 127.0 / np.maximum(np.abs(arr).max(axis=1, keepdims=True), 1e-12)
+    return np.clip(np.rint(arr * scale), -128, 127).astype(np.int8).tolist()
 
 # Listでテキストを受け取って, 埋め込みを行ったListを返す
-def embed_texts(texts: list)->list:
-    return model.encode(texts).tolist()
\ No newline at end of file
+## use_cache=False はインデックス登録時など、大量のテキストでキャッシュを押し流したくない場合に指定する
+## quantize=True は element_type: byte のインデックスに登録する場合に指定する (キャッシュにはfloatのまま保存する)
+def embed_texts(texts: list, use_cache: bool = True, quantize: bool = False)->list:
+    if not use_cache:
+        vectors = get_model().encode(texts)
+        return quantize_int8(vectors) if quantize else vectors.tolist()
+
+    results = [None] * len(texts)
+    missing = []
+    for i, text in enumerate(texts):
+        results[i] = embedding_cache.get(_cache_key(text))
+        if results[i] is None:
+            missing.append(i)
+
+    if missing:
+        vectors = get_model().encode([texts[i] for i in missing]).tolist()
+        for i, vector in zip(missing, vectors):
+            results[i] = vector
+            embedding_cache.put(_cache_key(texts[i]), vector)
+    return quantize_int8(results) if quantize else results
+
+
+class EmbeddingBatcher:
+    """
+    並行して届いた埋め込み要求を1回の model.encode にまとめて処理する
+    - 処理中に溜まった要求は次のバッチでまとめて処理するため、低負荷時に余計な待ちは発生しない
+    - 複数の要求が溜まっていた場合は max_wait_ms だけ後続の要求を待ってからバッチを締め切る (0なら待たない)
+    """
+
+    def __init__(self, load_model, max_batch_size: int = BATCH_MAX_SIZE, max_wait_ms: float = BATCH_MAX_WAIT_MS):
+        """load_model: encode に使うモデルを返す関数 (モデルの読み込みを最初の要求まで遅らせる)"""
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.load_model = load_model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._requests = 0
+        self._max_batch = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._encode_total = 0.0
+
+    async def embed(self, text: str) -> list:
+        """1件のテキストを埋め込み、そのベクトルを返す (バッチ処理を待つ間もイベントループやスレッドを占有しない)"""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((text, future, time.perf_counter()))
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> dict:
+        """バッチサイズとキュー待ち時間の統計を返す"""
+        with self._stats_lock:
+            batches = self._batches
+            return {
+                "batches": batches,
+                "requests": self._requests,
+                "avg_batch_size": self._requests / batches if batches else 0.0,
+                "max_batch_size": self._max_batch,
+                "avg_queue_wait_ms": self._wait_total / self._requests * 1000 if self._requests else 0.0,
+                "max_queue_wait_ms": self._wait_max * 1000,
+                "avg_encode_ms": self._encode_total / batches * 1000 if batches else 0.0,
+                "queue_depth": self._queue.qsize(),
+                "config": {"max_batch_size": self.max_batch_size, "max_wait_ms": self.max_wait * 1000},
+            }
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._worker_lock:
+            # 初回と、ワーカーが想定外の例外で終了していた場合に起動する
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+
+    @staticmethod
+    def _accept(batch: list, item: tuple):
+        # 待っている間に呼び出し元がキャンセルした要求は埋め込まない (以降はキャンセルできなくなる)
+        if item[1].set_running_or_notify_cancel():
+            batch.append(item)
+
+    def _collect(self) -> list:
+        batch = []
+        while not batch:
+            self._accept(batch, self._queue.get())
+        # 既にキューに溜まっている要求は待たずに取り出す
+        while len(batch) < self.max_batch_size:
+            try:
+                self._accept(batch, self._queue.get_nowait())
+            except Empty:
+                break
+        # 並行する要求が届いている場合のみ、締め切りまで後続の要求を待つ (単発の要求は待たせない)
+        deadline = time.perf_counter() + self.max_wait
+        while 1 < len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                self._accept(batch, self._queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def _run(self):
+        # 1つのバッチの失敗でワーカーが止まると以降の要求が全て待ち続けるため、例外はバッチごとに処理する
+        while True:
+            batch = []
+            try:
+                batch = self._collect()
+                self._process(batch)
+            except Exception as e:
+                print(f"クエリ埋め込みのバッチ処理でエラーが発生しました: {e}")
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _process(self, batch: list):
+        started = time.perf_counter()
+        try:
+            vectors = self.load_model().encode([text for text, _, _ in batch])
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        finished = time.perf_counter()
+
+        for (_, future, _), vector in zip(batch, vectors):
+            future.set_result(vector.tolist())
+
+        waits = [started - enqueued for _, _, enqueued in batch]
+        with self._stats_lock:
+            self._batches += 1
+            self._requests += len(batch)
+            self._max_batch = max(self._max_batch, len(batch))
+            self._wait_total += sum(waits)
+            self._wait_max = max(self._wait_max, max(waits))
+            self._encode_total += finished - started
+
+
+# /query から使用するクエリ埋め込み用のバッチャー
+query_batcher = EmbeddingBatcher(get_model)
+
+# 1件のクエリを埋め込む。キャッシュにない場合は並行するリクエストとまとめて encode される
+async def embed_query(text: str, use_cache: bool = True) -> list:
+    if not use_cache:
+        return await query_batcher.embed(text)
+
+    key = _cache_key(text)
+    vector = embedding_cache.get(key)
+    if vector is None:
+        vector = await query_batcher.embed(text)
+        embedding_cache.put(key, vector)
+    return vector
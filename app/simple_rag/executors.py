@@ -0,0 +1,31 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# CPUを使う処理を実行するスレッド数
+# 埋め込み(PyTorch/ONNX Runtime)とNumPyの計算はGILを解放するため、モデルを共有できるスレッドで実行する
+INGEST_WORKERS = 2  # /index のファイルの読み込み・チャンク分割・埋め込み (1件の登録で分割と埋め込みが並行できる数)
+CPU_WORKERS = 4  # /query 側の計算 (再評価モデル、local バックエンドの検索など)
+
+# 大きなアップロードの埋め込みがクエリ側のスレッドを使い尽くさないよう、実行するスレッドを分ける
+# 上限を超えた処理はキューで順番を待ち、イベントループはブロックしない
+ingest_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+cpu_executor = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="cpu")
+
+
+async def run_ingest(func, *args, **kwargs):
+    """登録処理のCPUを使う処理を ingest_executor で実行し、結果を待つ"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(ingest_executor, functools.partial(func, *args, **kwargs))
+
+
+async def run_cpu(func, *args, **kwargs):
+    """クエリ側のCPUを使う処理を cpu_executor で実行し、結果を待つ"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(cpu_executor, functools.partial(func, *args, **kwargs))
+
+
+def shutdown():
+    # 実行中の処理の完了を待ってスレッドを終了する
+    ingest_executor.shutdown(wait=True, cancel_futures=True)
+    cpu_executor.shutdown(wait=True, cancel_futures=True)
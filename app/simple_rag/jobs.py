@@ -0,0 +1,304 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from types import SimpleNamespace
+
+from starlette.concurrency import run_in_threadpool
+
+from answer_cache import answer_cache
+from ingestion import INGEST_BATCH_SIZE, READ_BLOCK_SIZE, ingest_documents
+
+# 登録ジョブの設定
+INGEST_SPOOL_DIR = "ingest_spool"  # アップロードされたファイルとジョブの状態を保存するディレクトリ
+MAX_CONCURRENT_JOBS = 2  # 同時に実行する登録ジョブの数 (超えた分は届いた順に待つ)
+JOB_MAX_ERRORS = 100  # ジョブの状態に保存するドキュメントごとのエラーの最大件数
+JOB_RETENTION_SECONDS = 7 * 24 * 3600  # 完了したジョブの状態を残す期間(秒)。起動時に古いものを削除する
+
+
+class _ProgressReader:
+    """読み込んだバイト数をジョブの状態に加えながらファイルを読む"""
+
+    def __init__(self, file, job: dict):
+        self.file = file
+        self.job = job
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file.read(size)
+        self.job["bytes_read"] += len(data)
+        return data
+
+
+def _copy_and_hash(src, path: str) -> str:
+    """src を path に書き込みながら内容のSHA-256を計算する (ドキュメントIDに使う)"""
+    digest = hashlib.sha256()
+    with open(path, "wb") as out:
+        while data := src.read(READ_BLOCK_SIZE):
+            digest.update(data)
+            out.write(data)
+    return digest.hexdigest()
+
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while data := f.read(READ_BLOCK_SIZE):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class IngestJobManager:
+    """
+    /index のアップロードをジョブとして受け付け、バックグラウンドのワーカーで登録する
+    - ファイルはスプール (spool_dir/<ジョブID>/files) に保存し、リクエストはジョブIDを返してすぐに終わる
+    - 同時に実行するジョブは max_concurrent 件までで、超えた分はキューで待つ
+    - 同じインデックス・同じドキュメント名のファイルを含むジョブは届いた順に1件ずつ実行する
+      (以前の版の削除が、並行して登録中の別の版のチャンクを消さないようにするため)
+    - バッチの書き込みが終わるたびに進捗を job.json に保存する (チェックポイント)
+      停止・異常終了したジョブは次回の起動時に、失敗したジョブは retry で、書き込み済みのバッチの次から再開する
+    """
+
+    def __init__(self, spool_dir: str = INGEST_SPOOL_DIR, max_concurrent: int = MAX_CONCURRENT_JOBS):
+        self.spool_dir = spool_dir
+        self.max_concurrent = max_concurrent
+        self._jobs = {}  # ジョブID -> ジョブの状態
+        self._queue = None
+        self._workers = []
+        self._source_locks = {}  # (インデックス名, ドキュメント名) -> [ロック, 使用中・待機中のジョブ数]
+
+    def _job_dir(self, job_id: str) -> str:
+        return os.path.join(self.spool_dir, job_id)
+
+    def _save(self, job: dict):
+        # 書き込み途中で停止しても壊れないよう、一時ファイルに書いてから置き換える
+        path = os.path.join(self._job_dir(job["id"]), "job.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def _load_all(self) -> list:
+        jobs = []
+        if not os.path.isdir(self.spool_dir):
+            return jobs
+        now = time.time()
+        for job_id in os.listdir(self.spool_dir):
+            path = os.path.join(self._job_dir(job_id), "job.json")
+            try:
+                with open(path, encoding="utf-8") as f:
+                    job = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"登録ジョブ {job_id} の状態を読み込めませんでした: {e}")
+                continue
+            if job["status"] == "completed" and now - job["finished_at"] > JOB_RETENTION_SECONDS:
+                shutil.rmtree(self._job_dir(job_id), ignore_errors=True)
+                continue
+            jobs.append(job)
+        return sorted(jobs, key=lambda job: job["created_at"])
+
+    async def start(self):
+        """保存されたジョブを読み込み、終わっていないジョブをキューに戻してワーカーを起動する"""
+        self._queue = asyncio.Queue()
+        for job in await run_in_threadpool(self._load_all):
+            self._jobs[job["id"]] = job
+            if job["status"] in ("queued", "running"):
+                print(f"登録ジョブ {job['id']} を再開します (書き込み済みのバッチ: {job['batches_done']})")
+                job["status"] = "queued"
+                self._queue.put_nowait(job["id"])
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrent)]
+
+    async def stop(self):
+        # 実行中のジョブは running のまま残し、次回の起動時に最後のチェックポイントから再開する
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def _spool_files(self, job_id: str, uploaded_files) -> list:
+        files_dir = os.path.join(self._job_dir(job_id), "files")
+        os.makedirs(files_dir)
+        files = []
+        try:
+            for i, uploaded_file in enumerate(uploaded_files):
+                path = os.path.join(files_dir, f"{i:04d}")
+                sha256 = _copy_and_hash(uploaded_file.file, path)
+                files.append({"name": uploaded_file.filename, "path": path, "bytes": os.path.getsize(path), "sha256": sha256})
+        except BaseException:
+            shutil.rmtree(self._job_dir(job_id), ignore_errors=True)
+            raise
+        return files
+
+    async def submit(self, index_name: str, uploaded_files) -> dict:
+        """アップロードされたファイルをスプールに保存してジョブをキューに入れ、ジョブの状態を返す"""
+        job_id = uuid.uuid4().hex
+        # ファイルのコピーはI/Oのため、登録用のスレッドではなくStarletteのスレッドプールで行う
+        files = await run_in_threadpool(self._spool_files, job_id, uploaded_files)
+        job = {
+            "id": job_id,
+            "index_name": index_name,
+            "status": "queued",
+            "files": files,
+            "batch_size": INGEST_BATCH_SIZE,  # 再開時に同じ区切りでバッチを作るため保存する
+            "bytes_total": sum(f["bytes"] for f in files),
+            "bytes_read": 0,
+            "batches_done": 0,
+            "chunks": 0,
+            "indexed": 0,
+            "skipped": 0,
+            "failed": 0,
+            "deleted": 0,
+            "errors": [],
+            "error": None,
+            "attempts": 0,
+            "seconds": 0.0,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+        }
+        self._save(job)
+        self._jobs[job_id] = job
+        self._queue.put_nowait(job_id)
+        return self.view(job)
+
+    async def retry(self, job_id: str) -> dict:
+        """失敗したジョブを最後のチェックポイントから再実行する"""
+        job = self._jobs[job_id]
+        if job["status"] != "failed":
+            raise ValueError(f"ジョブの状態が {job['status']} のため再実行できません (failed のジョブのみ再実行できます)")
+        job["status"] = "queued"
+        job["error"] = None
+        self._save(job)
+        self._queue.put_nowait(job_id)
+        return self.view(job)
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            await self._run(self._jobs[job_id])
+
+    @contextlib.asynccontextmanager
+    async def _source_lock(self, key: tuple):
+        entry = self._source_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._source_locks[key]
+
+    async def _run(self, job: dict):
+        # 同じドキュメント名を登録中のジョブが終わるまで queued のまま待つ (デッドロックしないよう同じ順に取る)
+        async with contextlib.AsyncExitStack() as stack:
+            for key in sorted({(job["index_name"], f["name"]) for f in job["files"]}):
+                await stack.enter_async_context(self._source_lock(key))
+            await self._ingest(job)
+
+    async def _ingest(self, job: dict):
+        job["status"] = "running"
+        job["started_at"] = job["started_at"] or time.time()
+        job["attempts"] += 1
+        job["bytes_read"] = 0
+        self._save(job)
+        run_started = time.perf_counter()
+        seconds_before = job["seconds"]
+
+        async def checkpoint(batch_no: int, stats: dict):
+            job["batches_done"] = batch_no + 1
+            job["chunks"] += stats["chunks"]
+            job["indexed"] += stats["success"]
+            job["skipped"] += stats["skipped"]
+            job["failed"] += len(stats["errors"])
+            job["errors"].extend(stats["errors"][:max(JOB_MAX_ERRORS - len(job["errors"]), 0)])
+            job["seconds"] = seconds_before + (time.perf_counter() - run_started)
+            if stats["success"]:
+                # インデックスの内容が変わったため、このインデックスのキャッシュした回答を無効にする
+                answer_cache.bump_generation(job["index_name"])
+            self._save(job)
+
+        try:
+            for f in job["files"]:
+                if "sha256" not in f:
+                    # ハッシュを保存する前に受け付けたジョブは、スプールのファイルから計算する
+                    f["sha256"] = await run_in_threadpool(_file_sha256, f["path"])
+            with contextlib.ExitStack() as stack:
+                files = [
+                    SimpleNamespace(
+                        filename=f["name"], sha256=f["sha256"],
+                        file=_ProgressReader(stack.enter_context(open(f["path"], "rb")), job),
+                    )
+                    for f in job["files"]
+                ]
+                result = await ingest_documents(
+                    job["index_name"], files, batch_size=job["batch_size"],
+                    skip_batches=job["batches_done"], on_batch=checkpoint,
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"登録ジョブ {job['id']} が失敗しました: {e}")
+            job["status"] = "failed"
+            job["error"] = str(e)
+            job["finished_at"] = time.time()
+            self._save(job)
+            return
+
+        job["deleted"] = result["deleted"]
+        if result["deleted"]:
+            # 以前の版のチャンクを削除したため、このインデックスのキャッシュした回答を無効にする
+            answer_cache.bump_generation(job["index_name"])
+        job["status"] = "completed"
+        job["seconds"] = seconds_before + (time.perf_counter() - run_started)
+        job["finished_at"] = time.time()
+        self._save(job)
+        # 登録が終わったファイルは削除し、ジョブの状態だけを残す
+        await run_in_threadpool(shutil.rmtree, os.path.join(self._job_dir(job["id"]), "files"), True)
+        print(
+            f"登録ジョブ {job['id']} が完了しました: インデックス '{job['index_name']}' に {job['indexed']} 件を登録 "
+            f"(変更なし: {job['skipped']} 件, 失敗: {job['failed']} 件, 以前の版を削除: {job['deleted']} 件, {job['seconds']:.1f}秒)"
+        )
+
+    def get(self, job_id: str) -> dict:
+        job = self._jobs.get(job_id)
+        return self.view(job) if job is not None else None
+
+    def view(self, job: dict) -> dict:
+        """GET /index/jobs/{id} で返すジョブの進捗"""
+        done = job["status"] == "completed"
+        return {
+            "job_id": job["id"],
+            "index_name": job["index_name"],
+            "status": job["status"],  # queued / running / completed / failed
+            "files": len(job["files"]),
+            "bytes_total": job["bytes_total"],
+            "bytes_read": job["bytes_total"] if done else job["bytes_read"],
+            "progress": 1.0 if done else (job["bytes_read"] / job["bytes_total"] if job["bytes_total"] else 0.0),
+            "batches_done": job["batches_done"],
+            "chunks": job["chunks"],
+            "indexed": job["indexed"],
+            "skipped": job["skipped"],
+            "failed": job["failed"],
+            "deleted": job.get("deleted", 0),  # 削除した以前の版のチャンク数
+            "chunks_per_sec": job["chunks"] / job["seconds"] if job["seconds"] else 0.0,
+            "seconds": job["seconds"],
+            "attempts": job["attempts"],
+            "errors": job["errors"],
+            "error": job["error"],
+            "created_at": job["created_at"],
+            "started_at": job["started_at"],
+            "finished_at": job["finished_at"],
+        }
+
+    def stats(self) -> dict:
+        counts = {}
+        for job in self._jobs.values():
+            counts[job["status"]] = counts.get(job["status"], 0) + 1
+        return {"jobs": counts, "queued": self._queue.qsize() if self._queue else 0, "max_concurrent": self.max_concurrent}
+
+
+# 全モジュールで共有するジョブの管理
+job_manager = IngestJobManager()
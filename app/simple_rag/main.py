@@ -1,21 +1,58 @@
+import asyncio
+import json
+import time
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException, Query
-from schemas import IndexRequest, QueryRequest, QueryResponse
-from embedding import embed_texts
-from elasticsearch_client import create_index, add_document, index_exists, search_similar, es
-from llm_client import ask_llm
-from chunk import chunking
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from schemas import BatchQueryItem, BatchQueryRequest, BatchQueryResponse, IndexRequest, QueryRequest, QueryResponse
+from embedding import MODEL_NAME, embed_texts, embed_query, query_batcher, embedding_cache, warmup
+from model_registry import registry
+from vector_store import EXPORT_PAGE_SIZE, store
+from llm_client import LLM_MAX_CONCURRENCY, ask_llm, llm_client
+from jobs import job_manager
+from answer_cache import answer_cache
+from context import pack_context
+from metrics import MetricsMiddleware, metrics_response, stage
+import executors
 from fastapi import FastAPI, UploadFile, File, Form
-from typing import List
+from typing import List, Literal, Optional
 from fastapi.middleware.cors import CORSMiddleware
 
+# /query/batch の設定
+QUERY_BATCH_MAX_QUESTIONS = 256  # 1リクエストで受け付ける質問数の上限
+QUERY_BATCH_CONCURRENCY = LLM_MAX_CONCURRENCY  # 1リクエストの中で同時に回答を生成する質問の数 (超えた分は順番を待つ)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # 埋め込みモデルの読み込みとウォームアップはバックグラウンドで行い、起動を待たせない
+    # 完了するまで /ready は503を返し、その間に届いたリクエストは読み込みの完了を待つ
+    app.state.warmup_task = asyncio.create_task(executors.run_cpu(warmup))
+    # 前回の実行で終わらなかった登録ジョブを再開し、ワーカーを起動する
+    await job_manager.start()
     yield
+    await job_manager.stop()  # 実行中の登録ジョブは次回の起動時に続きから再開する
+    await llm_client.aclose()  # Ollamaへのコネクションプールを閉じる
+    await store.close()  # Elasticsearchへのコネクションプールを閉じる
+    executors.shutdown()
+
+
+try:
+    import orjson
+except ImportError:  # orjson がない環境では標準の json でシリアライズする
+    orjson = None
+
 
+class FastJSONResponse(JSONResponse):
+    """orjson でシリアライズするレスポンス (標準の json より高速で、NumPyの値もそのまま扱える)"""
 
-app = FastAPI(lifespan=lifespan)
+    def render(self, content) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -23,57 +60,293 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],  # ブラウザから処理段階ごとの時間を参照できるようにする
 )
+# 処理時間・処理中のリクエスト数を記録し、Server-Timing ヘッダーを付ける
+app.add_middleware(MetricsMiddleware)
 
-@app.post("/index")
+@app.post("/index", status_code=202)
 async def index_docs(
     index_name: str = Form(...),  # フォームから取得
-    documents: List[UploadFile] = File(...)  # ファイルを複数受け取る
+    documents: List[UploadFile] = File(...),  # ファイルを複数受け取る
+    # 新規作成するインデックスの埋め込みの保存形式 (既存のインデックスには影響しない)
+    vector_type: Literal["float", "int8_hnsw", "byte"] = Form("float"),
 ):
-    all_chunks = []
-    for uploaded_file in documents:
-        content_bytes = await uploaded_file.read()
-        text = content_bytes.decode("utf-8")
-        chunks = chunking(text, chunk_size=50, overlap=10)
-        all_chunks.extend(chunks)
+    # インデックスの存在確認はリクエストごとに1回だけ行う
+    try:
+        await store.create_index(index_name, vector_type=vector_type)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # ファイルをスプールに保存してジョブIDを返し、チャンク分割・埋め込み・書き込みはバックグラウンドで行う
+    # チャンクIDはドキュメント名と内容のハッシュで、登録済みのチャンクは埋め込み・書き込みを省略する
+    try:
+        job = await job_manager.submit(index_name, documents)
+    except OSError as e:
+        raise HTTPException(status_code=500, detail=f"アップロードの保存に失敗しました: {e}")
+
+    return {
+        "message": f"インデックス '{index_name}' への登録を受け付けました (ジョブID: {job['job_id']})",
+        "status_url": f"/index/jobs/{job['job_id']}",
+        **job,
+    }
+
+
+@app.get("/index/jobs/{job_id}")
+def get_index_job(job_id: str):
+    # 登録ジョブの状態 (queued / running / completed / failed)、進捗、chunks/秒、エラー
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"ジョブ '{job_id}' は存在しません。")
+    return job
+
+
+@app.post("/index/jobs/{job_id}/retry", status_code=202)
+async def retry_index_job(job_id: str):
+    # 失敗したジョブを書き込み済みのバッチの次から再実行する
+    if job_manager.get(job_id) is None:
+        raise HTTPException(status_code=404, detail=f"ジョブ '{job_id}' は存在しません。")
+    try:
+        return await job_manager.retry(job_id)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+async def retrieve(req: QueryRequest):
+    """
+    質問をベクトル化して類似チャンクを検索し、検索結果と検索ごとの処理時間(ミリ秒)を返す
+    retrieval_mode が hybrid の場合はBM25とkNNの検索を1回のmsearchで実行して統合する
+    """
+    with stage("embed"):
+        q_emb = await embed_query(req.question)
+    if req.retrieval_mode == "hybrid":
+        with stage("search"):
+            result = await store.search_hybrid(
+                req.index_name, req.question, q_emb, req.top_k,
+                fusion=req.fusion, num_candidates=req.num_candidates,
+            )
+        return result["docs"], result["timings"]
+
+    started = time.perf_counter()
+    with stage("search"):
+        docs = await store.search_vector(
+            req.index_name, q_emb, req.top_k, mode=req.search_mode, num_candidates=req.num_candidates
+        )
+    return docs, {"vector_ms": (time.perf_counter() - started) * 1000}
+
+
+async def prepare_prompt(req: QueryRequest):
+    """検索結果、回答生成用のプロンプト、検索ごとの処理時間を返す"""
+    docs, timings = await retrieve(req)
+    # 重なる・隣接するチャンクをつなげて重複を除き、トークン数の上限に収める
+    with stage("pack_context"):
+        context = await executors.run_cpu(pack_context, docs)
+    return docs, make_prompt(context, req.question), timings
 
-    embeddings = embed_texts(all_chunks)
-    for i, (chunk, emb) in enumerate(zip(all_chunks, embeddings)):
-        add_document(index_name=index_name, id=f"chunk_{i}", content=chunk, embedding=emb)
 
-    return {"message": f"インデックス '{index_name}' に {len(all_chunks)} 件のチャンクを登録しました"}
+def make_prompt(context: str, question: str) -> str:
+    return f"以下の情報を参考に質問に答えてください:\n{context}\n質問: {question}"
+
+
+def cache_namespace(req: QueryRequest) -> tuple:
+    # 回答に影響する検索条件が同じ質問だけを比較する (先頭はインデックス名)
+    return (req.index_name, req.top_k, req.search_mode, req.num_candidates, req.retrieval_mode, req.fusion)
+
 
 @app.post("/query", response_model=QueryResponse)
-def query_answer(req: QueryRequest):
-    q_emb = embed_texts([req.question])[0]
-    docs = search_similar(q_emb, req.top_k, req.index_name)
-    context = "\n".join([d["content"] for d in docs])
-    prompt = f"以下の情報を参考に質問に答えてください:\n{context}\n質問: {req.question}"
-    answer = ask_llm(prompt)
-    return QueryResponse(answer=answer, docs=docs)
+async def query_answer(req: QueryRequest):
+    if req.use_cache:
+        # 検索と回答生成の前に、言い換えを含む類似した質問の回答がキャッシュにないか確認する
+        generation = answer_cache.generation(req.index_name)
+        with stage("embed"):
+            q_emb = await embed_query(req.question)
+        with stage("cache_lookup"):
+            cached = answer_cache.lookup(cache_namespace(req), q_emb)
+        if cached is not None:
+            return QueryResponse(answer=cached["answer"], docs=cached["docs"], cached=True)
+
+    docs, prompt, timings = await prepare_prompt(req)
+    with stage("generate"):
+        answer = await ask_llm(prompt)
+    if req.use_cache:
+        answer_cache.store(cache_namespace(req), q_emb, answer, docs, generation)
+    return QueryResponse(answer=answer, docs=docs, timings=timings)
+
+
+@app.post("/query/batch", response_model=BatchQueryResponse)
+async def query_answer_batch(req: BatchQueryRequest):
+    """
+    複数の質問にまとめて回答する (評価やバッチ処理で /query を繰り返し呼ぶ代わりに使う)
+    - 全ての質問を1回の embed_texts でベクトル化し、1回の _msearch で検索する
+    - 回答生成は QUERY_BATCH_CONCURRENCY 件まで並行して行い、結果は questions と同じ順に返す
+    - 質問ごとの検索・回答生成の失敗はその質問の error に入れ、他の質問の結果は返す
+      (検索全体が失敗した場合もキャッシュにあった質問の回答は返し、それ以外の質問の error に入れる)
+    """
+    if len(req.questions) > QUERY_BATCH_MAX_QUESTIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"質問数が上限 ({QUERY_BATCH_MAX_QUESTIONS} 件) を超えています: {len(req.questions)} 件",
+        )
+    namespace = cache_namespace(req)
+    generation = answer_cache.generation(req.index_name)
+    with stage("embed"):
+        embeddings = await executors.run_cpu(embed_texts, req.questions)
+
+    results = [None] * len(req.questions)
+    pending = []  # キャッシュになかった質問の番号
+    with stage("cache_lookup"):
+        for i, q_emb in enumerate(embeddings):
+            cached = answer_cache.lookup(namespace, q_emb) if req.use_cache else None
+            if cached is not None:
+                results[i] = BatchQueryItem(answer=cached["answer"], docs=cached["docs"], cached=True)
+            else:
+                pending.append(i)
+
+    try:
+        with stage("search"):
+            searched = await store.search_batch(
+                req.index_name, [req.questions[i] for i in pending], [embeddings[i] for i in pending], req.top_k,
+                retrieval_mode=req.retrieval_mode, mode=req.search_mode, fusion=req.fusion, num_candidates=req.num_candidates,
+            )
+    except Exception as e:
+        # インデックスがない・接続できないなど検索全体の失敗は、キャッシュから返せる質問の結果を残して各質問の error に入れる
+        print(f"まとめた検索に失敗しました: {e}")
+        searched = [{"docs": [], "timings": None, "error": f"検索に失敗しました: {e}"} for _ in pending]
+    with stage("pack_context"):
+        contexts = await executors.run_cpu(lambda: [pack_context(result["docs"]) for result in searched])
+
+    semaphore = asyncio.Semaphore(QUERY_BATCH_CONCURRENCY)
+
+    async def answer_one(i: int, result: dict, context: str) -> BatchQueryItem:
+        if result["error"] is not None:
+            return BatchQueryItem(timings=result["timings"], error=result["error"])
+        async with semaphore:
+            try:
+                with stage("generate"):
+                    answer = await ask_llm(make_prompt(context, req.questions[i]))
+            except HTTPException as e:
+                return BatchQueryItem(docs=result["docs"], timings=result["timings"], error=e.detail)
+        if req.use_cache:
+            answer_cache.store(namespace, embeddings[i], answer, result["docs"], generation)
+        return BatchQueryItem(answer=answer, docs=result["docs"], timings=result["timings"])
+
+    answered = await asyncio.gather(*(
+        answer_one(i, result, context) for i, result, context in zip(pending, searched, contexts)
+    ))
+    for i, item in zip(pending, answered):
+        results[i] = item
+    return BatchQueryResponse(results=results, errors=sum(item.error is not None for item in results))
+
+
+def sse_event(event: str, data: dict) -> str:
+    # Server-Sent Events の1イベント分の文字列
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/query/stream")
+async def query_answer_stream(req: QueryRequest, request: Request):
+    """
+    検索結果を docs イベントで先に返し、その後Ollamaが生成したトークンを token イベントで順に返す
+    クライアントが切断した場合はOllamaへの接続を閉じて生成を打ち切る
+    """
+    docs, prompt, timings = await prepare_prompt(req)
+
+    async def event_stream():
+        yield sse_event("docs", {"docs": docs, "timings": timings})
+        tokens = llm_client.stream(prompt)
+        try:
+            # 生成の時間はヘッダーの送信後のため Server-Timing には入らず、ヒストグラムにだけ記録される
+            with stage("generate"):
+                async for token in tokens:
+                    if await request.is_disconnected():
+                        print("クライアントが切断したため回答生成を中断します。")
+                        return
+                    yield sse_event("token", {"token": token})
+            yield sse_event("done", {})
+        except Exception as e:
+            yield sse_event("error", {"detail": f"LLM問い合わせ失敗: {str(e)}"})
+        finally:
+            await tokens.aclose()  # 上流のストリームを閉じて生成を止める
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/ready")
+def ready():
+    # 埋め込みモデルの読み込みとウォームアップが終わっていれば200、それまでは503を返す
+    is_ready = registry.is_ready(MODEL_NAME)
+    return FastJSONResponse(
+        status_code=200 if is_ready else 503,
+        content={"ready": is_ready, "models": registry.stats()},
+    )
+
+
+@app.get("/stats")
+def get_stats():
+    # 埋め込みバッチャーのバッチサイズ・キュー待ち時間、埋め込みキャッシュのヒット率、LLMのキューの深さなどの統計
+    return {
+        "models": registry.stats(),
+        "embedding_batcher": query_batcher.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "llm": llm_client.stats(),
+        "answer_cache": answer_cache.stats(),
+        "ingest_jobs": job_manager.stats(),
+    }
+
+
+@app.get("/metrics")
+def get_metrics():
+    # Prometheus 形式のメトリクス (処理段階ごとの処理時間のヒストグラム、Elasticsearch・Ollamaのエラー数など)
+    return metrics_response()
 
 
 @app.get("/get_index")
-def get_index(index_name: str):
+async def get_index(
+    index_name: str,
+    cursor: Optional[str] = None,  # 前回のレスポンスの最後の行の next_cursor (続きから取得する)
+    limit: Optional[int] = Query(None, ge=1),  # 返すドキュメント数の上限 (省略時は全件)
+):
+    """
+    インデックスのチャンクを NDJSON (1行に1件の {"id": ..., "content": ...}) でストリーミングして返す
+    ページ単位で取得しながら送るため、インデックスの大きさによらずサーバーのメモリ使用量は一定
+    最後の行は {"next_cursor": ..., "count": 返した件数} で、next_cursor が null でなければ続きがある
+    途中でエラーが起きた場合は最後の行に error と、送信済みの続きから再開できる next_cursor を返す
+    """
+    def page_size(count: int) -> int:
+        return min(EXPORT_PAGE_SIZE, limit - count) if limit else EXPORT_PAGE_SIZE
+
+    # 最初のページはレスポンスを返す前に取得し、カーソルやインデックスの誤りをステータスコードで返す
     try:
-        count = es.count(index=index_name)["count"]
-        # ドキュメント取得数の上限まで達した場合は10000を返す。
-        if count > 10000:
-            count = 10000
-        print(f"{index_name} のドキュメント件数は {count} 件です。")
-        resp = es.search(
-            index=index_name,
-            query={"match_all": {}},
-            size=count
-        )
-        hits = resp["hits"]["hits"]
-        contents = [hit["_source"]["content"] for hit in hits]
-        return {"index_name": index_name, "documents": contents}
+        docs, next_cursor = await store.fetch_page(index_name, cursor, page_size(0))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"インデックス取得失敗: {e}")
-    
+
+    async def lines():
+        nonlocal docs, next_cursor
+        count = 0
+        while True:
+            yield "".join(json.dumps(doc, ensure_ascii=False) + "\n" for doc in docs)
+            count += len(docs)
+            if next_cursor is None or (limit and count >= limit):
+                break
+            try:
+                docs, next_cursor = await store.fetch_page(index_name, next_cursor, page_size(count))
+            except Exception as e:
+                print(f"インデックス取得中にエラーが発生しました: {e}")
+                yield json.dumps({"error": str(e), "next_cursor": next_cursor, "count": count}, ensure_ascii=False) + "\n"
+                return
+        print(f"{index_name} から {count} 件のドキュメントを取得しました。")
+        yield json.dumps({"next_cursor": next_cursor, "count": count}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True)
\ No newline at end of file
+    # reload=True は監視用のプロセスとアプリのプロセスが分かれ、変更のたびにモデルを読み込み直すため使わない
+    uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=False)
\ No newline at end of file
@@ -0,0 +1,100 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from starlette.responses import Response
+
+# ヒストグラムのバケット(秒)。埋め込み・検索の数ミリ秒からLLMの生成の数分までを含める
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+REQUEST_SECONDS = Histogram(
+    "rag_request_duration_seconds", "リクエストの処理時間 (ストリーミングは送信完了まで)",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS,
+)
+REQUESTS_IN_FLIGHT = Gauge("rag_requests_in_flight", "処理中のリクエスト数")
+STAGE_SECONDS = Histogram("rag_stage_duration_seconds", "処理段階ごとの処理時間", ["stage"], buckets=LATENCY_BUCKETS)
+STAGE_ERRORS = Counter("rag_stage_errors_total", "例外で終わった処理段階の数", ["stage"])
+BACKEND_ERRORS = Counter("rag_backend_errors_total", "Elasticsearch・Ollamaの呼び出しの失敗数", ["backend", "operation"])
+INGEST_CHUNKS = Counter("rag_ingest_chunks_total", "登録処理したチャンク数 (indexed: 登録, skipped: 登録済み, failed: 失敗, deleted: 以前の版を削除)", ["result"])
+INGEST_IN_FLIGHT = Gauge("rag_ingest_in_flight", "実行中の登録処理の数")
+LLM_IN_FLIGHT = Gauge("rag_llm_in_flight", "Ollamaで生成中の数")
+LLM_WAITING = Gauge("rag_llm_waiting", "Ollamaの同時生成数の空きを待っている数")
+
+# リクエストごとの処理段階の時間(秒)。MetricsMiddleware がリクエストごとに空の辞書を設定する
+# create_task やスレッドプールにはコンテキストがコピーされるが、辞書は同じものを参照するため並行した段階も記録される
+_stage_timings: ContextVar = ContextVar("stage_timings", default=None)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    処理段階の時間をヒストグラムに記録し、同じリクエストの Server-Timing ヘッダーにも加える
+    同じ段階を複数回実行した場合 (書き換えたクエリでの再検索など) は Server-Timing では合計する
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.labels(name).inc()
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.labels(name).observe(elapsed)
+        timings = _stage_timings.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+
+def record_backend_error(backend: str, operation: str, count: int = 1):
+    BACKEND_ERRORS.labels(backend, operation).inc(count)
+
+
+def server_timing(timings: dict, total: float) -> str:
+    # 例: embed;dur=12.3, search;dur=4.5, generate;dur=812.0, total;dur=830.1 (ミリ秒)
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+class MetricsMiddleware:
+    """
+    リクエストの処理時間と処理中の数を記録し、レスポンスに処理段階ごとの Server-Timing ヘッダーを付ける
+    ストリーミングのレスポンスでは、ヘッダーを送るまでに終わった段階 (検索など) だけがヘッダーに入る
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        timings = {}
+        token = _stage_timings.set(timings)
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                header = server_timing(timings, time.perf_counter() - started)
+                message = {**message, "headers": [*message.get("headers", []), (b"server-timing", header.encode("latin-1"))]}
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            _stage_timings.reset(token)
+            # パスではなくルートのテンプレートをラベルにする (一致しないパスは1つにまとめる)
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_SECONDS.labels(scope["method"], route, str(status)).observe(time.perf_counter() - started)
+
+
+def metrics_response() -> Response:
+    """Prometheus のテキスト形式で全メトリクスを返す"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
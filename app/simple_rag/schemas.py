@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List
+from typing import Dict, List, Literal, Optional
 from fastapi import UploadFile
 
 class IndexRequest(BaseModel):
@@ -10,11 +10,44 @@ class QueryRequest(BaseModel):
     question: str
     top_k: int
     index_name: str
+    search_mode: Literal["knn", "exact"] = "knn"  # knn: 近似検索, exact: 全件計算
+    num_candidates: int = 100  # kNN検索の候補数
+    retrieval_mode: Literal["vector", "hybrid"] = "vector"  # hybrid: BM25とベクトル検索を1回のmsearchで実行して統合
+    fusion: Literal["rrf", "weighted"] = "rrf"  # hybrid の統合方法
+    use_cache: bool = True  # 類似した質問の回答をキャッシュから返す
 
 class DocItem(BaseModel):
+    id: Optional[str] = None  # チャンクID
     content: str
     score: float
+    source: Optional[str] = None  # チャンクの元ドキュメント名
+    doc_id: Optional[str] = None  # 元ドキュメントのID (ファイル内容とチャンク分割の設定のハッシュ)
+    start: Optional[int] = None  # 元ドキュメント内のチャンクの開始位置(文字)
+    end: Optional[int] = None  # 元ドキュメント内のチャンクの終了位置(文字)
 
 class QueryResponse(BaseModel):
     answer: str
-    docs: List[DocItem]
\ No newline at end of file
+    docs: List[DocItem]
+    timings: Optional[Dict[str, float]] = None  # 検索ごとの処理時間(ミリ秒)
+    cached: bool = False  # 回答キャッシュから返した場合はTrue
+
+class BatchQueryRequest(BaseModel):
+    questions: List[str]  # 回答する質問のリスト (結果はこの順に返す)
+    top_k: int
+    index_name: str
+    search_mode: Literal["knn", "exact"] = "knn"  # knn: 近似検索, exact: 全件計算
+    num_candidates: int = 100  # kNN検索の候補数
+    retrieval_mode: Literal["vector", "hybrid"] = "vector"  # hybrid: BM25とベクトル検索を1回のmsearchで実行して統合
+    fusion: Literal["rrf", "weighted"] = "rrf"  # hybrid の統合方法
+    use_cache: bool = True  # 類似した質問の回答をキャッシュから返す
+
+class BatchQueryItem(BaseModel):
+    answer: Optional[str] = None  # 失敗した場合はNone
+    docs: List[DocItem] = []
+    timings: Optional[Dict[str, float]] = None  # 検索ごとの処理時間(ミリ秒)
+    cached: bool = False  # 回答キャッシュから返した場合はTrue
+    error: Optional[str] = None  # この質問の検索・回答生成に失敗した理由
+
+class BatchQueryResponse(BaseModel):
+    results: List[BatchQueryItem]  # questions と同じ順の結果
+    errors: int  # 失敗した質問の数